@@ -0,0 +1,77 @@
+"""
+Import a training plan into the Groupalarm appointments of the organization.
+
+Usage:
+	python appointments.py plan.csv [--labels 12 34] [--timezone Europe/Berlin] [--prune] [--dry-run] [--workers 8]
+	python appointments.py plan.ics [--until 2027-12-31] …
+
+Appointments are matched with the existing ones by name and start. Changed appointments are updated, new ones created
+and, with `--prune`, existing appointments within the timespan of the plan that are not part of it deleted. Recurring
+events of ICS files are imported with all their occurrences, up to `--until` if they recur forever.
+"""
+
+import sys
+import argparse
+import logging
+from datetime import date, datetime, time
+from zoneinfo import ZoneInfo
+
+from config import Config
+from lib.groupalarm import GroupalarmClient
+from modules.appointments import Progress, import_plan, read_plan
+
+
+def main():
+	argp = argparse.ArgumentParser(prog='python appointments.py')
+	argp.add_argument('plan', help='CSV or ICS file')
+	argp.add_argument('--config', default='config.toml', metavar='FILE')
+	argp.add_argument('--labels', type=int, nargs='+', metavar='ID', help='Groupalarm labels of appointments that do not name their own')
+	argp.add_argument('--timezone', type=ZoneInfo, metavar='NAME', help='of times without an offset, defaults to the one named by an ICS file or the local one')
+	argp.add_argument('--until', type=_until, metavar='DATE', help='last start of occurrences of recurring ICS events')
+	argp.add_argument('--prune', action='store_true', help='delete existing appointments that are not planned')
+	argp.add_argument('--dry-run', action='store_true', help='only report the changes')
+	argp.add_argument('--workers', type=int, default=8, help='concurrent requests')
+	argp.add_argument('--debug', action='store_true')
+
+	args = argp.parse_args()
+
+	logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s %(threadName)s %(name)s [%(levelname)s] %(message)s')
+
+	config = Config(args.config)
+	if config.groupalarm.api_key is None:
+		sys.exit('No Groupalarm API key configured')
+
+	client = GroupalarmClient(config.groupalarm.api_key)
+	try:
+		client.init()
+
+		def _progress(state: Progress):
+			print(f'\r{state}', end='\n' if state.done == state.total else '', file=sys.stderr, flush=True)
+
+		try:
+			changes, result = import_plan(client, read_plan(args.plan, tz=args.timezone, label_ids=args.labels, until=args.until), prune=args.prune, dry_run=args.dry_run, workers=args.workers, progress=_progress)
+		except (OSError, ValueError) as e:
+			sys.exit(str(e))
+
+		if args.dry_run:
+			for appointment in changes.create:
+				print(f'create  {appointment.start:%Y-%m-%d %H:%M}  {appointment.name}')
+			for _, appointment in changes.update:
+				print(f'update  {appointment.start:%Y-%m-%d %H:%M}  {appointment.name}')
+			for appointment in changes.delete:
+				print(f'delete  {appointment["startDate"]}  {appointment["name"]}')
+		elif result is not None and result.failed > 0:
+			sys.exit(1)
+	finally:
+		client.close()
+
+
+def _until(value: str) -> datetime:
+	# a date includes the whole day
+	if len(value) == 10:
+		return datetime.combine(date.fromisoformat(value), time.max)
+	return datetime.fromisoformat(value)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,81 @@
+"""
+Query and replay the alarm archive of an Alarmierung module.
+
+Usage:
+	python archive.py query [--since 2026-01-01] [--until 2026-02-01] [--event 1234] [--limit 10] [--json]
+	python archive.py replay --channel 1234 [--speed 10] [--since …]
+	python archive.py replay --dry-run [--since …]
+"""
+
+import sys
+import json
+import argparse
+import logging
+from datetime import datetime
+
+from config import Config
+from modules.archive import open_archive
+from modules.registry import create_module
+
+
+def main():
+	argp = argparse.ArgumentParser(prog='python archive.py')
+	argp.add_argument('--config', default='config.toml', metavar='FILE')
+	argp.add_argument('--module', default='alarmierung', metavar='NAME', help='the Alarmierung module whose archive to use')
+	argp.add_argument('--debug', action='store_true')
+	commands = argp.add_subparsers(dest='command', required=True)
+
+	def _filters(parser: argparse.ArgumentParser):
+		parser.add_argument('--since', type=datetime.fromisoformat, help='received at or after, ISO 8601')
+		parser.add_argument('--until', type=datetime.fromisoformat, help='received before, ISO 8601')
+		parser.add_argument('--event', type=int, help='Groupalarm event id')
+		parser.add_argument('--limit', type=int, help='only the newest alarms')
+
+	query = commands.add_parser('query', help='list archived alarms')
+	_filters(query)
+	query.add_argument('--json', action='store_true', help='one JSON object per line, including the payload')
+
+	replay = commands.add_parser('replay', help='forward archived alarms again')
+	_filters(replay)
+	replay.add_argument('--channel', type=int, help='Hermine channel to forward the alarms to, required unless --dry-run')
+	replay.add_argument('--speed', type=float, default=1.0, help='multiple of the original pace, 0 for as fast as possible')
+	replay.add_argument('--dry-run', action='store_true', help='only render the alarms and report those that differ from the archived message')
+
+	args = argp.parse_args()
+	# so replaying never alarms the real channel by accident
+	if args.command == 'replay' and not args.dry_run and args.channel is None:
+		replay.error('--channel is required unless --dry-run is given')
+
+	logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s %(threadName)s %(name)s [%(levelname)s] %(message)s')
+
+	config = Config(args.config)
+	module, cfg = create_module(args.module, config.module_type(args.module))
+	cfg.load(config.module_data(args.module), config)
+	if getattr(cfg, 'archive', None) is None:
+		sys.exit(f'Module "{args.module}" does not archive alarms')
+
+	archive = open_archive(cfg.archive)
+	alarms = archive.query(since=args.since, until=args.until, event_id=args.event, limit=args.limit)
+
+	if args.command == 'query':
+		for alarm in alarms:
+			if args.json:
+				print(json.dumps(alarm.to_json(), ensure_ascii=False))
+			else:
+				print(f'{alarm.received.astimezone():%Y-%m-%d %H:%M:%S}  #{alarm.event_id:<8} {alarm.payload["event"]["name"]}: {alarm.payload["message"]}{"" if alarm.message is not None else "  (ignored)"}')
+	elif args.dry_run:
+		from modules.alarmierung import TEMPLATES, check_rendering
+		from modules.templates import MessageTemplates
+		from modules.geodata import Enrichment, open_geodata
+
+		enrichment = Enrichment(open_geodata(cfg.geodata) if cfg.geodata is not None else None, cfg.unterkunft, max_distance=cfg.geodata_max_distance)
+		differences = check_rendering(MessageTemplates(TEMPLATES, cfg.templates), alarms, enrichment)
+		logging.info('%d of %d alarms render differently', differences, len(alarms))
+		sys.exit(1 if differences > 0 else 0)
+	else:
+		module.update_config(cfg)
+		module.replay(alarms, channel=args.channel, speed=args.speed)
+
+
+if __name__ == '__main__':
+	main()
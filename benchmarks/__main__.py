@@ -0,0 +1,98 @@
+"""
+End-to-end benchmarks of the modules against local stand-ins for MQTT, Hermine, Groupalarm, IMAP and CalDAV.
+
+Usage:
+	python -m benchmarks [SCENARIO ...] [--rate 20] [--count 200] [--save results.json] [--compare baseline.json] [--trace spans.jsonl]
+"""
+
+import sys
+import json
+import time
+import argparse
+import logging
+
+from lib.tracing import TRACER
+
+from .harness import Environment
+from .scenarios import SCENARIOS
+
+
+def main():
+	argp = argparse.ArgumentParser(prog='python -m benchmarks')
+	argp.add_argument('scenarios', nargs='*', metavar='SCENARIO', help=f'one of {", ".join(SCENARIOS)} (default: all)')
+	argp.add_argument('--rate', type=float, default=20.0, help='operations per second, 0 for as fast as possible')
+	argp.add_argument('--count', type=int, default=200, help='operations per scenario')
+	argp.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for outstanding operations')
+	argp.add_argument('--users', type=int, default=200, help='Groupalarm users')
+	argp.add_argument('--appointments', type=int, default=3, help='Groupalarm appointments per weekly run')
+	argp.add_argument('--participants', type=int, default=100, help='participants per appointment')
+	argp.add_argument('--save', metavar='FILE', help='write the results as JSON, e.g. as a baseline')
+	argp.add_argument('--compare', metavar='FILE', help='compare the results against a saved baseline')
+	argp.add_argument('--trace', metavar='FILE', help='append the spans of traced operations to FILE as OTLP/JSON')
+	argp.add_argument('--debug', action='store_true')
+	args = argp.parse_args()
+
+	unknown = [name for name in args.scenarios if name not in SCENARIOS]
+	if unknown:
+		argp.error(f'unknown scenario {", ".join(map(repr, unknown))} (choose from {", ".join(SCENARIOS)})')
+
+	logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, format='%(asctime)s %(threadName)s %(name)s [%(levelname)s] %(message)s')
+
+	TRACER.export_to(args.trace)
+
+	# the stand-ins are shared by all scenarios, just like the clients are shared by the modules
+	results = []
+	with Environment(users=args.users, appointments=args.appointments, participants=args.participants) as env:
+		for name in args.scenarios or SCENARIOS:
+			result = SCENARIOS[name](env, rate=args.rate, count=args.count, timeout=args.timeout)
+			results.append(result)
+			_print(result)
+	TRACER.stop()
+
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump({'created': time.time(), 'results': results}, f, indent='\t')
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = {result['scenario']: result for result in json.load(f)['results']}
+		if not _compare(results, baseline):
+			sys.exit(1)
+
+def _print(result: dict) -> None:
+	print(
+		f'{result["scenario"]:<18} '
+		f'{result["completed"]:>5}/{result["operations"]:<5} '
+		f'{result["throughput_per_s"]:8.1f} ops/s  '
+		f'p50 {result["latency_p50_ms"]:8.2f} ms  '
+		f'p99 {result["latency_p99_ms"]:8.2f} ms  '
+		f'rss {result["rss_mb"]:7.1f} MiB'
+	)
+
+def _compare(results: list[dict], baseline: dict[str, dict], *, tolerance: float = 0.10) -> bool:
+	"""Print the relative change of every metric, returning False if any got worse by more than `tolerance`."""
+	ok = True
+	for result in results:
+		base = baseline.get(result['scenario'])
+		if base is None:
+			continue
+		if base['options'] != result['options']:
+			print(f'{result["scenario"]}: options differ from the baseline, skipping comparison')
+			continue
+
+		for metric, higher_is_better in [('throughput_per_s', True), ('latency_p50_ms', False), ('latency_p99_ms', False), ('rss_mb', False)]:
+			if base[metric] == 0:
+				continue
+			change = (result[metric] - base[metric]) / base[metric]
+			regression = -change if higher_is_better else change
+			marker = ' REGRESSION' if regression > tolerance else ''
+			ok &= not marker
+			print(f'{result["scenario"]:<18} {metric:<17} {base[metric]:10.2f} → {result[metric]:10.2f} ({change:+.1%}){marker}')
+		if result['completed'] < base['completed']:
+			ok = False
+			print(f'{result["scenario"]:<18} completed {base["completed"]} → {result["completed"]} REGRESSION')
+	return ok
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,79 @@
+"""
+Compares the batch AES codec against the previous per-field decryption on a message history.
+
+Usage: python -m benchmarks.aes [--messages 1000] [--repeat 20]
+"""
+
+import argparse
+import random
+import string
+import timeit
+
+import Crypto.Random
+
+from lib.hermine import AESBatchCodec, _encrypt_aes, _decrypt_aes
+
+
+def make_history(key: bytes, count: int, *, location_ratio: float = 0.2) -> list[dict]:
+	messages = []
+	for _ in range(count):
+		iv = Crypto.Random.get_random_bytes(16)
+		text = ''.join(random.choices(string.ascii_letters + ' ', k=random.randint(10, 400)))
+		message = {
+			'kind': 'message',
+			'encrypted': True,
+			'text': _encrypt_aes(text.encode('utf-8'), key, iv).hex(),
+			'iv': iv.hex(),
+			'location': None,
+		}
+		if random.random() < location_ratio:
+			message['location'] = {
+				'encrypted': True,
+				'iv': iv.hex(),
+				'latitude': _encrypt_aes(str(random.uniform(47, 55)).encode('utf-8'), key, iv).hex(),
+				'longitude': _encrypt_aes(str(random.uniform(6, 15)).encode('utf-8'), key, iv).hex(),
+			}
+		messages.append(message)
+	return messages
+
+def fields(messages: list[dict]) -> list[tuple[str, str]]:
+	pairs = []
+	for message in messages:
+		pairs.append((message['text'], message['iv']))
+		if message['location'] is not None:
+			pairs.append((message['location']['latitude'], message['location']['iv']))
+			pairs.append((message['location']['longitude'], message['location']['iv']))
+	return pairs
+
+def per_field(pairs: list[tuple[str, str]], key: bytes) -> list[bytes]:
+	return [_decrypt_aes(bytes.fromhex(ciphertext), key, bytes.fromhex(iv)) for ciphertext, iv in pairs]
+
+def batch(pairs: list[tuple[str, str]], key: bytes) -> list[bytes]:
+	return AESBatchCodec(key).decrypt_many(pairs)
+
+
+def main():
+	argp = argparse.ArgumentParser()
+	argp.add_argument('--messages', type=int, default=1000)
+	argp.add_argument('--repeat', type=int, default=20)
+	args = argp.parse_args()
+
+	key = Crypto.Random.get_random_bytes(32)
+	pairs = fields(make_history(key, args.messages))
+
+	if per_field(pairs, key) != batch(pairs, key):
+		raise AssertionError('Batch codec returned different plaintexts')
+
+	results = {
+		'per-field': min(timeit.repeat(lambda: per_field(pairs, key), number=1, repeat=args.repeat)),
+		'batch': min(timeit.repeat(lambda: batch(pairs, key), number=1, repeat=args.repeat)),
+	}
+
+	print(f'{args.messages} messages, {len(pairs)} encrypted fields (best of {args.repeat}):')
+	for name, seconds in results.items():
+		print(f'  {name:<10} {seconds * 1000:8.2f} ms  {seconds / len(pairs) * 1e6:6.2f} µs/field')
+	print(f'  speedup    {results["per-field"] / results["batch"]:8.2f}x')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,5 @@
+from .mqtt import FakeMQTTBroker
+from .hermine import FakeHermine
+from .groupalarm import FakeGroupalarm
+from .imap import FakeIMAPServer
+from .caldav import FakeCalDAV
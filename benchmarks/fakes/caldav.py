@@ -0,0 +1,62 @@
+import threading
+
+from .http import FakeHTTPServer, Request, Response
+
+
+_MULTISTATUS = '''<?xml version="1.0" encoding="utf-8"?>
+<d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">
+	<d:response>
+		<d:href>{href}</d:href>
+		<d:propstat>
+			<d:prop>
+				<d:current-user-principal><d:href>/principal/</d:href></d:current-user-principal>
+				<c:calendar-home-set><d:href>/calendars/</d:href></c:calendar-home-set>
+				<d:resourcetype><d:collection/>{calendar}</d:resourcetype>
+				<d:displayname>bench</d:displayname>
+				<c:supported-calendar-component-set><c:comp name="VEVENT"/></c:supported-calendar-component-set>
+			</d:prop>
+			<d:status>HTTP/1.1 200 OK</d:status>
+		</d:propstat>
+	</d:response>
+</d:multistatus>'''
+
+
+class FakeCalDAV(FakeHTTPServer):
+	"""
+	Minimal CalDAV server accepting any calendar under `/calendars/`, plus a static ICS feed under `/ics/`
+	(the links in the flag notices point to such feeds).
+	"""
+
+	def __init__(self, host: str = '127.0.0.1'):
+		super().__init__(host)
+
+		self._lock = threading.Lock()
+		self.events: dict[str, bytes] = {}
+		self.feeds: dict[str, str] = {}
+
+	def add_feed(self, name: str, ics: str) -> str:
+		with self._lock:
+			self.feeds[name] = ics
+		return f'{self.url}/ics/{name}'
+
+	def handle(self, request: Request) -> Response:
+		if request.path.startswith('/ics/'):
+			ics = self.feeds.get(request.path.removeprefix('/ics/'))
+			return Response(200, ics, {'Content-Type': 'text/calendar'}) if ics is not None else Response(404)
+
+		if request.method == 'OPTIONS':
+			return Response(200, headers={'DAV': '1, 2, 3, calendar-access', 'Allow': 'OPTIONS, GET, PUT, DELETE, PROPFIND, REPORT'})
+		if request.method == 'PROPFIND':
+			calendar = '<c:calendar/>' if request.path.startswith('/calendars/') and request.path.rstrip('/') != '/calendars' else ''
+			return Response(207, _MULTISTATUS.format(href=request.path, calendar=calendar), {'Content-Type': 'application/xml; charset=utf-8'})
+		if request.method == 'REPORT':
+			return Response(207, '<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:"/>', {'Content-Type': 'application/xml; charset=utf-8'})
+		if request.method == 'PUT':
+			with self._lock:
+				self.events[request.path] = request.body
+			return Response(201, headers={'ETag': f'"{len(self.events)}"'})
+		if request.method == 'GET':
+			with self._lock:
+				event = self.events.get(request.path)
+			return Response(200, event, {'Content-Type': 'text/calendar'}) if event is not None else Response(404)
+		return Response(405)
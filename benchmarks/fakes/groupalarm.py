@@ -0,0 +1,51 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from .http import FakeHTTPServer, Request, Response
+
+
+class FakeGroupalarm(FakeHTTPServer):
+	"""Local stand-in for the Groupalarm REST API serving a generated organization with users and appointments."""
+
+	def __init__(self, host: str = '127.0.0.1', *, users: int = 100, appointments: int = 3, participants: int = 50, label_id: int = 1):
+		super().__init__(host)
+
+		self.label_id = label_id
+		self.users = [
+			{'id': user_id, 'name': f'Vorname{user_id}', 'surname': f'Nachname{user_id}', 'pending': False}
+			for user_id in range(1, users + 1)
+		]
+
+		now = datetime.now(timezone.utc)
+		self.appointments = []
+		for i in range(appointments):
+			start = now + timedelta(days=1 + i, hours=2)
+			self.appointments.append({
+				'id': i + 1,
+				'name': f'Ausbildungsdienst {i + 1}',
+				'timezone': 'Europe/Berlin',
+				'startDate': start.isoformat(),
+				'endDate': (start + timedelta(hours=3)).isoformat(),
+				'participants': [
+					{'userID': user['id'], 'feedback': random.randint(0, 3), 'feedbackMessage': random.choice(['', '', 'später'])}
+					for user in random.sample(self.users, min(participants, users))
+				],
+			})
+
+	def handle(self, request: Request) -> Response:
+		path = request.path.removeprefix('/api/v1/')
+
+		if path == 'user':
+			return Response.json({'id': 1})
+		if path == 'organizations':
+			return Response.json([{'id': 1}])
+		if path == 'users':
+			return Response.json(self.users)
+		if path == f'label/{self.label_id}':
+			return Response.json({'id': self.label_id, 'assignees': [user['id'] for user in self.users]})
+		if path == 'appointments/calendar':
+			return Response.json(self.appointments)
+		if path.startswith('appointment/'):
+			appointment_id = int(path.split('/')[1])
+			return Response.json(next(a for a in self.appointments if a['id'] == appointment_id))
+		return Response(404)
@@ -0,0 +1,166 @@
+from collections.abc import Callable
+
+import json
+import time
+import base64
+import itertools
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+import socketio
+import Crypto.PublicKey.RSA
+import Crypto.Cipher.PKCS1_OAEP
+import Crypto.Random
+
+from lib.hermine import AESBatchCodec, _encrypt_aes
+from .http import FakeHTTPServer, Request, Response
+
+
+ENCRYPTION_PASSWORD = 'bench'
+
+
+class FakeHermine(FakeHTTPServer):
+	"""
+	Local stand-in for the Hermine (stashcat) REST API and its socket.io push server.
+
+	Channels are created on demand and share one RSA key pair for the benchmark user, so conversation keys and
+	messages are encrypted exactly like the real API does. `on_message` callbacks receive every decrypted message
+	sent through `message/send`.
+	"""
+
+	def __init__(self, host: str = '127.0.0.1'):
+		super().__init__(host)
+
+		self.user_id = 1
+		self._key = Crypto.PublicKey.RSA.generate(2048)
+		self._channel_keys: dict[int, bytes] = {}
+		self._messages: dict[int, list[dict]] = {}
+		self._ids = itertools.count(1)
+		self._lock = threading.Lock()
+		self._listeners: list[Callable[[int, str, float], None]] = []
+		self.requests: dict[str, int] = {}
+
+		self.sio = socketio.Server(async_mode='threading')
+		self._push = make_server(host, 0, socketio.WSGIApp(self.sio), server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+		self.push_url = f'http://{host}:{self._push.server_port}'
+
+	def start(self) -> None:
+		super().start()
+		threading.Thread(name='Thread-FakeHermine-push', target=self._push.serve_forever, daemon=True).start()
+
+	def stop(self) -> None:
+		super().stop()
+		self._push.shutdown()
+		self._push.server_close()
+
+	def on_message(self, callback: Callable[[int, str, float], None]) -> None:
+		self._listeners.append(callback)
+
+	def post_message(self, channel_id: int, text: str, *, sender: dict|None = None) -> dict:
+		"""Store a message as if another user had sent it and push a `message_sync` event for it."""
+		iv = Crypto.Random.get_random_bytes(16)
+		sender = sender or {'id': 2, 'first_name': 'Bench', 'last_name': 'User'}
+		message = self._store(channel_id, _encrypt_aes(text.encode('utf-8'), self._channel_key(channel_id), iv).hex(), iv.hex(), None, sender)
+		self.sio.emit('message_sync', {
+			'id': message['id'],
+			'kind': 'message',
+			'type': 'text',
+			'text': message['text'],
+			'channel_id': channel_id,
+			'sender': sender,
+			'channel': {'id': channel_id, 'name': f'channel-{channel_id}'},
+		})
+		return message
+
+	def handle(self, request: Request) -> Response:
+		endpoint = request.path.lstrip('/')
+		with self._lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+		handler = getattr(self, '_' + endpoint.replace('/', '_'), None)
+		if handler is None:
+			return Response.json({'status': {'value': 'ERROR', 'message': f'unknown endpoint {endpoint}'}, 'payload': {}})
+		return Response.json({'status': {'value': 'OK', 'message': ''}, 'payload': handler(request.form())})
+
+	def _auth_login(self, form):
+		return {'client_key': 'bench', 'userinfo': {'id': self.user_id, 'socket_id': 'bench'}}
+
+	def _auth_check(self, form):
+		return {}
+
+	def _security_get_private_key(self, form):
+		private = self._key.export_key(passphrase=ENCRYPTION_PASSWORD, pkcs=8, protection='PBKDF2WithHMAC-SHA1AndAES128-CBC').decode('utf-8')
+		return {'keys': {'private_key': json.dumps({'private': private})}}
+
+	def _channels_info(self, form):
+		channel_id = int(form['channel_id'])
+		return {'channels': {'id': channel_id, 'key': self._wrapped_key(channel_id)}}
+
+	def _channels_create(self, form):
+		channel_id = next(self._ids)
+		self._channel_key(channel_id)
+		return {'channel': {'id': channel_id, 'name': form['channel_name'], 'key': self._wrapped_key(channel_id)}}
+
+	def _channels_createInvite(self, form):
+		return {}
+
+	def _company_member(self, form):
+		return {'companies': [{'id': 1, 'name': 'Bench'}]}
+
+	def _channels_subscripted(self, form):
+		return {'channels': [{'id': channel_id, 'name': f'channel-{channel_id}'} for channel_id in self._channel_keys]}
+
+	def _channels_members(self, form):
+		return {'members': []}
+
+	def _message_send(self, form):
+		channel_id = int(form['channel_id'])
+		received = time.perf_counter()
+		message = self._store(channel_id, form['text'], form['iv'], None)
+
+		text = AESBatchCodec(self._channel_key(channel_id)).decrypt_many([(form['text'], form['iv'])])[0].decode('utf-8')
+		for listener in self._listeners:
+			listener(channel_id, text, received)
+		return {'message': message}
+
+	def _message_content(self, form):
+		channel_id = int(form['channel_id'])
+		limit, offset = int(form['limit']), int(form['offset'])
+		with self._lock:
+			messages = self._messages.get(channel_id, [])
+			page = messages[max(0, len(messages) - offset - limit):len(messages) - offset]
+		return {'messages': list(reversed(page))}
+
+	def _store(self, channel_id: int, text: str, iv: str, location: dict|None, sender: dict|None = None) -> dict:
+		message = {
+			'id': next(self._ids),
+			'kind': 'message',
+			'type': 'text',
+			'encrypted': True,
+			'text': text,
+			'iv': iv,
+			'location': location,
+			'channel_id': channel_id,
+			'sender': sender or {'id': 1, 'first_name': 'Bench', 'last_name': 'Bot'},
+			'time': int(time.time()),
+		}
+		with self._lock:
+			self._messages.setdefault(channel_id, []).append(message)
+		return message
+
+	def _channel_key(self, channel_id: int) -> bytes:
+		with self._lock:
+			return self._channel_keys.setdefault(channel_id, Crypto.Random.get_random_bytes(32))
+
+	def _wrapped_key(self, channel_id: int) -> str:
+		encryptor = Crypto.Cipher.PKCS1_OAEP.new(self._key.publickey())
+		return base64.b64encode(encryptor.encrypt(self._channel_key(channel_id))).decode('utf-8')
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+	def log_message(self, format, *args):
+		pass
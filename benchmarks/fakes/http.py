@@ -0,0 +1,79 @@
+from typing import Any
+
+import json
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Request:
+	def __init__(self, method: str, path: str, query: dict[str, list[str]], headers, body: bytes):
+		self.method = method
+		self.path = path
+		self.query = query
+		self.headers = headers
+		self.body = body
+
+	def form(self) -> dict[str, str]:
+		return {key: values[-1] for key, values in parse_qs(self.body.decode('utf-8'), keep_blank_values=True).items()}
+
+	def param(self, name: str, default: str|None = None) -> str|None:
+		values = self.query.get(name)
+		return values[-1] if values else default
+
+
+class Response:
+	def __init__(self, status: int = 200, body: bytes|str = b'', headers: dict[str, str]|None = None):
+		self.status = status
+		self.body = body.encode('utf-8') if isinstance(body, str) else body
+		self.headers = headers or {}
+
+	@classmethod
+	def json(cls, data: Any, status: int = 200) -> 'Response':
+		return cls(status, json.dumps(data), {'Content-Type': 'application/json'})
+
+
+class FakeHTTPServer:
+	"""Threaded local HTTP server dispatching every request to `handle()`."""
+
+	def __init__(self, host: str = '127.0.0.1', port: int = 0):
+		fake = self
+
+		class _Handler(BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def _dispatch(self):
+				url = urlsplit(self.path)
+				length = int(self.headers.get('Content-Length') or 0)
+				request = Request(self.command, url.path, parse_qs(url.query, keep_blank_values=True), self.headers, self.rfile.read(length))
+
+				try:
+					response = fake.handle(request)
+				except Exception as e:
+					response = Response(500, f'{type(e).__name__}: {e}')
+
+				self.send_response(response.status)
+				for name, value in response.headers.items():
+					self.send_header(name, value)
+				self.send_header('Content-Length', str(len(response.body)))
+				self.end_headers()
+				self.wfile.write(response.body)
+
+			do_GET = do_POST = do_PUT = do_DELETE = do_OPTIONS = do_PROPFIND = do_REPORT = _dispatch
+
+			def log_message(self, format, *args):
+				pass
+
+		self._server = ThreadingHTTPServer((host, port), _Handler)
+		self._server.daemon_threads = True
+		self.url = f'http://{host}:{self._server.server_port}'
+
+	def start(self) -> None:
+		threading.Thread(name=f'Thread-{type(self).__name__}', target=self._server.serve_forever, daemon=True).start()
+
+	def stop(self) -> None:
+		self._server.shutdown()
+		self._server.server_close()
+
+	def handle(self, request: Request) -> Response:
+		raise NotImplementedError
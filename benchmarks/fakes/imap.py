@@ -0,0 +1,177 @@
+import re
+import socket
+import threading
+
+
+class FakeIMAPServer:
+	"""
+	Plain-text IMAP4rev1 server with a single in-memory folder, supporting the commands used by `imap_tools`:
+	CAPABILITY, LOGIN, SELECT, UID SEARCH/FETCH/STORE, IDLE, NOOP, EXPUNGE and LOGOUT.
+	"""
+
+	def __init__(self, host: str = '127.0.0.1', port: int = 0, *, idle_limit: float|None = None):
+		self._sock = socket.create_server((host, port))
+		self.host = host
+		self.port = self._sock.getsockname()[1]
+
+		self._lock = threading.Lock()
+		self._messages: list[dict] = []
+		self._idling: set['_Session'] = set()
+		self._running = False
+		self.logins = 0
+		# like servers that limit IDLE, say BYE and close connections that idle longer than this
+		self.idle_limit = idle_limit
+
+	def start(self) -> None:
+		self._running = True
+		threading.Thread(name='Thread-FakeIMAPServer', target=self._accept, daemon=True).start()
+
+	def stop(self) -> None:
+		self._running = False
+		self._sock.close()
+
+	def append(self, raw: bytes) -> int:
+		"""Add a new, unseen message and notify idling sessions, returning its UID."""
+		with self._lock:
+			uid = len(self._messages) + 1
+			self._messages.append({'uid': uid, 'flags': set(), 'raw': raw})
+			exists = len(self._messages)
+			sessions = list(self._idling)
+			for session in sessions:
+				session.exists = exists
+		for session in sessions:
+			session.send(f'* {exists} EXISTS')
+		return uid
+
+	def _accept(self) -> None:
+		while self._running:
+			try:
+				conn, _ = self._sock.accept()
+			except OSError:
+				return
+			threading.Thread(name='Thread-FakeIMAPServer-client', target=_Session(self, conn).serve, daemon=True).start()
+
+
+class _Session:
+	def __init__(self, server: FakeIMAPServer, conn: socket.socket):
+		self.server = server
+		self.conn = conn
+		self._send_lock = threading.Lock()
+		# the message count last reported to the client
+		self.exists = 0
+
+	def send(self, line: str|bytes) -> None:
+		data = line.encode('utf-8') if isinstance(line, str) else line
+		with self._send_lock:
+			try:
+				self.conn.sendall(data + b'\r\n')
+			except OSError:
+				pass
+
+	def serve(self) -> None:
+		server = self.server
+		try:
+			with self.conn, self.conn.makefile('rb') as stream:
+				self.send('* OK [CAPABILITY IMAP4rev1 IDLE] fake server ready')
+				while True:
+					line = stream.readline()
+					if not line:
+						return
+					tag, _, rest = line.decode('utf-8').rstrip('\r\n').partition(' ')
+					command, _, args = rest.partition(' ')
+					command = command.upper()
+
+					if command == 'UID':
+						command, _, args = args.partition(' ')
+						self._uid(tag, command.upper(), args)
+					elif command == 'CAPABILITY':
+						self.send('* CAPABILITY IMAP4rev1 IDLE')
+						self.send(f'{tag} OK CAPABILITY completed')
+					elif command == 'LOGIN':
+						server.logins += 1
+						self.send(f'{tag} OK LOGIN completed')
+					elif command in ('SELECT', 'EXAMINE'):
+						with server._lock:
+							exists = self.exists = len(server._messages)
+						self.send(f'* {exists} EXISTS')
+						self.send('* 0 RECENT')
+						self.send('* OK [UIDVALIDITY 1] UIDs valid')
+						self.send(f'{tag} OK [READ-WRITE] {command} completed')
+					elif command == 'IDLE':
+						with server._lock:
+							server._idling.add(self)
+							exists = len(server._messages)
+							unreported = exists > self.exists
+							self.exists = exists
+						self.send('+ idling')
+						# like real servers, report messages that arrived since the last update right away
+						if unreported:
+							self.send(f'* {exists} EXISTS')
+						self.conn.settimeout(server.idle_limit)
+						try:
+							stream.readline()  # DONE
+						except TimeoutError:
+							self.send('* BYE idle for too long')
+							return
+						self.conn.settimeout(None)
+						with server._lock:
+							server._idling.discard(self)
+						self.send(f'{tag} OK IDLE terminated')
+					elif command in ('NOOP', 'EXPUNGE', 'CHECK'):
+						self.send(f'{tag} OK {command} completed')
+					elif command == 'LOGOUT':
+						self.send('* BYE logging out')
+						self.send(f'{tag} OK LOGOUT completed')
+						return
+					else:
+						self.send(f'{tag} BAD unsupported command {command}')
+		except OSError:
+			pass
+		finally:
+			with server._lock:
+				server._idling.discard(self)
+
+	def _uid(self, tag: str, command: str, args: str) -> None:
+		server = self.server
+		with server._lock:
+			messages = list(enumerate(server._messages, start=1))
+
+		if command == 'SEARCH':
+			uid_set = re.search(r'\bUID ([\d,:]+)', args, re.IGNORECASE)
+			wanted = _parse_uids(uid_set.group(1)) if uid_set is not None else None
+			uids = [
+				str(message['uid']) for _, message in messages
+				if ('UNSEEN' not in args.upper() or '\\Seen' not in message['flags']) and (wanted is None or message['uid'] in wanted)
+			]
+			self.send(f'* SEARCH {" ".join(uids)}'.rstrip())
+			self.send(f'{tag} OK SEARCH completed')
+		elif command == 'FETCH':
+			uids = _parse_uids(args.split(' ', 1)[0])
+			for seq, message in messages:
+				if message['uid'] in uids:
+					flags = ' '.join(sorted(message['flags']))
+					self.send(f'* {seq} FETCH (UID {message["uid"]} RFC822.SIZE {len(message["raw"])} FLAGS ({flags}) BODY[] {{{len(message["raw"])}}}'.encode('utf-8') + b'\r\n' + message['raw'] + b')')
+			self.send(f'{tag} OK FETCH completed')
+		elif command == 'STORE':
+			uid_set, mode, flags = args.split(' ', 2)
+			uids = _parse_uids(uid_set)
+			flags = set(re.findall(r'\\?\w+', flags))
+			with server._lock:
+				for seq, message in messages:
+					if message['uid'] in uids:
+						if mode.startswith('-'):
+							message['flags'] -= flags
+						else:
+							message['flags'] |= flags
+						self.send(f'* {seq} FETCH (UID {message["uid"]} FLAGS ({" ".join(sorted(message["flags"]))}))')
+			self.send(f'{tag} OK STORE completed')
+		else:
+			self.send(f'{tag} BAD unsupported UID command {command}')
+
+
+def _parse_uids(uid_set: str) -> set[int]:
+	uids = set()
+	for part in uid_set.split(','):
+		start, _, end = part.partition(':')
+		uids.update(range(int(start), int(end or start) + 1))
+	return uids
@@ -0,0 +1,164 @@
+import socket
+import struct
+import threading
+
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+class FakeMQTTBroker:
+	"""
+	In-process MQTT 3.1.1 broker supporting just enough for the benchmarks:
+	CONNECT, SUBSCRIBE/UNSUBSCRIBE with wildcards, PUBLISH (delivered with QoS 0, optionally retained), PINGREQ and
+	DISCONNECT.
+	"""
+
+	def __init__(self, host: str = '127.0.0.1', port: int = 0):
+		self._sock = socket.create_server((host, port))
+		self.host = host
+		self.port = self._sock.getsockname()[1]
+
+		self._lock = threading.Lock()
+		self._subscriptions: dict[socket.socket, set[str]] = {}
+		self._send_locks: dict[socket.socket, threading.Lock] = {}
+		self._retained: dict[str, bytes] = {}
+		self._running = False
+
+	def start(self) -> None:
+		self._running = True
+		threading.Thread(name='Thread-FakeMQTTBroker', target=self._accept, daemon=True).start()
+
+	def stop(self) -> None:
+		self._running = False
+		self._sock.close()
+		with self._lock:
+			for conn in self._subscriptions:
+				conn.close()
+
+	def publish(self, topic: str, payload: bytes, *, retain: bool = False) -> int:
+		"""Deliver a message to all matching subscribers, returning the number of receivers."""
+		packet = _publish_packet(topic, payload)
+
+		with self._lock:
+			if retain and payload:
+				self._retained[topic] = payload
+			elif retain:
+				self._retained.pop(topic, None)
+			receivers = [
+				conn for conn, filters in self._subscriptions.items()
+				if any(_topic_matches(f, topic) for f in filters)
+			]
+		for conn in receivers:
+			self._send(conn, packet)
+		return len(receivers)
+
+	def _accept(self) -> None:
+		while self._running:
+			try:
+				conn, _ = self._sock.accept()
+			except OSError:
+				return
+			conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			with self._lock:
+				self._subscriptions[conn] = set()
+				self._send_locks[conn] = threading.Lock()
+			threading.Thread(name='Thread-FakeMQTTBroker-client', target=self._serve, args=(conn,), daemon=True).start()
+
+	def _serve(self, conn: socket.socket) -> None:
+		try:
+			with conn, conn.makefile('rb') as stream:
+				while True:
+					header = stream.read(1)
+					if not header:
+						return
+					packet_type, flags = header[0] >> 4, header[0] & 0x0F
+					body = stream.read(_read_length(stream))
+
+					if packet_type == CONNECT:
+						self._send(conn, _packet(CONNACK << 4, b'\x00\x00'))
+					elif packet_type == SUBSCRIBE:
+						packet_id, filters = body[:2], _read_strings(body[2:], with_options=True)
+						with self._lock:
+							self._subscriptions[conn].update(filters)
+							retained = [(topic, payload) for topic, payload in self._retained.items() if any(_topic_matches(f, topic) for f in filters)]
+						self._send(conn, _packet(SUBACK << 4, packet_id + b'\x00' * len(filters)))
+						for topic, payload in retained:
+							self._send(conn, _publish_packet(topic, payload, retain=True))
+					elif packet_type == UNSUBSCRIBE:
+						packet_id, filters = body[:2], _read_strings(body[2:], with_options=False)
+						with self._lock:
+							self._subscriptions[conn].difference_update(filters)
+						self._send(conn, _packet(UNSUBACK << 4, packet_id))
+					elif packet_type == PUBLISH:
+						(length,) = struct.unpack('!H', body[:2])
+						topic = body[2:2 + length].decode('utf-8')
+						offset = 2 + length
+						if (flags >> 1) & 0x03:
+							self._send(conn, _packet(PUBACK << 4, body[offset:offset + 2]))
+							offset += 2
+						self.publish(topic, body[offset:], retain=bool(flags & 0x01))
+					elif packet_type == PINGREQ:
+						self._send(conn, _packet(PINGRESP << 4, b''))
+					elif packet_type == DISCONNECT:
+						return
+		except OSError:
+			pass
+		finally:
+			with self._lock:
+				self._subscriptions.pop(conn, None)
+				self._send_locks.pop(conn, None)
+
+	def _send(self, conn: socket.socket, packet: bytes) -> None:
+		lock = self._send_locks.get(conn)
+		if lock is None:
+			return
+		try:
+			with lock:
+				conn.sendall(packet)
+		except OSError:
+			pass
+
+
+def _publish_packet(topic: str, payload: bytes, *, retain: bool = False) -> bytes:
+	encoded = topic.encode('utf-8')
+	return _packet(PUBLISH << 4 | int(retain), struct.pack('!H', len(encoded)) + encoded + payload)
+
+def _packet(header: int, body: bytes) -> bytes:
+	length = len(body)
+	encoded = bytearray()
+	while True:
+		byte, length = length % 128, length // 128
+		encoded.append(byte | (0x80 if length > 0 else 0))
+		if length == 0:
+			break
+	return bytes([header]) + bytes(encoded) + body
+
+def _read_length(stream) -> int:
+	length, multiplier = 0, 1
+	while True:
+		byte = stream.read(1)[0]
+		length += (byte & 0x7F) * multiplier
+		if byte & 0x80 == 0:
+			return length
+		multiplier *= 128
+
+def _read_strings(data: bytes, *, with_options: bool) -> list[str]:
+	strings = []
+	offset = 0
+	while offset < len(data):
+		(length,) = struct.unpack('!H', data[offset:offset + 2])
+		strings.append(data[offset + 2:offset + 2 + length].decode('utf-8'))
+		offset += 2 + length + (1 if with_options else 0)
+	return strings
+
+def _topic_matches(topic_filter: str, topic: str) -> bool:
+	filter_levels = topic_filter.split('/')
+	topic_levels = topic.split('/')
+	for i, level in enumerate(filter_levels):
+		if level == '#':
+			return True
+		if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+			return False
+	return len(filter_levels) == len(topic_levels)
@@ -0,0 +1,175 @@
+from typing import Any
+from collections.abc import Callable
+
+import os
+import re
+import time
+import toml
+import resource
+import tempfile
+import threading
+
+from config import Config
+from modules.module import Module
+from modules.registry import create_module
+from modules.mail import get_mail_service
+from lib.hermine import StashCatClient
+from lib.groupalarm import GroupalarmClient
+
+from .fakes import FakeMQTTBroker, FakeHermine, FakeGroupalarm, FakeIMAPServer, FakeCalDAV
+from .fakes.hermine import ENCRYPTION_PASSWORD
+
+
+HERMINE_CHANNEL = 1000
+MARKER = re.compile(r'bench #(\d+)')
+
+
+class Environment:
+	"""Starts all local stand-ins and points the clients at them."""
+
+	def __init__(self, **groupalarm_options):
+		self.broker = FakeMQTTBroker()
+		self.hermine = FakeHermine()
+		self.groupalarm = FakeGroupalarm(**groupalarm_options)
+		self.imap = FakeIMAPServer()
+		self.caldav = FakeCalDAV()
+
+		self._tmpdir = tempfile.TemporaryDirectory(prefix='bench-')
+
+	def __enter__(self) -> 'Environment':
+		for fake in (self.broker, self.hermine, self.groupalarm, self.imap, self.caldav):
+			fake.start()
+
+		StashCatClient.base_url = self.hermine.url
+		StashCatClient.push_url = self.hermine.push_url
+		GroupalarmClient.base_url = f'{self.groupalarm.url}/api/v1'
+
+		threading.Thread(name='Thread-bench-mail', target=get_mail_service().run, daemon=True).start()
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		get_mail_service().stop()
+		for fake in (self.broker, self.hermine, self.groupalarm, self.imap, self.caldav):
+			fake.stop()
+		self._tmpdir.cleanup()
+
+	def path(self, name: str) -> str:
+		"""A path in the temporary directory of the environment."""
+		return os.path.join(self._tmpdir.name, name)
+
+	def config(self, modules: dict[str, Any]) -> Config:
+		data = {
+			'hermine': {
+				'username': 'bench',
+				'password': 'bench',
+				'encryption_password': ENCRYPTION_PASSWORD,
+				# the stand-in does not throttle, so neither should the dispatcher
+				'send_rate': 10000.0,
+				'send_burst': 10000,
+				'target_send_rate': 10000.0,
+				'target_send_burst': 10000,
+			},
+			'groupalarm': {'api_key': 'bench'},
+			'mqtt': {'host': self.broker.host, 'port': self.broker.port, 'username': 'bench', 'password': 'bench', 'client_id': 'bench'},
+			'imap': {'host': self.imap.host, 'port': self.imap.port, 'use_ssl': False, 'username': 'bench', 'password': 'bench', 'idle_timeout': 5},
+			'caldav': {'url': self.caldav.url, 'username': 'bench', 'password': 'bench'},
+			'modules': modules,
+		}
+
+		path = self.path('config.toml')
+		with open(path, 'w') as f:
+			toml.dump(data, f)
+		return Config(path)
+
+	def module(self, name: str, config: Config) -> Any:
+		module, cfg = create_module(name, config.module_type(name))
+		cfg.load(config.module_data(name), config)
+		module.update_config(cfg)
+		return module
+
+	def start(self, module: Module) -> threading.Thread:
+		thread = threading.Thread(name=f'Thread-bench-{module.name}', target=module.run, daemon=True)
+		thread.start()
+		return thread
+
+	def track_hermine(self, recorder: 'Recorder') -> None:
+		"""Complete the operation whose marker appears in a message sent to Hermine."""
+		def _(channel_id: int, text: str, received: float):
+			for match in MARKER.finditer(text):
+				recorder.complete(int(match.group(1)), received)
+		self.hermine.on_message(_)
+
+
+class Recorder:
+	"""Collects start and completion times of numbered operations."""
+
+	def __init__(self, count: int):
+		self.count = count
+		self.started: dict[int, float] = {}
+		self.completed: dict[int, float] = {}
+		self._done = threading.Event()
+		self._lock = threading.Lock()
+
+	def start(self, n: int, at: float|None = None) -> None:
+		with self._lock:
+			self.started[n] = at if at is not None else time.perf_counter()
+
+	def complete(self, n: int, at: float|None = None) -> None:
+		with self._lock:
+			if n in self.completed:
+				return
+			self.completed[n] = at if at is not None else time.perf_counter()
+			if len(self.completed) >= self.count:
+				self._done.set()
+
+	def wait(self, timeout: float) -> bool:
+		return self._done.wait(timeout)
+
+	def latencies(self) -> list[float]:
+		with self._lock:
+			return sorted(self.completed[n] - self.started[n] for n in self.completed if n in self.started)
+
+
+def drive(rate: float, count: int, action: Callable[[int], None], recorder: Recorder) -> None:
+	"""Call `action` `count` times at a fixed `rate` per second (as fast as possible if `rate` is 0)."""
+	start = time.perf_counter()
+	for n in range(count):
+		if rate > 0:
+			delay = start + n / rate - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+		recorder.start(n)
+		action(n)
+
+
+def report(name: str, recorder: Recorder, elapsed: float, options: dict[str, Any]) -> dict[str, Any]:
+	latencies = recorder.latencies()
+	return {
+		'scenario': name,
+		'options': options,
+		'operations': recorder.count,
+		'completed': len(latencies),
+		'elapsed_s': elapsed,
+		'throughput_per_s': len(latencies) / elapsed if elapsed > 0 else 0.0,
+		'latency_p50_ms': _percentile(latencies, 0.50) * 1000,
+		'latency_p99_ms': _percentile(latencies, 0.99) * 1000,
+		'latency_max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+		'rss_mb': rss_bytes() / 2**20,
+	}
+
+def rss_bytes() -> int:
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmRSS:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	# peak instead of current RSS where /proc is not available (in bytes on macOS, in KiB elsewhere)
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+def _percentile(values: list[float], q: float) -> float:
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(q * len(values)))]
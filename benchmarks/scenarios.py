@@ -0,0 +1,169 @@
+from typing import Any
+
+import json
+import time
+import uuid
+import random
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+
+from modules.geodata import Place, build_index
+
+from .harness import Environment, Recorder, HERMINE_CHANNEL, drive, report
+
+
+SCENARIOS = {}
+
+def scenario(name: str):
+	def decorator(func):
+		SCENARIOS[name] = func
+		return func
+	return decorator
+
+
+@scenario('alarmierung')
+def alarmierung(env: Environment, *, rate: float, count: int, timeout: float) -> dict[str, Any]:
+	"""MQTT alarm → filter → geodata lookup → format → encrypt → Hermine `message/send` → archive."""
+	build_index(_places(50000), env.path('places.geo'))
+	config = env.config({'alarmierung': {
+		'topic': 'bench/alarm',
+		'hermine_channel': HERMINE_CHANNEL,
+		'archive': env.path('alarms.log'),
+		'geodata': env.path('places.geo'),
+		'unterkunft': {'latitude': 52.5, 'longitude': 13.35},
+	}})
+	module = env.module('alarmierung', config)
+
+	recorder = Recorder(count)
+	env.track_hermine(recorder)
+	env.start(module)
+	_wait_for(module.mqtt.is_connected)
+	time.sleep(0.2)
+
+	def _(n: int):
+		env.broker.publish('bench/alarm', json.dumps(_alarm(n)).encode('utf-8'))
+
+	start = time.perf_counter()
+	drive(rate, count, _, recorder)
+	recorder.wait(timeout)
+	module.mqtt.disconnect()
+	return report('alarmierung', recorder, time.perf_counter() - start, {'rate': rate, 'count': count, 'archived': len(module.archive)})
+
+@scenario('user_interface')
+def user_interface(env: Environment, *, rate: float, count: int, timeout: float) -> dict[str, Any]:
+	"""socket.io `message_sync` → message fetch and decryption → command dispatch → reply to Hermine."""
+	config = env.config({'user_interface': {'hermine_channel': HERMINE_CHANNEL}})
+	module = env.module('user_interface', config)
+
+	recorder = Recorder(count)
+	env.track_hermine(recorder)
+	env.start(module)
+	_wait_for(lambda: env.hermine.sio.manager.rooms.get('/'))
+	time.sleep(0.2)
+
+	start = time.perf_counter()
+	drive(rate, count, lambda n: env.hermine.post_message(HERMINE_CHANNEL, f'!ping bench #{n}'), recorder)
+	recorder.wait(timeout)
+	return report('user_interface', recorder, time.perf_counter() - start, {'rate': rate, 'count': count})
+
+@scenario('ausbildungsdienst')
+def ausbildungsdienst(env: Environment, *, rate: float, count: int, timeout: float) -> dict[str, Any]:
+	"""Weekly run: users, label and appointments from Groupalarm → participant lists → Hermine."""
+	config = env.config({'ausbildungsdienst': {'hermine_channel': HERMINE_CHANNEL, 'groupalarm_label': env.groupalarm.label_id}})
+	module = env.module('ausbildungsdienst', config)
+
+	recorder = Recorder(count)
+	def _(n: int):
+		module._weekly_run()
+		recorder.complete(n)
+
+	start = time.perf_counter()
+	drive(rate, count, _, recorder)
+	return report('ausbildungsdienst', recorder, time.perf_counter() - start, {
+		'rate': rate,
+		'count': count,
+		'appointments': len(env.groupalarm.appointments),
+		'users': len(env.groupalarm.users),
+	})
+
+@scenario('beflaggung')
+def beflaggung(env: Environment, *, rate: float, count: int, timeout: float) -> dict[str, Any]:
+	"""New mail via IMAP IDLE → ICS download and parsing → Hermine and CalDAV."""
+	config = env.config({'beflaggung': {
+		'hermine_channel': HERMINE_CHANNEL,
+		'calendar': 'bench',
+		'filter_from': ['beflaggung@example.org'],
+		'location': {'latitude': 52.52, 'longitude': 13.40},
+	}})
+	module = env.module('beflaggung', config)
+
+	recorder = Recorder(count)
+	env.track_hermine(recorder)
+	env.start(module)
+	_wait_for(lambda: env.imap.logins > 0)
+	time.sleep(0.5)
+
+	def _(n: int):
+		url = env.caldav.add_feed(f'{n}', _ics(n))
+		env.imap.append(_mail(n, url))
+
+	start = time.perf_counter()
+	drive(rate, count, _, recorder)
+	recorder.wait(timeout)
+	return report('beflaggung', recorder, time.perf_counter() - start, {'rate': rate, 'count': count})
+
+
+def _alarm(n: int) -> dict:
+	location = {'latitude': str(52.4 + n % 97 * 0.002), 'longitude': str(13.3 + n % 89 * 0.002)}
+	# every other alarm has no address, so the nearest place is looked up
+	if n % 2 == 0:
+		location['address'] = 'Musterstraße 1'
+	return {
+		'message': f'Einsatz bench #{n}',
+		'event': {
+			'name': 'Benchmark',
+			'startDate': datetime.now(timezone.utc).isoformat(),
+			'severity': {'icon': '🔥', 'name': 'Hoch'},
+		},
+		'optionalContent': location,
+		'alarmResources': {'units': [], 'labels': []},
+	}
+
+def _places(count: int) -> list[Place]:
+	rng = random.Random(0)
+	return [Place(52.3 + rng.random() * 0.4, 13.1 + rng.random() * 0.5, f'Musterstraße {i}', f'Gemeinde {i % 40}') for i in range(count)]
+
+def _ics(n: int) -> str:
+	start = datetime.now(timezone.utc) + timedelta(days=1)
+	return '\r\n'.join([
+		'BEGIN:VCALENDAR',
+		'VERSION:2.0',
+		'PRODID:-//bench//EN',
+		'BEGIN:VEVENT',
+		f'UID:{uuid.uuid4()}',
+		f'DTSTAMP:{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}',
+		f'DTSTART;VALUE=DATE:{start:%Y%m%d}',
+		f'DTEND;VALUE=DATE:{start + timedelta(days=1):%Y%m%d}',
+		f'SUMMARY:Beflaggung bench #{n}',
+		'DESCRIPTION:Benchmark',
+		'END:VEVENT',
+		'END:VCALENDAR',
+		'',
+	])
+
+def _mail(n: int, ics_url: str) -> bytes:
+	msg = EmailMessage()
+	msg['From'] = 'beflaggung@example.org'
+	msg['To'] = 'bench@example.org'
+	msg['Subject'] = f'Beflaggung bench #{n}'
+	msg['Date'] = datetime.now(timezone.utc).strftime('%a, %d %b %Y %H:%M:%S +0000')
+	msg.set_content('Beflaggung')
+	msg.add_alternative(f'<p><a href="{ics_url}?view=renderBMIWebICS">ICS</a></p>', subtype='html')
+	return msg.as_bytes()
+
+def _wait_for(condition, timeout: float = 10.0) -> None:
+	deadline = time.monotonic() + timeout
+	while not condition():
+		if time.monotonic() > deadline:
+			raise TimeoutError('Timed out waiting for the module to connect')
+		time.sleep(0.05)
@@ -7,5 +7,10 @@ from .hermine import *
 from .groupalarm import *
 from .mqtt import *
 from .caldav import *
+from .scheduler import *
+from .templates import *
+from .metrics import *
+from .tracing import *
+from .coordination import *
 
 from .watcher import *
@@ -8,6 +8,11 @@ from .hermine import HermineConfig
 from .groupalarm import GroupalarmConfig
 from .mqtt import MQTTConfig
 from .caldav import CalDAVConfig
+from .scheduler import SchedulerConfig
+from .templates import TemplatesConfig
+from .metrics import MetricsConfig
+from .tracing import TracingConfig
+from .coordination import CoordinationConfig
 
 
 def load_toml_data[T: IConfig](data: TOMLDict|None, cfg: type[T]|T) -> T:
@@ -30,6 +35,11 @@ class Config:
 	groupalarm: GroupalarmConfig
 	mqtt: MQTTConfig
 	caldav: CalDAVConfig
+	scheduler: SchedulerConfig
+	templates: TemplatesConfig
+	metrics: MetricsConfig
+	tracing: TracingConfig
+	coordination: CoordinationConfig
 
 	def __init__(self, fp):
 		self._data = toml.load(fp)
@@ -40,10 +50,25 @@ class Config:
 		self.groupalarm = load_toml_data(self._data.get('groupalarm'), GroupalarmConfig)
 		self.mqtt = load_toml_data(self._data.get('mqtt'), MQTTConfig)
 		self.caldav = load_toml_data(self._data.get('caldav'), CalDAVConfig)
+		self.scheduler = load_toml_data(self._data.get('scheduler'), SchedulerConfig)
+		self.templates = load_toml_data(self._data.get('templates'), TemplatesConfig)
+		self.metrics = load_toml_data(self._data.get('metrics'), MetricsConfig)
+		self.tracing = load_toml_data(self._data.get('tracing'), TracingConfig)
+		self.coordination = load_toml_data(self._data.get('coordination'), CoordinationConfig)
 
 	def _modules(self) -> TOMLDict:
 		return self._data.get('modules', {})
 
+	def module_names(self) -> list[str]:
+		return list(self._modules())
+
+	def module_type(self, name: str) -> str:
+		"""Type of the module configured in `[modules.<name>]`, given by its `module` key and defaulting to the name."""
+		type_name = self.module_data(name).get('module', name)
+		if not isinstance(type_name, str):
+			raise TypeError(f'Type of module "{name}" must be a string, got {type_name!r}')
+		return type_name
+
 	def module_data(self, name: str) -> TOMLDict:
 		return self._modules().get(name, {})
 	
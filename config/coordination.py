@@ -0,0 +1,28 @@
+from .interface import IConfig, TOMLDict
+
+
+BACKENDS = ('file', 'sqlite', 'mqtt')
+
+
+class CoordinationConfig(IConfig):
+	backend: str|None
+	path: str|None
+	replica_id: str|None
+	topic: str
+	lease_time: float
+	heartbeat_interval: float
+
+	def from_toml(self, data: TOMLDict) -> None:
+		self.set_value('backend', data, default=None)
+		self.set_value('path', data, default=None)
+		self.set_value('replica_id', data, default=None)
+		self.set_value('topic', data, default='automatisierung/coordination')
+		self.set_value('lease_time', data, default=15.0, converter=float)
+		self.set_value('heartbeat_interval', data, default=5.0, converter=float)
+
+		if self.backend is not None and self.backend not in BACKENDS:
+			raise ValueError(f'Unknown coordination backend "{self.backend}", expected one of {", ".join(BACKENDS)}')
+		if self.backend in ('file', 'sqlite') and self.path is None:
+			raise ValueError(f'The "{self.backend}" coordination backend requires a path')
+		if self.heartbeat_interval >= self.lease_time:
+			raise ValueError('The heartbeat interval must be shorter than the lease time')
@@ -7,8 +7,35 @@ class HermineConfig(IConfig):
 	encryption_password: str
 	device_id: str
 
+	send_rate: float
+	send_burst: int
+	target_send_rate: float
+	target_send_burst: int
+	send_retries: int
+
+	push_reconnect_delay: float
+	push_max_reconnect_delay: float
+	push_heartbeat_interval: float
+	push_catch_up_limit: int
+
+	directory_refresh_interval: float
+
 	def from_toml(self, data: TOMLDict) -> None:
 		self.set_value('username', data, default=None)
 		self.set_value('password', data, default=None)
 		self.set_value('encryption_password', data, default=None)
 		self.set_value('device_id', data, default='automation')
+
+		self.set_value('send_rate', data, default=5.0, converter=float)
+		self.set_value('send_burst', data, default=10)
+		self.set_value('target_send_rate', data, default=1.0, converter=float)
+		self.set_value('target_send_burst', data, default=5)
+		self.set_value('send_retries', data, default=5)
+
+		self.set_value('push_reconnect_delay', data, default=1.0, converter=float)
+		self.set_value('push_max_reconnect_delay', data, default=60.0, converter=float)
+		self.set_value('push_heartbeat_interval', data, default=30.0, converter=float)
+		self.set_value('push_catch_up_limit', data, default=200)
+
+		# companies, channels and their members are fetched again this often
+		self.set_value('directory_refresh_interval', data, default=300.0, converter=float)
@@ -4,13 +4,29 @@ from .interface import IConfig, TOMLDict
 class IMAPConfig(IConfig):
 	host: str
 	port: int
+	use_ssl: bool
 	username: str
 	password: str
 	folder: str
 
+	idle_timeout: int
+	reconnect_delay: float
+	max_reconnect_delay: float
+
 	def from_toml(self, data: TOMLDict):
 		self.set_value('host', data, default=None)
 		self.set_value('port', data, default=993)
+		self.set_value('use_ssl', data, default=True)
 		self.set_value('username', data, default=None)
 		self.set_value('password', data, default=None)
 		self.set_value('folder', data, default='INBOX')
+
+		# the longest interval IDLE is renewed at, it is shortened if the server drops IDLE earlier
+		self.set_value('idle_timeout', data, default=3 * 60)
+		# failed connections are retried after an exponential backoff between these delays
+		self.set_value('reconnect_delay', data, default=5.0, converter=float)
+		self.set_value('max_reconnect_delay', data, default=10 * 60.0, converter=float)
+
+		# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+		if self.idle_timeout > 29 * 60:
+			raise ValueError('The IDLE timeout must not exceed 29 minutes')
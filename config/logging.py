@@ -3,8 +3,51 @@ import logging
 from .interface import IConfig, TOMLDict
 
 
+FORMATS = ('text', 'json')
+
+
+class LoggerConfig(IConfig):
+	level: int|None
+	sample: float
+	rate: float|None
+	burst: int
+
+	def from_toml(self, data: TOMLDict) -> None:
+		self.set_value('level', data, default=None, converter=logging.getLevelName)
+		# records below WARNING are kept with this probability and at most at this rate, errors always are
+		self.set_value('sample', data, default=1.0, converter=float)
+		self.set_value('rate', data, default=None, converter=float)
+		self.set_value('burst', data, default=10)
+
+		if not 0.0 <= self.sample <= 1.0:
+			raise ValueError('The sample rate of a logger must be between 0 and 1')
+
+
 class LoggingConfig(IConfig):
 	level: int
+	format: str
+	queue_size: int
+	redact: list[str]
+	max_payload_length: int
+	loggers: dict[str, LoggerConfig]
 
 	def from_toml(self, data: TOMLDict) -> None:
 		self.set_value('level', data, default=logging.INFO, converter=logging.getLevelName)
+		self.set_value('format', data, default='text')
+		self.set_value('queue_size', data, default=10000)
+		self.set_value('redact', data, default=['password', 'encryption_password', 'api_key', 'private_key'])
+		self.set_value('max_payload_length', data, default=200)
+
+		# per-logger tables, e.g. `[logging.loggers."modules.alarmierung"]`, also apply to the loggers below them
+		self.set_value('loggers', data, default={}, converter=self._conv_loggers)
+
+		if self.format not in FORMATS:
+			raise ValueError(f'Unknown log format "{self.format}", expected one of {", ".join(FORMATS)}')
+
+	def _conv_loggers(self, loggers: TOMLDict) -> dict[str, LoggerConfig]:
+		result = {}
+		for name, data in loggers.items():
+			cfg = LoggerConfig()
+			cfg.from_toml(data)
+			result[name] = cfg
+		return result
@@ -0,0 +1,10 @@
+from .interface import IConfig, TOMLDict
+
+
+class MetricsConfig(IConfig):
+	host: str
+	port: int|None
+
+	def from_toml(self, data: TOMLDict) -> None:
+		self.set_value('host', data, default='127.0.0.1')
+		self.set_value('port', data, default=None)
@@ -0,0 +1,12 @@
+from .interface import IConfig, TOMLDict
+
+
+class SchedulerConfig(IConfig):
+	timezone: str|None
+	state_file: str|None
+	workers: int
+
+	def from_toml(self, data: TOMLDict) -> None:
+		self.set_value('timezone', data, default=None)
+		self.set_value('state_file', data, default=None)
+		self.set_value('workers', data, default=4)
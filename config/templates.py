@@ -0,0 +1,16 @@
+from .interface import IConfig, TOMLDict
+
+
+class TemplatesConfig(IConfig):
+	max_length: int
+	overrides: dict[str, dict[str, str]]
+
+	def from_toml(self, data: TOMLDict) -> None:
+		self.set_value('max_length', data, default=4096)
+
+		# per-kind tables (e.g. `[templates.alarm]`) are merged into the inherited overrides part by part
+		overrides = {kind: dict(parts) for kind, parts in getattr(self, 'overrides', {}).items()}
+		for kind, parts in data.items():
+			if isinstance(parts, dict):
+				overrides.setdefault(kind, {}).update({part: str(source) for part, source in parts.items()})
+		self.overrides = overrides
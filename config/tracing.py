@@ -0,0 +1,11 @@
+from .interface import IConfig, TOMLDict
+
+
+class TracingConfig(IConfig):
+	file: str|None
+	queue_size: int
+
+	def from_toml(self, data: TOMLDict) -> None:
+		# spans are appended to this file as OTLP/JSON, tracing is disabled without it
+		self.set_value('file', data, default=None)
+		self.set_value('queue_size', data, default=10000)
@@ -0,0 +1,53 @@
+"""
+Build and query the offline geodata index used by the Alarmierung module to enrich alarms.
+
+Usage:
+	python geodata.py build places.csv places.geo [--cell-size 0.01]
+	python geodata.py nearest places.geo 52.52 13.40 [--max-distance 2000]
+
+The CSV needs the columns `latitude`, `longitude`, `name` and optionally `municipality`, e.g. the addresses of an
+OpenStreetMap extract exported with `osmium export` or `ogr2ogr`, or a list of hydrants and sites.
+"""
+
+import sys
+import time
+import argparse
+import logging
+
+from modules.geodata import DEFAULT_CELL_SIZE, GeoIndex, build_index, read_csv
+
+
+def main():
+	argp = argparse.ArgumentParser(prog='python geodata.py')
+	commands = argp.add_subparsers(dest='command', required=True)
+
+	build = commands.add_parser('build', help='index the places of a CSV file')
+	build.add_argument('csv')
+	build.add_argument('index')
+	build.add_argument('--cell-size', type=float, default=DEFAULT_CELL_SIZE, help='edge of the grid cells in degrees')
+
+	nearest = commands.add_parser('nearest', help='look up the place closest to coordinates')
+	nearest.add_argument('index')
+	nearest.add_argument('latitude', type=float)
+	nearest.add_argument('longitude', type=float)
+	nearest.add_argument('--max-distance', type=float, default=2000.0, help='in meters')
+
+	args = argp.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(name)s [%(levelname)s] %(message)s')
+
+	if args.command == 'build':
+		build_index(read_csv(args.csv), args.index, cell_size=args.cell_size)
+	else:
+		index = GeoIndex(args.index)
+		start = time.perf_counter()
+		result = index.nearest(args.latitude, args.longitude, max_distance=args.max_distance)
+		duration = time.perf_counter() - start
+		if result is None:
+			sys.exit(f'No place within {args.max_distance:.0f} m')
+		place, distance = result
+		print(f'{place.name}, {place.municipality} ({distance:.0f} m, looked up in {duration * 1000:.3f} ms)')
+
+
+if __name__ == '__main__':
+	main()
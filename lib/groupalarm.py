@@ -1,4 +1,5 @@
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Literal
 from typeguard import typechecked
 from datetime import datetime
@@ -17,48 +18,48 @@ class GroupalarmClient:
 	user_id: int
 	organization_id: int
 
+	# connections kept open per host, enough for the concurrent requests of bulk operations
+	max_connections: int = 16
+
 	def __init__(self, api_key: str):
 		self.api_key = api_key
 
 		self.user_id = None
 		self.organization_id = None
 
-	def _get(self, url: str, *, data, **kwargs):
-		response = requests.get(f'{self.base_url}/{url}', params=data, headers={
+		self._session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+		self._session.mount('https://', adapter)
+		self._session.mount('http://', adapter)
+
+	def _request(self, method: str, url: str, *, headers: dict[str, str]|None = None, **kwargs):
+		response = self._session.request(method, f'{self.base_url}/{url}', headers={
 			**self.headers,
 			'Personal-Access-Token': self.api_key,
+			**(headers or {}),
 		}, **kwargs)
 		try:
 			response.raise_for_status()
 		except requests.RequestException as e:
 			raise ValueError(e) from e
 		
-		return response.json()
+		return response.json() if len(response.content) > 0 else None
+
+	def _get(self, url: str, *, data, **kwargs):
+		return self._request('GET', url, params=data, **kwargs)
 	
 	def _post(self, url: str, *, data, **kwargs):
-		response = requests.post(f'{self.base_url}/{url}', data=data, headers={
-			**self.headers,
-			'Personal-Access-Token': self.api_key,
-		}, **kwargs)
-		try:
-			response.raise_for_status()
-		except requests.RequestException as e:
-			raise ValueError(e) from e
-		
-		return response.json()
+		return self._request('POST', url, json=data, **kwargs)
 	
 	def _put(self, url: str, *, data, **kwargs):
-		response = requests.put(f'{self.base_url}/{url}', data=data, headers={
-			**self.headers,
-			'Personal-Access-Token': self.api_key,
-		}, **kwargs)
-		try:
-			response.raise_for_status()
-		except requests.RequestException as e:
-			raise ValueError(e) from e
-		
-		return response.json()
+		return self._request('PUT', url, json=data, **kwargs)
+
+	def _delete(self, url: str, *, data, **kwargs):
+		return self._request('DELETE', url, params=data, **kwargs)
 	
+	def close(self):
+		self._session.close()
+
 	def init(self):
 		self.user_id = self.get_user()['id']
 		self.organization_id = self.get_organizations()[0]['id']
@@ -87,7 +88,22 @@ class GroupalarmClient:
 			'organization_id': organization_id,
 		})
 	
-	def create_appointment(self, *, name: str, description: str, start: datetime, end: datetime, organization_id: int|None = None, label_ids: list[int]|None = None, is_public: bool = False, keep_label_participants_in_sync: bool = True):
+	def create_appointment(self, *, name: str, description: str, start: datetime, end: datetime, organization_id: int|None = None, label_ids: list[int]|None = None, is_public: bool = False, keep_label_participants_in_sync: bool = True, idempotency_key: str|None = None):
+		"""With an `idempotency_key`, retrying a request whose response was lost does not create the appointment twice."""
+		return self._post('appointment', data=self._appointment_data(name, description, start, end, organization_id, label_ids, is_public, keep_label_participants_in_sync), headers={
+			'Idempotency-Key': idempotency_key,
+		} if idempotency_key is not None else None)
+
+	def update_appointment(self, appointment_id: int, *, name: str, description: str, start: datetime, end: datetime, organization_id: int|None = None, label_ids: list[int]|None = None, is_public: bool = False, keep_label_participants_in_sync: bool = True):
+		return self._put(f'appointment/{appointment_id}', data={
+			'id': appointment_id,
+			**self._appointment_data(name, description, start, end, organization_id, label_ids, is_public, keep_label_participants_in_sync),
+		})
+
+	def delete_appointment(self, appointment_id: int):
+		return self._delete(f'appointment/{appointment_id}', data={})
+
+	def _appointment_data(self, name: str, description: str, start: datetime, end: datetime, organization_id: int|None, label_ids: list[int]|None, is_public: bool, keep_label_participants_in_sync: bool) -> dict:
 		if start.tzinfo is None:
 			start = start.astimezone()
 		if end.tzinfo is None:
@@ -95,16 +111,16 @@ class GroupalarmClient:
 		if organization_id is None:
 			organization_id = self.organization_id
 		
-		return self._post('appointment', data={
+		return {
 			'name': name,
 			'description': description,
 			'startDate': start.isoformat(),
 			'endDate': end.isoformat(),
 			'organizationID': organization_id,
-			'labelIDs': label_ids,
+			'labelIDs': label_ids if label_ids is not None else [],
 			'isPublic': is_public,
 			'keepLabelParticipantsInSync': keep_label_participants_in_sync,
-		})
+		}
 	
 	def get_appointment(self, appointment_id: int, *, timestamp: datetime|None = None):
 		return self._get(f'appointment/{appointment_id}', data={
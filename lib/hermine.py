@@ -11,20 +11,23 @@
 
 import argparse
 import base64
+import contextlib
+import email.utils
+import functools
 import http.client
+import itertools
 import json
 import logging
+import os
 import uuid
 import string
 import random
+import threading
 import time
 
-import requests
+from concurrent.futures import ProcessPoolExecutor
 
-try:
-    import socketio
-except ModuleNotFoundError:
-    socketio = None
+import requests
 
 import Crypto.PublicKey.RSA
 import Crypto.Cipher
@@ -32,6 +35,43 @@ import Crypto.Cipher.PKCS1_OAEP
 import Crypto.Cipher.AES
 import Crypto.Random
 import Crypto.Util.Padding
+import Crypto.Util.strxor
+
+
+# seconds to wait for a connection to the API and for each read of its response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# RSA is slow enough in pycryptodome to pay off on other processes only for this many receivers
+POOL_THRESHOLD = 256
+# receivers per `channels/createInvite` request
+INVITE_BATCH_SIZE = 100
+# invites to at least this many users are logged with their timings
+LARGE_INVITE = 50
+
+
+def _no_hook(operation):
+    return contextlib.nullcontext()
+
+
+# context manager factory wrapped around every RSA and AES operation, see `set_crypto_hook`
+_crypto_hook = _no_hook
+
+
+def set_crypto_hook(hook):
+    """
+    Have `hook(operation)` return a context manager that is entered around every RSA and AES operation, e.g. to time
+    them. Operations are `rsa_import`, `rsa_wrap`, `rsa_decrypt`, `aes_encrypt` and `aes_decrypt`; None removes it.
+    """
+    global _crypto_hook
+    _crypto_hook = hook or _no_hook
+
+
+class RateLimitedError(ValueError):
+    """The API rejected a request because of rate limiting (HTTP 429)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
 class StashCatClient:
@@ -67,8 +107,12 @@ class StashCatClient:
         if include_auth:
             data["client_key"] = self.client_key
 
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
         response = requests.post(f"{self.base_url}/{url}", data=data, headers=self.headers,
                                  **kwargs)
+        if response.status_code == 429:
+            raise RateLimitedError(f"Rate limited: {url}",
+                                   _parse_retry_after(response.headers.get("Retry-After")))
         try:
             response.raise_for_status()
         except requests.RequestException as exception:
@@ -93,18 +137,22 @@ class StashCatClient:
         self.hidden_id = data["userinfo"]["socket_id"]
         return data
 
-    def get_socket(self):
-        if socketio is None:
+    def get_socket(self, *, connect=True, **options):
+        # socketio is optional and slow to import, so it is only loaded by clients that listen for pushes
+        try:
+            import socketio
+        except ModuleNotFoundError:
             raise NotImplementedError
 
-        sio = socketio.Client()
+        sio = socketio.Client(**options)
         @sio.on("connect")
         def _connect():
             sio.emit("userid", {"hidden_id": self.hidden_id,
                                 "device_id": self.device_id,
                                 "client_key": self.client_key})
 
-        sio.connect(self.push_url)
+        if connect:
+            sio.connect(self.push_url)
         return sio
 
     def check(self):
@@ -118,9 +166,10 @@ class StashCatClient:
         data = self._post("security/get_private_key", data={})
         private_key_field = json.loads(data["keys"]["private_key"])
         # there might be an unescaping bug here....
-        self.private_key = Crypto.PublicKey.RSA.import_key(
-            private_key_field["private"], passphrase=encryption_password
-        )
+        with _crypto_hook("rsa_import"):
+            self.private_key = Crypto.PublicKey.RSA.import_key(
+                private_key_field["private"], passphrase=encryption_password
+            )
 
     def get_open_conversations(self, *, limit=30, offset=0):
         data = self._post("message/conversations", data={
@@ -146,22 +195,23 @@ class StashCatClient:
         return self._post("users/info", data={"user_id": user_id, "withkey": True})["user"]
 
     def open_conversation(self, members):
+        members = list(members)
         conversation_key = Crypto.Random.get_random_bytes(32)
 
         receivers = []
         # Always add ourselves
-        encryptor = Crypto.Cipher.PKCS1_OAEP.new(self.private_key.publickey())
-        receivers.append({
-            "id": int(self.user_id),
-            "key": base64.b64encode(encryptor.encrypt(conversation_key)).decode("utf-8")
-        })
-        for member in members:
-            pubkey = Crypto.PublicKey.RSA.import_key(member["public_key"])
-            encryptor = Crypto.Cipher.PKCS1_OAEP.new(pubkey)
+        with _crypto_hook("rsa_wrap"):
+            encryptor = Crypto.Cipher.PKCS1_OAEP.new(self.private_key.publickey())
             receivers.append({
-                "id": int(member["id"]),
+                "id": int(self.user_id),
                 "key": base64.b64encode(encryptor.encrypt(conversation_key)).decode("utf-8")
             })
+        keys = _wrap_keys([member["public_key"] for member in members], conversation_key)
+        for member, key in zip(members, keys):
+            receivers.append({
+                "id": int(member["id"]),
+                "key": key,
+            })
 
         data = self._post("message/createEncryptedConversation", data={
             "members": json.dumps(receivers),
@@ -178,29 +228,26 @@ class StashCatClient:
             "offset": offset,
         })
 
-        conversation_key = self._get_conversation_key(source)
+        codec = AESBatchCodec(self._get_conversation_key(source))
 
+        # collect all encrypted fields of the page and decrypt them in a single batch
+        fields = []
         for message in data["messages"]:
             if message["kind"] == "message" and message["encrypted"]:
                 if message["text"] is not None:
-                    message["text_decrypted"] = _decrypt_aes(
-                        bytes.fromhex(message["text"] ),
-                        conversation_key,
-                        bytes.fromhex(message["iv"])
-                    ).decode("utf-8")
-
-                if message["location"] is not None and message["location"]["encrypted"]:
-                    message["location"]["latitude_decrypted"] = _decrypt_aes(
-                        bytes.fromhex(message["location"]["latitude"]),
-                        conversation_key,
-                        bytes.fromhex(message["location"]["iv"])
-                    ).decode("utf-8")
-                    message["location"]["longitude_decrypted"] = _decrypt_aes(
-                        bytes.fromhex(message["location"]["longitude"]),
-                        conversation_key,
-                        bytes.fromhex(message["location"]["iv"])
-                    ).decode("utf-8")
-            yield message
+                    fields.append((message, "text_decrypted", message["text"], message["iv"]))
+
+                location = message["location"]
+                if location is not None and location["encrypted"]:
+                    fields.append((location, "latitude_decrypted", location["latitude"], location["iv"]))
+                    fields.append((location, "longitude_decrypted", location["longitude"], location["iv"]))
+
+        with _crypto_hook("aes_decrypt"):
+            decrypted = codec.decrypt_many([(ciphertext, iv) for _, _, ciphertext, iv in fields])
+        for (container, key, _, _), plain in zip(fields, decrypted):
+            container[key] = plain.decode("utf-8")
+
+        yield from data["messages"]
 
     def get_companies(self):
         data = self._post("company/member", data={"no_cache": True})
@@ -214,8 +261,9 @@ class StashCatClient:
                        channel_type="closed", visible=False, writable="all",
                        invitable="all", show_membership_activities=True):
         conversation_key = Crypto.Random.get_random_bytes(32)
-        encryptor = Crypto.Cipher.PKCS1_OAEP.new(self.private_key.publickey())
-        key = base64.b64encode(encryptor.encrypt(conversation_key)).decode("utf-8")
+        with _crypto_hook("rsa_wrap"):
+            encryptor = Crypto.Cipher.PKCS1_OAEP.new(self.private_key.publickey())
+            key = base64.b64encode(encryptor.encrypt(conversation_key)).decode("utf-8")
 
         data = self._post("channels/create", data={
             "encryption_key": key,
@@ -233,23 +281,32 @@ class StashCatClient:
         return channel
 
     def invite(self, channel_id, users, text="", expiry=None):
+        users = list(users)
+        expiry = expiry or time.time() + 7 * 24 * 60 * 60
         conversation_key = self._get_conversation_key(("channel", channel_id))
 
-        receivers = []
-        for user in users:
-            pubkey = Crypto.PublicKey.RSA.import_key(user["public_key"])
-            encryptor = Crypto.Cipher.PKCS1_OAEP.new(pubkey)
-            receivers.append({
+        start = time.perf_counter()
+        keys = _wrap_keys([user["public_key"] for user in users], conversation_key)
+        wrapped = time.perf_counter()
+
+        for i in range(0, len(users), INVITE_BATCH_SIZE):
+            receivers = [{
                 "id": int(user["id"]),
-                "key": base64.b64encode(encryptor.encrypt(conversation_key)).decode("utf-8"),
-                "expiry": expiry or time.time() + 7 * 24 * 60 * 60,
+                "key": key,
+                "expiry": expiry,
                 "userVerified": True,
+            } for user, key in zip(users[i:i + INVITE_BATCH_SIZE], keys[i:i + INVITE_BATCH_SIZE])]
+            self._post("channels/createInvite", data={
+                "channel_id": int(channel_id),
+                "users": json.dumps(receivers),
+                "text": text,
             })
-        self._post("channels/createInvite", data={
-            "channel_id": int(channel_id),
-            "users": json.dumps(receivers),
-            "text": text,
-        })
+
+        if len(users) >= LARGE_INVITE:
+            logging.getLogger("hermine").info(
+                "Invited %d users to channel %s in %.0f ms (wrapping keys: %.0f ms, %d requests: %.0f ms)",
+                len(users), channel_id, (time.perf_counter() - start) * 1000, (wrapped - start) * 1000,
+                -(len(users) // -INVITE_BATCH_SIZE), (time.perf_counter() - wrapped) * 1000)
 
     def get_channel_members(self, channel_id, *, limit=40, offset=0):
         data = self._post("channels/members", data={
@@ -285,20 +342,28 @@ class StashCatClient:
 
             self._key_cache[target] = encrypted_key
 
-        decryptor = Crypto.Cipher.PKCS1_OAEP.new(self.private_key)
-        return decryptor.decrypt(base64.b64decode(encrypted_key))
+        with _crypto_hook("rsa_decrypt"):
+            decryptor = Crypto.Cipher.PKCS1_OAEP.new(self.private_key)
+            return decryptor.decrypt(base64.b64decode(encrypted_key))
 
     def send_msg(self, target, message, *, files=None, location=None, is_styled=False):
         files = files or []
 
         iv = Crypto.Random.get_random_bytes(16)
-        conversation_key = self._get_conversation_key(target)
+        codec = AESBatchCodec(self._get_conversation_key(target))
+
+        fields = [message.encode("utf-8")]
+        if location:
+            fields.append(str(location[0]).encode("utf-8"))
+            fields.append(str(location[1]).encode("utf-8"))
+        with _crypto_hook("aes_encrypt"):
+            encrypted = codec.encrypt_many(fields, iv)
 
         payload = {
             "client_key": self.client_key,
             "target": target[0],
             f"{target[0]}_id": target[1],
-            "text": _encrypt_aes(message.encode("utf-8"), conversation_key, iv).hex(),
+            "text": encrypted[0].hex(),
             "iv": iv.hex(),
             "files": json.dumps(files),
             "url": "[]",
@@ -312,10 +377,8 @@ class StashCatClient:
         }
 
         if location:
-            payload["latitude"] = _encrypt_aes(
-                str(location[0]).encode("utf-8"), conversation_key, iv).hex()
-            payload["longitude"] = _encrypt_aes(
-                str(location[1]).encode("utf-8"), conversation_key, iv).hex()
+            payload["latitude"] = encrypted[1].hex()
+            payload["longitude"] = encrypted[2].hex()
 
         return self._post("message/send", data=payload)["message"]
 
@@ -337,11 +400,12 @@ class StashCatClient:
         upload_uuid = str(uuid.uuid4())
         for nr in range(-(len(content) // -chunk_size)):
             chunk = content[nr * chunk_size:(nr + 1) * chunk_size]
-            ct_bytes = _encrypt_aes(
-                chunk,
-                file_key,
-                iv
-            )
+            with _crypto_hook("aes_encrypt"):
+                ct_bytes = _encrypt_aes(
+                    chunk,
+                    file_key,
+                    iv
+                )
 
             file_data = self._post("file/upload", data={
                 "resumableChunkNumber": nr,
@@ -363,17 +427,206 @@ class StashCatClient:
             }, files={"file": ("[object Object]", ct_bytes, "application/octet-stream")})["file"]
 
         iv = Crypto.Random.get_random_bytes(16)
+        conversation_key = self._get_conversation_key(target)
+        with _crypto_hook("aes_encrypt"):
+            encrypted_file_key = _encrypt_aes(file_key, conversation_key, iv)
         self._post("security/set_file_access_key", data={
             "file_id": file_data["id"],
             "target": target[0],
             "target_id": target[1],
-            "key": _encrypt_aes(file_key, self._get_conversation_key(target), iv).hex(),
+            "key": encrypted_file_key.hex(),
             "iv": iv.hex(),
         })
 
         return file_data
 
 
+class Directory:
+    """
+    Companies, channels and channel members of a client, cached so names resolve to ids with a dict lookup and
+    membership checks need no request.
+
+    `refresh` only fetches the members of channels that are new or whose member count changed, and imports the public
+    keys of new members, so `invite` and `open_conversation` never parse keys while sending. Every refresh builds new
+    maps and swaps them in at once, readers never take a lock.
+    """
+
+    def __init__(self, client, *, interval=300.0):
+        self.client = client
+        self.interval = interval
+        self.logger = logging.getLogger("hermine.directory")
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._companies = {}
+        self._company_names = {}
+        self._channels = {}
+        self._channel_names = {}
+        # channel id -> (member count when fetched, {user id: user})
+        self._members = {}
+        self._users = {}
+        self._user_names = {}
+
+    def start(self):
+        """Refresh now and then every `interval` seconds in a background thread."""
+        self.refresh()
+        if self._thread is None:
+            self._thread = threading.Thread(name="Thread-hermine-directory", target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def refresh(self, *, force=False):
+        with self._lock:
+            self._refresh(force)
+
+    def company(self, name):
+        """The company with the name, None if there is none."""
+        return self._company_names.get(_name_key(name))
+
+    def company_by_id(self, company_id):
+        return self._companies.get(int(company_id))
+
+    def channel(self, name, company_id=None):
+        """The channel with the name, of any company unless `company_id` is given; None if there is none."""
+        channels = self._channel_names.get(_name_key(name), ())
+        for channel in channels:
+            if company_id is None or int(channel["company_id"]) == int(company_id):
+                return channel
+        return None
+
+    def channel_by_id(self, channel_id):
+        return self._channels.get(int(channel_id))
+
+    def channels(self, company_id=None):
+        return [channel for channel in self._channels.values()
+                if company_id is None or int(channel["company_id"]) == int(company_id)]
+
+    def members(self, channel_id):
+        return list(self._members.get(int(channel_id), (None, {}))[1].values())
+
+    def is_member(self, channel_id, user_id):
+        return int(user_id) in self._members.get(int(channel_id), (None, {}))[1]
+
+    def user(self, user_id):
+        """A member of any channel or, if there is none, the user as fetched with `user_info` and then cached."""
+        user = self._users.get(int(user_id))
+        if user is None:
+            user = self.client.user_info(user_id)
+            _prepare_user(user)
+            self._users = {**self._users, int(user["id"]): user}
+        return user
+
+    def user_by_name(self, name):
+        """The member of any channel with the name, "first last", None if there is none or it is ambiguous."""
+        users = self._user_names.get(_name_key(name), ())
+        return users[0] if len(users) == 1 else None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.warning("Failed to refresh the Hermine directory: %s", e)
+
+    def _refresh(self, force):
+        companies = {int(company["id"]): company for company in self.client.get_companies()}
+        channels = {}
+        for company_id in companies:
+            for channel in self.client.get_channels(company_id):
+                channel.setdefault("company_id", company_id)
+                channels[int(channel["id"])] = channel
+
+        members = {}
+        fetched = 0
+        for channel_id, channel in channels.items():
+            count = channel.get("user_count")
+            cached = self._members.get(channel_id)
+            if not force and cached is not None and count is not None and cached[0] == count:
+                members[channel_id] = cached
+                continue
+            channel_members = {}
+            for user in unpaginate(self.client.get_channel_members, channel_id, limit=100):
+                _prepare_user(user)
+                channel_members[int(user["id"])] = user
+            members[channel_id] = (count, channel_members)
+            fetched += 1
+
+        users = {user_id: user for _, channel_members in members.values() for user_id, user in channel_members.items()}
+        # users fetched with `user_info` that are not a member of any channel
+        for user_id, user in self._users.items():
+            users.setdefault(user_id, user)
+
+        self._companies = companies
+        self._company_names = {_name_key(company["name"]): company for company in companies.values()}
+        self._channels = channels
+        self._channel_names = _group_by_name(channels.values(), lambda channel: channel["name"])
+        self._members = members
+        self._users = users
+        self._user_names = _group_by_name(users.values(), _user_name)
+
+        self.logger.debug("Refreshed directory: %d companies, %d channels (members of %d fetched), %d users",
+                          len(companies), len(channels), fetched, len(users))
+
+
+def _prepare_user(user):
+    public_key = user.get("public_key")
+    if public_key:
+        # imported now, so it is cached when sending
+        _public_key_encryptor(public_key)
+
+
+def _name_key(name):
+    return " ".join(str(name).split()).casefold()
+
+
+def _user_name(user):
+    return f"{user.get('first_name', '')} {user.get('last_name', '')}"
+
+
+def _group_by_name(items, name):
+    groups = {}
+    for item in items:
+        groups.setdefault(_name_key(name(item)), []).append(item)
+    return groups
+
+
+@functools.lru_cache(maxsize=4096)
+def _public_key_encryptor(public_key):
+    """OAEP encryptor of a PEM public key, importing (parsing) each key once."""
+    with _crypto_hook("rsa_import"):
+        return Crypto.Cipher.PKCS1_OAEP.new(Crypto.PublicKey.RSA.import_key(public_key))
+
+
+def _wrap_key(public_key, key):
+    return base64.b64encode(_public_key_encryptor(public_key).encrypt(key)).decode("utf-8")
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _wrap_keys(public_keys, key):
+    """`key` encrypted with each of the PEM `public_keys`, on a pool of processes if there are many of them."""
+    workers = os.process_cpu_count() or 1
+    if len(public_keys) < POOL_THRESHOLD or workers < 2:
+        with _crypto_hook("rsa_wrap"):
+            return [_wrap_key(public_key, key) for public_key in public_keys]
+
+    global _pool
+    workers = min(workers, 4)
+    with _pool_lock:
+        if _pool is None:
+            # kept for the next invite, the workers cache the keys they imported just like this process does
+            _pool = ProcessPoolExecutor(max_workers=workers)
+    with _crypto_hook("rsa_wrap"):
+        return list(_pool.map(_wrap_key, public_keys, itertools.repeat(key),
+                              chunksize=-(len(public_keys) // -(workers * 4))))
+
+
 def unpaginate(method, *args, offset=0, limit=30, **kwargs):
     while True:
         result = method(*args, **kwargs, limit=limit, offset=offset)
@@ -383,6 +636,20 @@ def unpaginate(method, *args, offset=0, limit=30, **kwargs):
             return
 
 
+def _parse_retry_after(value):
+    """Parse a `Retry-After` header (delay in seconds or HTTP date) into seconds."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
 def _encrypt_aes(plain: bytes, key: bytes, iv: bytes):
     return Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_CBC, iv=iv).encrypt(
         Crypto.Util.Padding.pad(plain, Crypto.Cipher.AES.block_size)
@@ -398,6 +665,73 @@ def _decrypt_aes(cipher: bytes, key: bytes, iv: bytes):
     )
 
 
+class AESBatchCodec:
+    """AES-CBC codec for many fields encrypted under the same key.
+
+    CBC decryption of a block only depends on the block itself and the preceding
+    ciphertext block (or the IV), so all fields are decrypted with a single ECB pass
+    over one preallocated buffer, followed by a single XOR with the shifted ciphertext.
+    Encryption is inherently sequential and still uses one CBC cipher per field.
+    """
+
+    block_size = Crypto.Cipher.AES.block_size
+
+    def __init__(self, key: bytes):
+        self.key = key
+        self._ecb = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_ECB)
+
+    def encrypt_many(self, plains, iv: bytes):
+        return [_encrypt_aes(plain, self.key, iv) for plain in plains]
+
+    def decrypt_many(self, pairs):
+        """Decrypt hex encoded `(ciphertext, iv)` pairs, returning the unpadded plaintexts."""
+        sizes = [len(ciphertext) // 2 for ciphertext, _ in pairs]
+        total = sum(sizes)
+
+        cipher = bytearray(total)
+        chain = bytearray(total)
+        offset = 0
+        for (ciphertext, iv), size in zip(pairs, sizes):
+            if size == 0:
+                continue
+            if size % self.block_size != 0:
+                raise ValueError("Ciphertext length is not a multiple of the block size")
+
+            iv = bytes.fromhex(iv)
+            # slice assignment would resize the buffer and shift every following field
+            if len(iv) != self.block_size:
+                raise ValueError(f"Incorrect IV length (it must be {self.block_size} bytes long)")
+
+            end = offset + size
+            cipher[offset:end] = bytes.fromhex(ciphertext)
+            chain[offset:offset + self.block_size] = iv
+            chain[offset + self.block_size:end] = cipher[offset:end - self.block_size]
+            offset = end
+
+        plain = bytearray(total)
+        if total > 0:
+            self._ecb.decrypt(cipher, output=plain)
+            Crypto.Util.strxor.strxor(plain, chain, output=plain)
+
+        view = memoryview(plain)
+        results = []
+        offset = 0
+        for size in sizes:
+            results.append(_unpad(view[offset:offset + size], self.block_size))
+            offset += size
+        return results
+
+
+def _unpad(padded: memoryview, block_size: int):
+    if len(padded) == 0:
+        return b""
+
+    padding_len = padded[-1]
+    if not 0 < padding_len <= block_size or padded[-padding_len:] != bytes([padding_len]) * padding_len:
+        raise ValueError("Padding is incorrect.")
+    return bytes(padded[:-padding_len])
+
+
 def setup_logging(debug=False):
     logging.basicConfig()
     requests_log = logging.getLogger("requests.packages.urllib3")
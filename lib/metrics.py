@@ -0,0 +1,252 @@
+"""
+Minimal Prometheus-style metrics.
+
+Hot paths only ever write to per-thread shards (no locks, no shared read-modify-write),
+the shards of all threads are summed up when the metrics are collected.
+"""
+
+from collections.abc import Callable, Iterator
+
+import time
+import bisect
+import logging
+import weakref
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Shards:
+	"""Per-thread accumulators that are merged on collection, and into a common one when their thread exits."""
+
+	def __init__(self, size: int):
+		self._size = size
+		self._local = threading.local()
+		self._shards: list[list[float]] = []
+		# values of the shards of threads that have exited
+		self._retired = [0.0] * size
+		# never taken by writes; reentrant, as a finalizer may run while a collection holds it
+		self._lock = threading.RLock()
+
+	def local(self) -> list[float]:
+		try:
+			return self._local.shard
+		except AttributeError:
+			shard = self._local.shard = [0.0] * self._size
+			# thread-local values are dropped when the thread exits, and the finalizer of this one with them
+			self._local.owner = owner = _ShardOwner()
+			weakref.finalize(owner, self._retire, shard)
+			with self._lock:
+				self._shards.append(shard)
+			return shard
+
+	def collect(self) -> list[float]:
+		with self._lock:
+			shards = [self._retired, *self._shards]
+			return [sum(values) for values in zip(*shards)]
+
+	def _retire(self, shard: list[float]) -> None:
+		with self._lock:
+			for i, other in enumerate(self._shards):
+				if other is shard:
+					del self._shards[i]
+					break
+			self._retired = [retired + value for retired, value in zip(self._retired, shard)]
+
+
+class _ShardOwner:
+	"""Stored next to a shard in the thread-local, only to be notified when the thread exits."""
+
+	__slots__ = ('__weakref__',)
+
+
+class _Metric:
+	type: str
+
+	def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), *, registry: 'Registry|None' = None):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = labelnames
+		self._children: dict[tuple[str, ...], _Metric] = {}
+
+		if registry is None:
+			registry = REGISTRY
+		registry.register(self)
+
+	def labels(self, *values) -> '_Metric':
+		key = tuple(str(value) for value in values)
+		child = self._children.get(key)
+		if child is None:
+			if len(key) != len(self.labelnames):
+				raise ValueError(f'Metric "{self.name}" expects labels {self.labelnames}, got {key}')
+			child = self._children.setdefault(key, self._child())
+		return child
+
+	def _child(self) -> '_Metric':
+		child = object.__new__(type(self))
+		child._init_child()
+		return child
+
+	def _init_child(self) -> None:
+		...
+
+	def _samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+		...
+
+	def expose(self) -> list[str]:
+		lines = [
+			f'# HELP {self.name} {self.documentation}',
+			f'# TYPE {self.name} {self.type}',
+		]
+		children = self._children.items() if self.labelnames else [((), self)]
+		for values, child in children:
+			labels = dict(zip(self.labelnames, values))
+			for suffix, extra, value in child._samples():
+				lines.append(f'{self.name}{suffix}{_format_labels({**labels, **extra})} {_format_value(value)}')
+		return lines
+
+
+class Counter(_Metric):
+	type = 'counter'
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._init_child()
+
+	def _init_child(self) -> None:
+		self._shards = _Shards(1)
+		self._function: Callable[[], float]|None = None
+
+	def inc(self, amount: float = 1) -> None:
+		self._shards.local()[0] += amount
+
+	def set_function(self, function: Callable[[], float]) -> None:
+		"""Read the value from `function` on collection instead of counting (e.g. for existing statistics)."""
+		self._function = function
+
+	def _samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+		yield '_total', {}, self._function() if self._function is not None else self._shards.collect()[0]
+
+
+class Gauge(_Metric):
+	type = 'gauge'
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._init_child()
+
+	def _init_child(self) -> None:
+		self._value = 0.0
+		self._function: Callable[[], float]|None = None
+
+	def set(self, value: float) -> None:
+		self._value = value
+
+	def set_function(self, function: Callable[[], float]) -> None:
+		self._function = function
+
+	def _samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+		yield '', {}, self._function() if self._function is not None else self._value
+
+
+class Histogram(_Metric):
+	type = 'histogram'
+
+	def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), *, buckets: tuple[float, ...] = DEFAULT_BUCKETS, registry: 'Registry|None' = None):
+		self._buckets = tuple(sorted(buckets))
+		super().__init__(name, documentation, labelnames, registry=registry)
+		self._init_child()
+
+	def _child(self) -> 'Histogram':
+		child = object.__new__(Histogram)
+		child._buckets = self._buckets
+		child._init_child()
+		return child
+
+	def _init_child(self) -> None:
+		# one slot per bucket, one for +Inf and one for the sum
+		self._shards = _Shards(len(self._buckets) + 2)
+
+	def observe(self, value: float) -> None:
+		shard = self._shards.local()
+		shard[bisect.bisect_left(self._buckets, value)] += 1
+		shard[-1] += value
+
+	@contextmanager
+	def time(self):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start)
+
+	def _samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+		values = self._shards.collect()
+		count = 0.0
+		for bound, value in zip(self._buckets, values):
+			count += value
+			yield '_bucket', {'le': _format_value(bound)}, count
+		count += values[-2]
+		yield '_bucket', {'le': '+Inf'}, count
+		yield '_sum', {}, values[-1]
+		yield '_count', {}, count
+
+
+class Registry:
+	def __init__(self):
+		self._metrics: dict[str, _Metric] = {}
+		self._lock = threading.Lock()
+
+	def register(self, metric: _Metric) -> None:
+		with self._lock:
+			if metric.name in self._metrics:
+				raise ValueError(f'Metric "{metric.name}" is already registered')
+			self._metrics[metric.name] = metric
+
+	def expose(self) -> str:
+		with self._lock:
+			metrics = list(self._metrics.values())
+		return ''.join(line + '\n' for metric in metrics for line in metric.expose())
+
+
+REGISTRY = Registry()
+
+
+def start_http_server(host: str, port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+	class _Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path.split('?')[0] != '/metrics':
+				self.send_error(404)
+				return
+
+			body = registry.expose().encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			logging.getLogger('metrics').debug(format, *args)
+
+	server = ThreadingHTTPServer((host, port), _Handler)
+	threading.Thread(name='Thread-metrics', target=server.serve_forever, daemon=True).start()
+	return server
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+	if not labels:
+		return ''
+	escaped = (
+		f'{name}="{value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')}"'
+		for name, value in labels.items()
+	)
+	return '{' + ','.join(escaped) + '}'
+
+def _format_value(value: float) -> str:
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value))
@@ -0,0 +1,259 @@
+"""
+Minimal tracing with spans in the OpenTelemetry data model.
+
+Ended spans are queued and written by a background thread to a file, one OTLP/JSON `ExportTraceServiceRequest` per
+line as the file exporter of the OpenTelemetry Collector writes them, so the file can be loaded by the usual tools.
+"""
+
+from typing import Any
+from collections.abc import Iterator
+
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from lib.metrics import Counter
+
+
+SPANS_DROPPED = Counter('trace_spans_dropped', 'Spans dropped because the export queue was full')
+
+# span kinds of OTLP
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+PRODUCER = 4
+CONSUMER = 5
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current: contextvars.ContextVar['Span|None'] = contextvars.ContextVar('span', default=None)
+
+
+class Span:
+	__slots__ = ('name', 'kind', 'trace_id', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'events', 'status', '_tracer')
+
+	def __init__(self, tracer: 'Tracer', name: str, trace_id: int, parent_id: int|None, *, kind: int = INTERNAL, start: int|None = None, attributes: dict[str, Any]|None = None):
+		self.name = name
+		self.kind = kind
+		self.trace_id = trace_id
+		self.span_id = random.getrandbits(64) or 1
+		self.parent_id = parent_id
+		# nanoseconds since the epoch
+		self.start = start if start is not None else time.time_ns()
+		self.end: int|None = None
+		self.attributes = attributes if attributes is not None else {}
+		self.events: list[tuple[int, str, dict[str, Any]]] = []
+		self.status: tuple[int, str]|None = None
+		self._tracer = tracer
+
+	def set_attribute(self, key: str, value: Any) -> None:
+		self.attributes[key] = value
+
+	def add_event(self, name: str, *, at: int|None = None, **attributes) -> None:
+		self.events.append((at if at is not None else time.time_ns(), name, attributes))
+
+	def set_error(self, error: BaseException|str) -> None:
+		self.status = (STATUS_ERROR, str(error))
+
+	def finish(self, *, at: int|None = None) -> None:
+		"""End the span and queue it for export; only the first call counts."""
+		if self.end is not None:
+			return
+		self.end = at if at is not None else time.time_ns()
+		self._tracer._export(self)
+
+	def to_otlp(self) -> dict:
+		data = {
+			'traceId': f'{self.trace_id:032x}',
+			'spanId': f'{self.span_id:016x}',
+			'name': self.name,
+			'kind': self.kind,
+			'startTimeUnixNano': str(self.start),
+			'endTimeUnixNano': str(self.end),
+			'attributes': _attributes(self.attributes),
+		}
+		if self.parent_id is not None:
+			data['parentSpanId'] = f'{self.parent_id:016x}'
+		if self.events:
+			data['events'] = [{'timeUnixNano': str(at), 'name': name, 'attributes': _attributes(attributes)} for at, name, attributes in self.events]
+		if self.status is not None:
+			data['status'] = {'code': self.status[0], 'message': self.status[1]}
+		return data
+
+	@property
+	def recording(self) -> bool:
+		return True
+
+
+class NoopSpan:
+	"""Stands in for spans while tracing is disabled or outside of a trace, so callers never have to check."""
+
+	__slots__ = ()
+
+	recording = False
+
+	def set_attribute(self, key: str, value: Any) -> None:
+		pass
+
+	def add_event(self, name: str, *, at: int|None = None, **attributes) -> None:
+		pass
+
+	def set_error(self, error: BaseException|str) -> None:
+		pass
+
+	def finish(self, *, at: int|None = None) -> None:
+		pass
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+	"""
+	Creates spans and exports them once they are ended, does nothing until `export_to` is called.
+
+	Traces are only started explicitly with `start_trace`; `span` records a child of the current span and is a no-op
+	outside of a trace, so shared code like the API clients can be instrumented without tracing every call.
+	The current span is a context variable, `contextvars.copy_context()` carries it to other threads.
+	"""
+
+	def __init__(self, service_name: str = 'automatisierung'):
+		self.service_name = service_name
+		self.logger = logging.getLogger('tracing')
+
+		self._queue: queue.Queue[Span|None]|None = None
+		self._thread: threading.Thread|None = None
+		self._path: str|None = None
+
+	@property
+	def enabled(self) -> bool:
+		return self._queue is not None
+
+	def start_trace(self, name: str, *, kind: int = INTERNAL, start: int|None = None, **attributes) -> Span|NoopSpan:
+		"""Start the root span of a new trace, it is neither made current nor ended automatically."""
+		if self._queue is None:
+			return NOOP_SPAN
+		return Span(self, name, random.getrandbits(128) or 1, None, kind=kind, start=start, attributes=attributes)
+
+	def start_span(self, name: str, *, parent: Span|NoopSpan|None = None, kind: int = INTERNAL, start: int|None = None, **attributes) -> Span|NoopSpan:
+		"""Start a child of `parent` or of the current span, it is neither made current nor ended automatically."""
+		if parent is None:
+			parent = _current.get()
+		if parent is None or not parent.recording:
+			return NOOP_SPAN
+		return Span(self, name, parent.trace_id, parent.span_id, kind=kind, start=start, attributes=attributes)
+
+	@contextmanager
+	def span(self, name: str, *, kind: int = INTERNAL, **attributes) -> Iterator[Span|NoopSpan]:
+		"""Child of the current span that is current within the block and ended after it, marked as failed on exceptions."""
+		span = self.start_span(name, kind=kind, **attributes)
+		if not span.recording:
+			yield span
+			return
+		with use_span(span):
+			try:
+				yield span
+			except BaseException as e:
+				span.set_error(e)
+				raise
+			finally:
+				span.finish()
+
+	def export_to(self, path: str|None, *, queue_size: int = 10000) -> None:
+		"""Write ended spans to `path` from now on, stop exporting if it is None."""
+		if path == self._path:
+			return
+		self.stop()
+		if path is None:
+			return
+
+		self._path = path
+		self._queue = queue.Queue(queue_size)
+		self._thread = threading.Thread(name='Thread-tracing', target=self._write, args=(path, self._queue), daemon=True)
+		self._thread.start()
+
+	def stop(self) -> None:
+		"""Write the spans still queued and stop exporting."""
+		if self._queue is None:
+			return
+		spans, self._queue = self._queue, None
+		spans.put(None)
+		self._thread.join()
+		self._thread = None
+		self._path = None
+
+	def _export(self, span: Span) -> None:
+		spans = self._queue
+		if spans is None:
+			return
+		try:
+			spans.put_nowait(span)
+		except queue.Full:
+			SPANS_DROPPED.inc()
+
+	def _write(self, path: str, spans: 'queue.Queue[Span|None]') -> None:
+		resource = {'attributes': _attributes({'service.name': self.service_name})}
+		scope = {'name': __name__}
+
+		with open(path, 'a', encoding='utf-8') as fp:
+			stopped = False
+			while not stopped:
+				batch = [spans.get()]
+				# everything queued meanwhile goes into the same line
+				while True:
+					try:
+						batch.append(spans.get_nowait())
+					except queue.Empty:
+						break
+				if None in batch:
+					stopped = True
+					batch = [span for span in batch if span is not None]
+				if not batch:
+					continue
+
+				try:
+					fp.write(json.dumps({'resourceSpans': [{'resource': resource, 'scopeSpans': [{'scope': scope, 'spans': [span.to_otlp() for span in batch]}]}]}, ensure_ascii=False, separators=(',', ':')))
+					fp.write('\n')
+					fp.flush()
+				except Exception:
+					self.logger.exception('Failed to write %d spans to %s', len(batch), path)
+
+
+TRACER = Tracer()
+
+
+def current_span() -> Span|NoopSpan:
+	span = _current.get()
+	return span if span is not None else NOOP_SPAN
+
+@contextmanager
+def use_span(span: Span|NoopSpan) -> Iterator[Span|NoopSpan]:
+	"""Make `span` the current span within the block without ending it."""
+	if not span.recording:
+		yield span
+		return
+	token = _current.set(span)
+	try:
+		yield span
+	finally:
+		_current.reset(token)
+
+def _attributes(attributes: dict[str, Any]) -> list[dict]:
+	return [{'key': key, 'value': _value(value)} for key, value in attributes.items() if value is not None]
+
+def _value(value: Any) -> dict:
+	if isinstance(value, bool):
+		return {'boolValue': value}
+	if isinstance(value, int):
+		# 64 bit integers are strings in OTLP/JSON
+		return {'intValue': str(value)}
+	if isinstance(value, float):
+		return {'doubleValue': value}
+	if isinstance(value, (list, tuple)):
+		return {'arrayValue': {'values': [_value(item) for item in value]}}
+	return {'stringValue': str(value)}
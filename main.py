@@ -1,36 +1,82 @@
 from modules.module import Module, ModuleConfig
 
+import time
 import logging
-from threading import Thread
+from threading import Thread, Lock
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 from config import Config, ConfigWatcher
-from modules import beflaggung, ausbildungsdienst, alarmierung, user_interface
+from modules.registry import create_modules
+from modules.scheduler import configure_scheduler
+from modules.coordination import configure_coordinator
+from modules.mail import get_mail_service
+from modules.logs import configure_logging, stop_logging
+from lib.metrics import Gauge, start_http_server
+from lib.tracing import TRACER
 
 
 CONFIG_FILE = 'config.toml'
 
+STARTUP_SECONDS = Gauge('startup_phase_seconds', 'Duration of the startup phases', ('phase',))
+
+
+class StartupTimer:
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.phases: dict[str, float] = {}
+		self._lock = Lock()
+
+	@contextmanager
+	def phase(self, name: str):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			duration = time.perf_counter() - start
+			with self._lock:
+				self.phases[name] = duration
+			STARTUP_SECONDS.labels(name).set(duration)
+
+	def report(self) -> None:
+		total = time.perf_counter() - self.start
+		STARTUP_SECONDS.labels('total').set(total)
+		logging.info('Started in %.2f seconds (%s)', total, ', '.join(f'{name}: {duration:.2f} s' for name, duration in self.phases.items()))
+
 
 def main():
-	config = load_config(CONFIG_FILE)
+	timer = StartupTimer()
 
-	logging.basicConfig(level=config.logging.level, format='%(asctime)s %(threadName)s %(name)s [%(levelname)s] %(message)s')
+	with timer.phase('config'):
+		config = load_config(CONFIG_FILE)
+
+	configure_logging(config.logging)
 	logging.info('Starting…')
 	logging.debug('Logging level is set to %s', logging.getLevelName(config.logging.level))
 
-	modules: list[tuple[Module, ModuleConfig]] = [
-		(beflaggung.Beflaggung('beflaggung'), beflaggung._Config()),
-		(ausbildungsdienst.Ausbildungsdienst('ausbildungsdienst'), ausbildungsdienst._Config()),
-		(alarmierung.Alarmierung('alarmierung'), alarmierung._Config()),
+	scheduler = configure_scheduler(config.scheduler)
+	coordinator = configure_coordinator(config.coordination, config.mqtt)
+
+	if config.metrics.port is not None:
+		start_http_server(config.metrics.host, config.metrics.port)
+		logging.info('Serving metrics on http://%s:%d/metrics', config.metrics.host, config.metrics.port)
+	TRACER.export_to(config.tracing.file, queue_size=config.tracing.queue_size)
 
-		(user_interface.UserInterface('user_interface'), user_interface._Config()),
-	]
-	update_config(config, modules)
-	threads = list(map(lambda module: Thread(name=f'Thread-{module[0].__module__}', target=module[0].run, daemon=True), modules))
+	with timer.phase('imports'):
+		modules = create_modules(config)
+	with timer.phase('init'):
+		update_config(config, modules, timer)
+	threads = list(map(lambda module: Thread(name=f'Thread-{module[0].name}', target=module[0].run, daemon=True), modules))
+	threads.append(Thread(name='Thread-scheduler', target=scheduler.run, daemon=True))
+	threads.append(Thread(name='Thread-coordination', target=coordinator.run, daemon=True))
+	threads.append(Thread(name='Thread-mail', target=get_mail_service().run, daemon=True))
 
 	for thread in threads:
 		logging.debug('Starting thread "%s"…', thread.name)
 		thread.start()
 
+	timer.report()
+
 	config_watcher = ConfigWatcher(CONFIG_FILE)
 	@config_watcher.on_change
 	def _():
@@ -41,7 +87,13 @@ def main():
 			logging.debug('Config is unchanged, skipping reload')
 			return
 		config = cfg
-		update_config(config, modules)
+		if config.module_names() != [module.name for module, _ in modules]:
+			logging.warning('Adding or removing modules requires a restart')
+		configure_logging(config.logging)
+		TRACER.export_to(config.tracing.file, queue_size=config.tracing.queue_size)
+		configure_scheduler(config.scheduler)
+		configure_coordinator(config.coordination, config.mqtt)
+		update_config(config, [(module, cfg) for module, cfg in modules if module.name in config.module_names()])
 
 	manually_interrupted = False
 	try:
@@ -50,12 +102,18 @@ def main():
 	except KeyboardInterrupt:
 		manually_interrupted = True
 
+	# hand over leases right away instead of letting the other replicas wait for them to expire
+	coordinator.stop()
+	get_mail_service().stop()
+
 	for thread in threads:
 		if thread.is_alive():
 			level = logging.DEBUG if manually_interrupted else logging.WARNING
 			logging.log(level, 'Thread "%s" was still running…', thread.name)
 	
 	logging.info('Exiting…')
+	TRACER.stop()
+	stop_logging()
 
 def load_config(fp, default: Config|None = None) -> Config:
 	try:
@@ -69,10 +127,17 @@ def load_config(fp, default: Config|None = None) -> Config:
 			logging.warning(f'{msg}: %s', fp, e.args[0])
 			return default
 
-def update_config(config: Config, modules: list[tuple[Module, ModuleConfig]]) -> None:
-	for module, cfg in modules:
-		cfg.load(config.module_data(module.name), config)
-		module.update_config(cfg)
+def update_config(config: Config, modules: list[tuple[Module, ModuleConfig]], timer: StartupTimer|None = None) -> None:
+	# modules are configured concurrently, so the logins and connections of their clients overlap
+	def _(module: Module, cfg: ModuleConfig):
+		with timer.phase(f'init.{module.name}') if timer is not None else nullcontext():
+			cfg.load(config.module_data(module.name), config)
+			module.update_config(cfg)
+
+	with ThreadPoolExecutor(max_workers=max(1, len(modules)), thread_name_prefix='Thread-init') as executor:
+		futures = [executor.submit(_, module, cfg) for module, cfg in modules]
+	for future in futures:
+		future.result()
 
 
 if __name__ == '__main__':
@@ -1,102 +1,307 @@
 import json
+import hashlib
+import logging
 import mgrs
-from paho.mqtt.client import Client as MQTTClient, MQTTMessage
-from paho.mqtt.reasoncodes import ReasonCode
+from time import perf_counter, monotonic, time_ns
+from concurrent.futures import Future
+from paho.mqtt.client import MQTTMessage
 
-from config import Config, load_toml_data, HermineConfig, MQTTConfig, TOMLDict
+from config import Config, load_toml_data, HermineConfig, GroupalarmConfig, MQTTConfig, TemplatesConfig, TOMLDict
 from modules.module import ModuleConfig, Module
-from modules.clients import get_hermine_client, get_mqtt_client
-from modules.utils import parse_datetime
+from modules.coordination import Mode, get_coordinator
+from modules.clients import get_hermine_client, get_hermine_dispatcher, get_hermine_directory, get_groupalarm_client, get_mqtt_client
+from modules.dispatcher import Priority
+from modules.utils import parse_datetime, parallel
+from modules.templates import MessageTemplates, MessageBuilder
+from modules.logs import Payload
+from modules.archive import ArchivedAlarm, open_archive, replay
+from modules.geodata import Enrichment, open_geodata
+from modules.incidents import IncidentChannels
+from modules.roster import get_roster
+from modules.scheduler import get_scheduler
+from lib.metrics import Counter, Histogram
+from lib.tracing import TRACER, CONSUMER, PRODUCER, NOOP_SPAN, Span, NoopSpan, use_span
+
+
+ALARM_LATENCY = Histogram('alarm_latency_seconds', 'Time from receiving an alarm via MQTT until Hermine acknowledged it', ('module',))
+UPSTREAM_DELAY = Histogram('alarm_upstream_delay_seconds', 'Time from the start of a Groupalarm event until its alarm was received via MQTT', ('module',))
+ALARMS = Counter('alarms', 'Received alarm messages', ('module', 'result'))
+
+
+TEMPLATES = {
+	'alarm': {
+		'header': '🚨 **{event[name]}**\n_{event[severity][icon]} {event[severity][name]}_\n\n{message}',
+		'location': '\n\n_{address}_\n_{mgrs}_\n_{latitude}°N {longitude}°O_',
+		# in place of the address if the alarm has none
+		'nearest': '{place[name]}, {place[municipality]} (≈ {distance:.0f} m)',
+		'unterkunft': '\n_{distance:.1f} km Luftlinie von der Unterkunft_',
+	},
+	'incident': {
+		'channel': '{start:%Y-%m-%d %H:%M} {event[name]}',
+		'invite': 'Einsatz: {event[name]}',
+	},
+}
 
 
 class _Config(ModuleConfig):
 	hermine: HermineConfig
+	groupalarm: GroupalarmConfig
 	mqtt: MQTTConfig
+	templates: TemplatesConfig
 
 	topic: str
 	groupalarm_unit: int|None
 	groupalarm_label: int|None
 	hermine_channel: int
+	archive: str|None
+	geodata: str|None
+	geodata_max_distance: float
+	unterkunft: tuple[float, float]|None
+	incident_company: int|None
+	incident_severities: list[str]
+	incident_labels: list[int]
+	incident_unit_channels: dict[int, int]
+	incident_budget: float
 
 	def load(self, data: TOMLDict, cfg: Config) -> None:
 		self.hermine = load_toml_data(data.get('hermine'), cfg.hermine)
+		self.groupalarm = load_toml_data(data.get('groupalarm'), cfg.groupalarm)
 		self.mqtt = load_toml_data(data.get('mqtt'), cfg.mqtt)
+		self.templates = load_toml_data(data.get('templates'), cfg.templates)
 
 		self.set_value('topic', data)
 		self.set_value('groupalarm_unit', data, default=None)
 		self.set_value('groupalarm_label', data, default=None)
 		self.set_value('hermine_channel', data)
+		self.set_value('archive', data, default=None)
+		# index built with `python geodata.py build`, the nearest place within the distance (in meters) is added to alarms
+		self.set_value('geodata', data, default=None)
+		self.set_value('geodata_max_distance', data, default=2000.0, converter=float)
+		self.set_value('unterkunft', data, default=None, converter=self._conv_loc)
+
+		# a channel of this Hermine company is created for every alarm of these severities (names, all if empty), and
+		# the members of these Groupalarm labels and of the Hermine channels of the alarmed units are invited
+		self.set_value('incident_company', data, default=None)
+		self.set_value('incident_severities', data, default=[])
+		self.set_value('incident_labels', data, default=[])
+		self.set_value('incident_unit_channels', data, default={}, converter=self._conv_unit_channels)
+		# seconds from receiving an alarm until its channel should be ready
+		self.set_value('incident_budget', data, default=30.0, converter=float)
+
+	def _conv_loc(self, loc: TOMLDict) -> tuple[float, float]:
+		return (float(loc['latitude']), float(loc['longitude']))
+
+	def _conv_unit_channels(self, channels: TOMLDict) -> dict[int, int]:
+		# TOML keys are strings
+		return {int(unit_id): int(channel_id) for unit_id, channel_id in channels.items()}
 
 
 class Alarmierung(Module[_Config]):
+	# every replica receives the alarms, the first one to claim an alarm forwards it
+	coordination_mode = Mode.ACTIVE
+
+	# the last alarm that was forwarded, for queries of other modules
+	last_alarm: dict|None = None
 
 	def init(self) -> None:
-		self.hermine = get_hermine_client(self.config.hermine.device_id, self.config.hermine.username, self.config.hermine.password, self.config.hermine.encryption_password)
-		self.mqtt = get_mqtt_client(self.config.mqtt.host, self.config.mqtt.port, self.config.mqtt.use_ssl, self.config.mqtt.username, self.config.mqtt.password, self.config.mqtt.client_id)
+		self.hermine, self.mqtt = parallel(
+			lambda: get_hermine_client(self.config.hermine.device_id, self.config.hermine.username, self.config.hermine.password, self.config.hermine.encryption_password),
+			lambda: get_mqtt_client(self.config.mqtt.host, self.config.mqtt.port, self.config.mqtt.use_ssl, self.config.mqtt.username, self.config.mqtt.password, get_coordinator().unique(self.config.mqtt.client_id)),
+		)
+		self.outbox = get_hermine_dispatcher(self.hermine, self.config.hermine.username, self.config.hermine.send_rate, self.config.hermine.send_burst, self.config.hermine.target_send_rate, self.config.hermine.target_send_burst, self.config.hermine.send_retries)
+
+		self.templates = MessageTemplates(TEMPLATES, self.config.templates)
+		self.enrichment = Enrichment(
+			open_geodata(self.config.geodata) if self.config.geodata is not None else None,
+			self.config.unterkunft,
+			max_distance=self.config.geodata_max_distance,
+		)
+
+		self.incidents = None
+		if self.config.incident_company is None:
+			get_scheduler().cancel(f'{self.name}.incidents')
+		else:
+			self.incidents = IncidentChannels(
+				self.name,
+				self.hermine,
+				self.outbox,
+				get_hermine_directory(self.hermine, self.config.hermine.directory_refresh_interval),
+				get_roster(get_groupalarm_client(self.config.groupalarm.api_key)) if len(self.config.incident_labels) > 0 else None,
+				self.templates,
+				company_id=self.config.incident_company,
+				labels=self.config.incident_labels,
+				unit_channels=self.config.incident_unit_channels,
+				budget=self.config.incident_budget,
+			)
+			self.incidents.prepare()
+			# after the directory and the roster were refreshed
+			get_scheduler().cron('7 * * * *', self.incidents.prepare, id=f'{self.name}.incidents', owner=self.name)
+
+		self.archive = open_archive(self.config.archive) if self.config.archive is not None else None
+		# so the last alarm is known right after a restart
+		if self.archive is not None and self.last_alarm is None:
+			last = self.archive.last()
+			if len(last) > 0 and last[0].message is not None:
+				self.last_alarm = last[0].payload
 
 	def run(self) -> None:
-		@self.mqtt.connect_callback()
-		def _(client: MQTTClient, userdata, connect_flags, reason_code: ReasonCode, properties):
-			if reason_code == 0:
-				self.logger.debug('Successfully connected to MQTT broker at "%s:%d"', client.host, client.port)
-			else:
-				self.logger.error('Failed to connect to MQTT broker: %s', reason_code)
-			
-			client.subscribe(self.config.topic)
-		
-		@self.mqtt.disconnect_callback()
-		def _(client: MQTTClient, userdata, disconnect_flags, reason_code: ReasonCode, properties):
-			self.logger.debug('Disconnected from MQTT broker: %s', reason_code)
-		
-		@self.mqtt.message_callback()
-		def _(client: MQTTClient, userdata, msg: MQTTMessage):
-			self._handle_message(json.loads(msg.payload.decode()))
-
-		self.mqtt.loop_forever(retry_first_connection=True)
+		def _(msg: MQTTMessage):
+			received = perf_counter()
+			# paho stamps messages with `time.monotonic()` when it reads them from the socket
+			trace = TRACER.start_trace('alarm', kind=CONSUMER, start=time_ns() - int((monotonic() - msg.timestamp) * 1e9), module=self.name, topic=msg.topic)
+
+			with use_span(trace), TRACER.span('alarm.decode', size=len(msg.payload)):
+				data = json.loads(msg.payload.decode())
+			# every update of an event goes to the replica that claimed it first, which has its incident channel
+			event_id = data.get('event', {}).get('id')
+			key = f'event:{event_id}' if event_id is not None else hashlib.sha1(msg.payload).hexdigest()
+
+			# handled later if another replica should forward it, but does not confirm that in time
+			if not self.coordination.handle(key, lambda: self._handle_message(data, received=received, trace=trace)):
+				self.logger.debug('Alarm is forwarded by another replica')
+				trace.set_attribute('alarm.result', 'other_replica')
+				trace.finish()
+
+		self.mqtt.subscribe(self.config.topic, _)
+		self.mqtt.loop_forever()
 
 		self.logger.info('Module finished!')
 	
-	def _handle_message(self, data: dict) -> None:
-		if any(conf is not None for conf in [
-			self.config.groupalarm_unit,
-			self.config.groupalarm_label,
-		]):
-			is_ok: bool = False
-			
-			if self.config.groupalarm_unit is not None:
-				if self.config.groupalarm_unit in (int(unit['id']) for unit in data['alarmResources']['units']):
-					is_ok = True
-			if self.config.groupalarm_label is not None:
-				if self.config.groupalarm_label in (int(label['label']['id']) for label in data['alarmResources']['labels']):
-					is_ok = True
-			
+	def replay(self, alarms: list[ArchivedAlarm], *, channel: int, speed: float = 1.0) -> int:
+		"""
+		Forward archived alarms again to the Hermine channel `channel` at `speed` times the original pace, e.g. for
+		load tests; returns their number.
+		"""
+		futures: list[Future] = []
+
+		def _(alarm: ArchivedAlarm):
+			future = self._handle_message(alarm.payload, received=perf_counter(), archive=False, channel=channel)
+			if future is not None:
+				futures.append(future)
+
+		count = replay(alarms, _, speed=speed)
+		for future in futures:
+			future.exception()
+		self.logger.info('Replayed %d alarms', count)
+		return count
+
+	def _handle_message(self, data: dict, *, received: float|None = None, archive: bool = True, channel: int|None = None, trace: Span|NoopSpan = NOOP_SPAN) -> Future|None:
+		trace.set_attribute('event.id', data.get('event', {}).get('id'))
+		with use_span(trace):
+			with TRACER.span('alarm.filter'):
+				is_ok = self._filter(data)
 			if not is_ok:
-				self.logger.debug('Ignoring alarm message "%s"', data['message'])
+				self.logger.debug('Ignoring alarm message "%s"', Payload(data['message']))
+				ALARMS.labels(self.name, 'ignored').inc()
+				if archive and self.archive is not None:
+					self.archive.append(data, None)
+				trace.set_attribute('alarm.result', 'ignored')
+				trace.finish()
+				return None
+
+			# replayed alarms were raised long ago
+			if archive:
+				delay = (trace.start if trace.recording else time_ns()) / 1e9 - parse_datetime(data['event']['startDate']).timestamp()
+				UPSTREAM_DELAY.labels(self.name).observe(max(0.0, delay))
+				trace.set_attribute('alarm.upstream_delay', delay)
+
+			self.logger.info('Received message for event: %s', data['event']['name'])
+			# replayed alarms are not the last one
+			if archive:
+				self.last_alarm = data
+
+			with TRACER.span('alarm.format') as span:
+				message, location = render_alarm(self.templates, data, self.enrichment)
+				chunks = message.split()
+				span.set_attribute('chunks', len(chunks))
+			for i, chunk in enumerate(chunks):
+				self.logger.debug('Sending message to Hermine: %s', Payload(chunk))
+				# from queueing the chunk until Hermine acknowledged it, the dispatcher adds the requests below it
+				send = TRACER.start_span('alarm.send', kind=PRODUCER, chunk=i)
+				with use_span(send):
+					future = self.outbox.send_msg(('channel', channel if channel is not None else self.config.hermine_channel), chunk, priority=Priority.ALARM, dedup_key=data['event'].get('id'), location=location if i == 0 else None, is_styled=True)
+				future.add_done_callback(lambda future, send=send: _finish(send, future))
+
+			severity = data['event'].get('severity', {}).get('name')
+			if archive and self.incidents is not None and (len(self.config.incident_severities) == 0 or severity in self.config.incident_severities):
+				self.incidents.provision(data, chunks, location, received=received if received is not None else perf_counter(), trace=trace)
+
+			# archived once it is on its way, so writing to disk never delays an alarm
+			if archive and self.archive is not None:
+				with TRACER.span('alarm.archive'):
+					self.archive.append(data, chunks)
+
+		# chunks to the same channel are sent in order, so the alarm is delivered once the last one is acknowledged
+		def _(future):
+			trace.add_event('ack')
+			_finish(trace, future)
+			if future.exception() is not None:
+				self.logger.error('Failed to forward alarm "%s": %s', data['event']['name'], future.exception())
+				ALARMS.labels(self.name, 'failed').inc()
 				return
+			ALARMS.labels(self.name, 'forwarded').inc()
+			if received is not None:
+				ALARM_LATENCY.labels(self.name).observe(perf_counter() - received)
+		future.add_done_callback(_)
+		return future
 
-		time = parse_datetime(data['event']['startDate'])
-
-		opt_content = data.get('optionalContent')
-		location = None
-		if opt_content is not None and opt_content.get('latitude') is not None and opt_content.get('longitude') is not None:
-			lat = float(opt_content['latitude'])
-			lon = float(opt_content['longitude'])
-			location = (
-				lat,
-				lon,
-				opt_content.get('address', '-' * 15),
-				_format_mgrs(lat, lon),
-			)
-		
-		self.logger.info('Received message for event: %s', data['event']['name'])
+	def _filter(self, data: dict) -> bool:
+		if self.config.groupalarm_unit is None and self.config.groupalarm_label is None:
+			return True
+		if self.config.groupalarm_unit is not None:
+			if self.config.groupalarm_unit in (int(unit['id']) for unit in data['alarmResources']['units']):
+				return True
+		if self.config.groupalarm_label is not None:
+			if self.config.groupalarm_label in (int(label['label']['id']) for label in data['alarmResources']['labels']):
+				return True
+		return False
+
+def _finish(span: Span|NoopSpan, future: Future) -> None:
+	if future.exception() is not None:
+		span.set_error(future.exception())
+	span.finish()
+
+def check_rendering(templates: MessageTemplates, alarms: list[ArchivedAlarm], enrichment: Enrichment|None = None) -> int:
+	"""Render archived alarms again and log the ones that differ from the message sent back then; returns their number."""
+	differences = 0
+	for alarm in alarms:
+		if alarm.message is None:
+			continue
+		chunks = render_alarm(templates, alarm.payload, enrichment)[0].split()
+		if chunks != alarm.message:
+			differences += 1
+			logging.warning('Alarm "%s" of %s renders differently now:\n%s\n---\n%s', alarm.payload['event']['name'], alarm.received, '\n'.join(alarm.message), '\n'.join(chunks))
+	return differences
 
-		message = f'🚨 **{data["event"]["name"]}**\n_{data["event"]["severity"]["icon"]} {data["event"]["severity"]["name"]}_\n\n{data["message"]}'
-		if location is not None:
-			message += f'\n\n_{location[2]}_\n_{location[3]}_\n_{location[0]}°N {location[1]}°O_'
-		message += '\n\n_🤖 automatically sent message_'
+def render_alarm(templates: MessageTemplates, data: dict, enrichment: Enrichment|None = None) -> tuple[MessageBuilder, tuple|None]:
+	"""The message for the alarm `data` and the location attached to it, if any."""
+	opt_content = data.get('optionalContent')
+	location = None
+	from_unterkunft = None
+	if opt_content is not None and opt_content.get('latitude') is not None and opt_content.get('longitude') is not None:
+		lat = float(opt_content['latitude'])
+		lon = float(opt_content['longitude'])
+		address = opt_content.get('address')
+		if enrichment is not None:
+			if address is None:
+				nearest = enrichment.nearest(lat, lon)
+				if nearest is not None:
+					address = templates.builder('alarm').add('nearest', place=nearest[0], distance=nearest[1]).build()
+			from_unterkunft = enrichment.from_unterkunft(lat, lon)
+		location = (
+			lat,
+			lon,
+			address if address is not None else '-' * 15,
+			_format_mgrs(lat, lon),
+		)
 
-		self.logger.debug('Sending message to Hermine: %s', message)
-		self.hermine.send_msg(('channel', self.config.hermine_channel), message, location=location, is_styled=True)
+	message = templates.builder('alarm').add('header', event=data['event'], message=data['message'], alarm=data)
+	if location is not None:
+		message.add('location', latitude=location[0], longitude=location[1], address=location[2], mgrs=location[3])
+		if from_unterkunft is not None:
+			message.add('unterkunft', distance=from_unterkunft / 1000)
+	message.add('footer')
+	return message, location
 
 def _format_mgrs(lat: float, lon: float, precision: int = 5) -> str:
 	if precision < 0 or precision > 5:
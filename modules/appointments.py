@@ -0,0 +1,237 @@
+from collections.abc import Callable, Iterable, Iterator
+
+import csv
+import time
+import random
+import hashlib
+import logging
+import requests
+from datetime import datetime, tzinfo
+from dateutil.tz import tzlocal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lib.groupalarm import GroupalarmClient
+from modules.calendars import ParsedCalendar
+from modules.utils import parse_datetime
+
+
+# transient failures of a single request, the idempotency key makes retrying creations safe
+RETRIES = 3
+RETRY_DELAY = 0.5
+
+
+class PlannedAppointment:
+	__slots__ = ('name', 'start', 'end', 'description', 'label_ids', 'is_public')
+
+	def __init__(self, name: str, start: datetime, end: datetime, *, description: str = '', label_ids: list[int]|None = None, is_public: bool = False):
+		if end < start:
+			raise ValueError(f'Appointment "{name}" ends before it starts')
+		self.name = name
+		self.start = start
+		self.end = end
+		self.description = description
+		self.label_ids = sorted(label_ids) if label_ids is not None else []
+		self.is_public = is_public
+
+	@property
+	def key(self) -> tuple[str, datetime]:
+		"""Identifies the appointment in Groupalarm, everything else may be changed by an update."""
+		return self.name, self.start
+
+	@property
+	def idempotency_key(self) -> str:
+		data = '\x1f'.join((self.name, self.start.isoformat(), self.end.isoformat(), self.description, ','.join(map(str, self.label_ids)), str(self.is_public)))
+		return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+	def differs(self, existing: dict) -> bool:
+		"""Whether the appointment `existing` with the same key has to be updated, fields it lacks are not compared."""
+		if parse_datetime(existing['endDate']) != self.end:
+			return True
+		if (existing.get('description') or '') != self.description:
+			return True
+		if 'labelIDs' in existing and sorted(existing['labelIDs'] or []) != self.label_ids:
+			return True
+		return 'isPublic' in existing and existing['isPublic'] != self.is_public
+
+	def create(self, client: GroupalarmClient) -> dict:
+		return client.create_appointment(name=self.name, description=self.description, start=self.start, end=self.end, label_ids=self.label_ids, is_public=self.is_public, idempotency_key=self.idempotency_key)
+
+	def update(self, client: GroupalarmClient, appointment_id: int) -> dict:
+		return client.update_appointment(appointment_id, name=self.name, description=self.description, start=self.start, end=self.end, label_ids=self.label_ids, is_public=self.is_public)
+
+	def __repr__(self) -> str:
+		return f'PlannedAppointment({self.name!r}, {self.start.isoformat()}, {self.end.isoformat()})'
+
+
+class Changes:
+	"""What has to be done to bring Groupalarm in line with a plan."""
+
+	def __init__(self):
+		self.create: list[PlannedAppointment] = []
+		# id of the existing appointment and how it should be
+		self.update: list[tuple[int, PlannedAppointment]] = []
+		self.delete: list[dict] = []
+		self.unchanged = 0
+
+	def __len__(self) -> int:
+		return len(self.create) + len(self.update) + len(self.delete)
+
+
+class Progress:
+	__slots__ = ('total', 'done', 'created', 'updated', 'deleted', 'failed')
+
+	def __init__(self, total: int):
+		self.total = total
+		self.done = 0
+		self.created = 0
+		self.updated = 0
+		self.deleted = 0
+		self.failed = 0
+
+	def __str__(self) -> str:
+		return f'{self.done}/{self.total}: {self.created} created, {self.updated} updated, {self.deleted} deleted, {self.failed} failed'
+
+
+def read_plan(path: str, *, tz: tzinfo|None = None, label_ids: list[int]|None = None, until: datetime|None = None) -> Iterator[PlannedAppointment]:
+	"""The appointments of a CSV or ICS file, by its extension; `label_ids` for those that do not name their own."""
+	if path.lower().endswith(('.ics', '.ical', '.ifb')):
+		return read_ics(path, tz=tz, label_ids=label_ids, until=until)
+	return read_csv(path, tz=tz, label_ids=label_ids)
+
+def read_csv(path: str, *, tz: tzinfo|None = None, label_ids: list[int]|None = None) -> Iterator[PlannedAppointment]:
+	"""
+	Appointments from a CSV file with the columns `name`, `start` and `end` (ISO 8601, in `tz` unless they have an
+	offset) and optionally `description`, `labels` (ids separated by spaces) and `public` (`1`/`true`/`ja`).
+	"""
+	with open(path, newline='', encoding='utf-8-sig') as fp:
+		for line, row in enumerate(csv.DictReader(fp), start=2):
+			try:
+				labels = row.get('labels') or ''
+				yield PlannedAppointment(
+					row['name'].strip(),
+					_localized(datetime.fromisoformat(row['start'].strip()), tz),
+					_localized(datetime.fromisoformat(row['end'].strip()), tz),
+					description=row.get('description') or '',
+					label_ids=[int(label) for label in labels.replace(',', ' ').split()] if labels.strip() else label_ids,
+					is_public=(row.get('public') or '').strip().lower() in ('1', 'true', 'yes', 'ja', 'x'),
+				)
+			except (KeyError, TypeError, ValueError) as e:
+				raise ValueError(f'{path}, line {line}: {e}') from e
+
+def read_ics(path: str, *, tz: tzinfo|None = None, label_ids: list[int]|None = None, until: datetime|None = None) -> Iterator[PlannedAppointment]:
+	"""
+	Appointments from the events of an ICS file, with every occurrence of recurring ones starting up to `until`, which
+	is required if an event recurs forever. Floating times are in the timezone the calendar names, else in `tz`.
+	"""
+	with open(path, encoding='utf-8-sig') as fp:
+		content = fp.read()
+	try:
+		calendar = ParsedCalendar(content, tz=tz or tzlocal())
+	except (AttributeError, KeyError, ValueError) as e:
+		raise ValueError(f'{path}: {e}') from e
+	if calendar.endless and until is None:
+		raise ValueError(f'{path}: events recur without an end, import them up to a date')
+
+	start = calendar.start
+	if start is None:
+		return
+	for event in calendar.events(start, _localized(until, tz) if until is not None else None):
+		yield PlannedAppointment(
+			event.summary or '',
+			event.start,
+			event.end,
+			description=event.description or '',
+			label_ids=label_ids,
+			is_public=str(event.component.get('CLASS', '')).upper() == 'PUBLIC',
+		)
+
+def diff(planned: Iterable[PlannedAppointment], existing: Iterable[dict], *, prune: bool = False) -> Changes:
+	"""
+	Match `planned` with the `existing` appointments by name and start. Existing appointments that are not planned
+	(including duplicates of planned ones) are only deleted with `prune`, so a partial plan can be imported as well.
+	"""
+	changes = Changes()
+	plan: dict[tuple[str, datetime], PlannedAppointment] = {}
+	for appointment in planned:
+		if appointment.key in plan:
+			logging.getLogger('appointments').warning('"%s" at %s is planned more than once, importing the last one', appointment.name, appointment.start)
+		plan[appointment.key] = appointment
+
+	for appointment in existing:
+		planned_appointment = plan.pop((appointment['name'], parse_datetime(appointment['startDate'])), None)
+		if planned_appointment is None:
+			if prune:
+				changes.delete.append(appointment)
+		elif planned_appointment.differs(appointment):
+			changes.update.append((int(appointment['id']), planned_appointment))
+		else:
+			changes.unchanged += 1
+	changes.create.extend(plan.values())
+	return changes
+
+def apply(client: GroupalarmClient, changes: Changes, *, workers: int = 8, progress: Callable[[Progress], None]|None = None) -> Progress:
+	"""
+	Make the `changes` with at most `workers` requests at a time, calling `progress` after each of them. Failed
+	requests are logged and counted, not raised, so one bad appointment does not stop the rest.
+	"""
+	logger = logging.getLogger('appointments')
+	state = Progress(len(changes))
+
+	with ThreadPoolExecutor(max_workers=max(1, min(workers, client.max_connections)), thread_name_prefix='Thread-appointments') as executor:
+		futures = {}
+		for appointment in changes.create:
+			futures[executor.submit(_retried, appointment.create, client)] = ('created', appointment.name, appointment.start)
+		for appointment_id, appointment in changes.update:
+			futures[executor.submit(_retried, appointment.update, client, appointment_id)] = ('updated', appointment.name, appointment.start)
+		for existing in changes.delete:
+			futures[executor.submit(_retried, client.delete_appointment, int(existing['id']))] = ('deleted', existing['name'], existing['startDate'])
+
+		for future in as_completed(futures):
+			action, name, start = futures[future]
+			state.done += 1
+			try:
+				future.result()
+			except Exception as e:
+				state.failed += 1
+				logger.error('Appointment "%s" at %s could not be %s: %s', name, start, action, e)
+			else:
+				setattr(state, action, getattr(state, action) + 1)
+				logger.debug('Appointment "%s" at %s %s', name, start, action)
+			if progress is not None:
+				progress(state)
+
+	return state
+
+def import_plan(client: GroupalarmClient, planned: Iterable[PlannedAppointment], *, prune: bool = False, dry_run: bool = False, workers: int = 8, progress: Callable[[Progress], None]|None = None) -> tuple[Changes, Progress|None]:
+	"""Diff `planned` against the existing appointments of its timespan and apply the changes unless `dry_run`."""
+	plan = list(planned)
+	if len(plan) == 0:
+		return Changes(), None
+
+	start = min(appointment.start for appointment in plan)
+	end = max(appointment.end for appointment in plan)
+	existing = [
+		appointment for appointment in client.get_appointments(start=start, end=end, type='organization')
+		if start <= parse_datetime(appointment['startDate']) <= end
+	]
+	changes = diff(plan, existing, prune=prune)
+	logging.getLogger('appointments').info('%d appointments planned from %s to %s: %d to create, %d to update, %d to delete, %d unchanged', len(plan), start, end, len(changes.create), len(changes.update), len(changes.delete), changes.unchanged)
+	if dry_run or len(changes) == 0:
+		return changes, None
+	return changes, apply(client, changes, workers=workers, progress=progress)
+
+
+def _retried(func: Callable, *args):
+	for attempt in range(RETRIES + 1):
+		try:
+			return func(*args)
+		except (requests.ConnectionError, requests.Timeout):
+			if attempt == RETRIES:
+				raise
+			# full jitter, so the workers do not retry in lockstep
+			time.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+
+def _localized(value: datetime, tz: tzinfo|None) -> datetime:
+	if value.tzinfo is not None:
+		return value
+	return value.replace(tzinfo=tz) if tz is not None else value.astimezone()
@@ -0,0 +1,170 @@
+from collections.abc import Callable, Iterable
+
+import os
+import json
+import time
+import zlib
+import bisect
+import struct
+import logging
+from datetime import datetime, timezone
+from threading import Lock
+
+from modules.utils import cached
+from lib.metrics import Counter
+
+
+ARCHIVED_ALARMS = Counter('archived_alarms', 'Alarms appended to the archive', ('archive',))
+
+# every record in the log: length and CRC-32 of the zlib compressed JSON that follows
+_RECORD = struct.Struct('<II')
+# every entry of the index: time received, event id and offset of the record in the log
+_ENTRY = struct.Struct('<dqQ')
+
+
+class ArchivedAlarm:
+	__slots__ = ('received', 'event_id', 'payload', 'message')
+
+	def __init__(self, received: datetime, event_id: int, payload: dict, message: list[str]|None):
+		self.received = received
+		self.event_id = event_id
+		self.payload = payload
+		# the chunks sent to Hermine, None if the alarm was ignored
+		self.message = message
+
+	def to_json(self) -> dict:
+		return {'received': self.received.isoformat(), 'event_id': self.event_id, 'payload': self.payload, 'message': self.message}
+
+
+class AlarmArchive:
+	"""
+	Append-only log of received alarms at `path`, with a fixed-size index at `path.idx` that is kept in memory, so
+	queries by time or event id only read the records they return.
+
+	A record that was cut off by a crash is dropped when the archive is opened, and records missing from the index are
+	added back to it. Times are clamped to never decrease, so the index stays sorted if the clock is set back.
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+		self.logger = logging.getLogger('archive')
+
+		self._lock = Lock()
+		self._log = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o640)
+		self._index = os.open(f'{path}.idx', os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o640)
+
+		self._times: list[float] = []
+		self._offsets: list[int] = []
+		self._events: dict[int, list[int]] = {}
+		self._load()
+
+	def append(self, payload: dict, message: list[str]|None, *, received: float|None = None) -> None:
+		body = zlib.compress(json.dumps({'payload': payload, 'message': message}, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+		event_id = _event_id(payload)
+
+		with self._lock:
+			received = max(received if received is not None else time.time(), self._times[-1] if self._times else 0.0)
+			offset = os.fstat(self._log).st_size
+			os.write(self._log, _RECORD.pack(len(body), zlib.crc32(body)) + body)
+			os.write(self._index, _ENTRY.pack(received, event_id, offset))
+			self._add(received, event_id, offset)
+		ARCHIVED_ALARMS.labels(self.path).inc()
+
+	def query(self, *, since: datetime|None = None, until: datetime|None = None, event_id: int|None = None, limit: int|None = None) -> list[ArchivedAlarm]:
+		"""Archived alarms received in [since, until) and of event `event_id`, oldest first; the newest `limit` ones."""
+		with self._lock:
+			start = bisect.bisect_left(self._times, since.timestamp()) if since is not None else 0
+			end = bisect.bisect_left(self._times, until.timestamp()) if until is not None else len(self._times)
+			if event_id is not None:
+				indices = [i for i in self._events.get(event_id, []) if start <= i < end]
+			else:
+				indices = range(start, end)
+			if limit is not None:
+				indices = indices[-limit:] if limit > 0 else []
+			entries = [(self._times[i], self._offsets[i]) for i in indices]
+
+		return [self._read(received, offset) for received, offset in entries]
+
+	def last(self, n: int = 1) -> list[ArchivedAlarm]:
+		return self.query(limit=n)
+
+	def close(self) -> None:
+		os.close(self._log)
+		os.close(self._index)
+
+	def __len__(self) -> int:
+		return len(self._offsets)
+
+	def _add(self, received: float, event_id: int, offset: int) -> None:
+		self._events.setdefault(event_id, []).append(len(self._offsets))
+		self._times.append(received)
+		self._offsets.append(offset)
+
+	def _read(self, received: float, offset: int) -> ArchivedAlarm:
+		length, _ = _RECORD.unpack(os.pread(self._log, _RECORD.size, offset))
+		data = json.loads(zlib.decompress(os.pread(self._log, length, offset + _RECORD.size)))
+		return ArchivedAlarm(datetime.fromtimestamp(received, timezone.utc), _event_id(data['payload']), data['payload'], data['message'])
+
+	def _load(self) -> None:
+		index = os.pread(self._index, os.fstat(self._index).st_size, 0)
+		# an entry cut off by a crash is written again below
+		valid = len(index) - len(index) % _ENTRY.size
+		for received, event_id, offset in _ENTRY.iter_unpack(index[:valid]):
+			self._add(received, event_id, offset)
+		if valid < len(index):
+			os.ftruncate(self._index, valid)
+
+		# records appended to the log whose index entry was not written
+		size = os.fstat(self._log).st_size
+		offset = 0
+		if self._offsets:
+			length, _ = _RECORD.unpack(os.pread(self._log, _RECORD.size, self._offsets[-1]))
+			offset = self._offsets[-1] + _RECORD.size + length
+		while offset < size:
+			header = os.pread(self._log, _RECORD.size, offset)
+			if len(header) < _RECORD.size:
+				break
+			length, crc = _RECORD.unpack(header)
+			body = os.pread(self._log, length, offset + _RECORD.size)
+			if len(body) < length or zlib.crc32(body) != crc:
+				break
+
+			event_id = _event_id(json.loads(zlib.decompress(body))['payload'])
+			received = max(os.fstat(self._log).st_mtime, self._times[-1] if self._times else 0.0)
+			os.write(self._index, _ENTRY.pack(received, event_id, offset))
+			self._add(received, event_id, offset)
+			offset += _RECORD.size + length
+
+		if offset < size:
+			self.logger.warning('Dropping %d bytes of an incomplete record at the end of %s', size - offset, self.path)
+			os.ftruncate(self._log, offset)
+
+
+@cached(close=lambda archive: archive.close())
+def open_archive(path: str) -> AlarmArchive:
+	return AlarmArchive(path)
+
+
+def replay(alarms: Iterable[ArchivedAlarm], handle: Callable[[ArchivedAlarm], None], *, speed: float = 1.0) -> int:
+	"""
+	Call `handle` with every alarm, keeping the intervals they were received at divided by `speed`, or without any
+	delay if it is 0; returns the number of alarms replayed.
+	"""
+	count = 0
+	start = time.monotonic()
+	first: float|None = None
+	for alarm in alarms:
+		received = alarm.received.timestamp()
+		if first is None:
+			first = received
+		if speed > 0:
+			delay = start + (received - first) / speed - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+		handle(alarm)
+		count += 1
+	return count
+
+def _event_id(payload: dict) -> int:
+	# 0 for payloads without a Groupalarm event id
+	return int(payload.get('event', {}).get('id') or 0)
@@ -1,104 +1,234 @@
 from typing import SupportsFloat
 from collections.abc import Iterator
 
-import time
-from schedule import Scheduler
+import logging
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
-from config import Config, load_toml_data, HermineConfig, GroupalarmConfig, TOMLDict
+from config import Config, load_toml_data, HermineConfig, GroupalarmConfig, TemplatesConfig, TOMLDict
 from modules.module import ModuleConfig, Module
-from modules.clients import get_hermine_client, get_groupalarm_client
-from modules.utils import parse_datetime, onetime_job
+from modules.coordination import Mode
+from modules.clients import get_hermine_client, get_hermine_dispatcher, get_groupalarm_client
+from modules.dispatcher import Priority
+from modules.utils import parse_datetime, parallel
+from modules.scheduler import Cron, get_scheduler
+from modules.templates import MessageTemplates
+from modules.logs import Payload
+from modules.roster import Person, get_roster
+from modules.webhooks import WebhookServer, get_webhook_server, is_loopback
+
+
+TEMPLATES = {
+	'event': {
+		'header': '📅 **{event[name]}**\n_{start:%A, %d.%m.%Y, %H:%M} – {end:%H:%M}_\n\n',
+		'participant': '- {name:<20} {status}\n',
+		'participant_feedback': '- {name:<20} {status} (_"{feedback}"_)\n',
+	},
+}
+
+# how far ahead appointments are synchronized between the weekly runs
+SYNC_HORIZON = timedelta(weeks=1)
+# webhooks often come in bursts, e.g. while an appointment is edited, so they are handled together after a pause
+WEBHOOK_DELAY = timedelta(seconds=5)
 
 
 class _Config(ModuleConfig):
 	hermine: HermineConfig
 	groupalarm: GroupalarmConfig
+	templates: TemplatesConfig
 
 	scheduled_time: str
 	reminder_time: timedelta
 	event_filters: list[str]
-	groupalarm_label: int|None
+	groupalarm_labels: list[int]
 	hermine_channel: int
 
 	run_on_startup: bool = False
 
+	adaptive_polling: bool
+	min_poll_interval: timedelta
+	max_poll_interval: timedelta
+	webhook_host: str
+	webhook_port: int|None
+	webhook_path: str
+	webhook_secret: str|None
+
 	def load(self, data: TOMLDict, cfg: Config) -> None:
 		self.hermine = load_toml_data(data.get('hermine'), cfg.hermine)
 		self.groupalarm = load_toml_data(data.get('groupalarm'), cfg.groupalarm)
+		self.templates = load_toml_data(data.get('templates'), cfg.templates)
 
 		self.set_value('scheduled_time', data, default='12:00')
 		self.set_value('reminder_time', data, default=timedelta(hours=10), converter=self._conv_remtime)
 		self.set_value('event_filters', data, default=[])
-		self.set_value('groupalarm_label', data, default=None)
+		self.set_value('groupalarm_labels', data, default=[])
 		self.set_value('hermine_channel', data)
 
+		# a single label can still be given the old way
+		if data.get('groupalarm_label') is not None:
+			self.groupalarm_labels = [*data.get('groupalarm_labels', []), data['groupalarm_label']]
+		self.groupalarm_labels = list(dict.fromkeys(self.groupalarm_labels))
+
 		self.set_value('run_on_startup', data, default=False)
+
+		self.set_value('adaptive_polling', data, default=False)
+		self.set_value('min_poll_interval', data, default=timedelta(minutes=5), converter=self._conv_minutes)
+		self.set_value('max_poll_interval', data, default=timedelta(hours=6), converter=self._conv_minutes)
+		if self.min_poll_interval > self.max_poll_interval:
+			raise ValueError('min_poll_interval must not be greater than max_poll_interval')
+		self.set_value('webhook_host', data, default='127.0.0.1')
+		self.set_value('webhook_port', data, default=None)
+		self.set_value('webhook_path', data, default='/groupalarm/appointments')
+		self.set_value('webhook_secret', data, default=None)
+		if self.webhook_port is not None and self.webhook_secret is None and not is_loopback(self.webhook_host):
+			raise ValueError('webhook_secret is required unless webhooks are only received on a loopback address')
+
+	@property
+	def event_driven(self) -> bool:
+		return self.adaptive_polling or self.webhook_port is not None
 	
 	def _conv_remtime(self, remtime: SupportsFloat) -> timedelta:
 		return timedelta(hours=float(remtime))
 
+	def _conv_minutes(self, minutes: SupportsFloat) -> timedelta:
+		if float(minutes) <= 0:
+			raise ValueError('poll intervals must be positive')
+		return timedelta(minutes=float(minutes))
+
 
 class Ausbildungsdienst(Module[_Config]):
+	coordination_mode = Mode.LEADER
+
+	_webhook: tuple[WebhookServer, str]|None = None
 
 	def init(self) -> None:
-		self.hermine = get_hermine_client(self.config.hermine.device_id, self.config.hermine.username, self.config.hermine.password, self.config.hermine.encryption_password)
-		self.groupalarm = get_groupalarm_client(self.config.groupalarm.api_key)
+		self.hermine, self.groupalarm = parallel(
+			lambda: get_hermine_client(self.config.hermine.device_id, self.config.hermine.username, self.config.hermine.password, self.config.hermine.encryption_password),
+			lambda: get_groupalarm_client(self.config.groupalarm.api_key),
+		)
+		self.outbox = get_hermine_dispatcher(self.hermine, self.config.hermine.username, self.config.hermine.send_rate, self.config.hermine.send_burst, self.config.hermine.target_send_rate, self.config.hermine.target_send_burst, self.config.hermine.send_retries)
+		self.templates = MessageTemplates(TEMPLATES, self.config.templates)
 
-		self.label_persons = {}
-		self.scheduler = Scheduler()
+		self.roster = get_roster(self.groupalarm)
 
-	def run(self) -> None:
-		self.scheduler.every().sunday.at(self.config.scheduled_time).do(self._weekly_run)
+		# jobs are identified by id, so re-registering them after a config change replaces the previous ones
+		self.scheduler = get_scheduler()
+		self.scheduler.handler(f'{self.name}.reminder', self._reminder_run)
+		self.scheduler.cron(Cron.weekly('sun', self.config.scheduled_time, self.scheduler.tz), self._weekly_run, id=f'{self.name}.weekly', owner=self.name)
 
+		if self._webhook is not None:
+			self._webhook[0].unroute(self._webhook[1])
+			self._webhook = None
+		if self.config.webhook_port is not None:
+			server = get_webhook_server(self.config.webhook_host, self.config.webhook_port)
+			server.route(self.config.webhook_path, self._on_webhook, secret=self.config.webhook_secret)
+			self._webhook = (server, self.config.webhook_path)
+
+		if self.config.event_driven:
+			self.scheduler.once(timedelta(0), self._sync, id=f'{self.name}.sync', owner=self.name)
+		else:
+			self.scheduler.cancel(f'{self.name}.sync')
+
+	def run(self) -> None:
 		if self.config.run_on_startup:
-			self.scheduler.run_all()
-		
-		while True:
-			self.scheduler.run_pending()
+			self._weekly_run()
 
-			idle_seconds = self.scheduler.idle_seconds or 1
-			self.logger.debug('Sleeping for %d seconds…', idle_seconds)
-			time.sleep(idle_seconds)
-		
 		self.logger.info('Module finished!')
 
-	def _run(self, timespan: timedelta) -> set[datetime]:
+	def upcoming_events(self, timespan: timedelta = timedelta(weeks=4)) -> list[dict]:
+		"""The appointments of the next `timespan` that pass the event filters, ordered by their start."""
+		data = self.groupalarm.get_appointments(start=datetime.now(), end=datetime.now() + timespan, type='organization')
+		return sorted(self._filter_events(data), key=lambda event: parse_datetime(event['startDate']))
+
+	def _run(self, timespan: timedelta, *, send: bool = True) -> set[datetime]:
 		event_starts = set()
 
 		data = self.groupalarm.get_appointments(start=datetime.now(), end=datetime.now() + timespan, type='organization')
 		for event in self._filter_events(data):
-			event_start = self._handle_event(event)
+			event_start = self._handle_event(event, send=send)
 			if event_start is not None:
 				event_starts.add(event_start)
 		
 		return event_starts
 	
 	def _weekly_run(self):
-		self._update_labels()
-		event_starts = self._run(timedelta(weeks=1))
-		for event_start in event_starts:
-			onetime_job(self.scheduler, (event_start - self.config.reminder_time).replace(tzinfo=None), self._run, self.config.reminder_time)
-	
-	def _update_labels(self) -> None:
-		self.label_persons.clear()
-
-		if self.config.groupalarm_label is not None:
-			data = self.groupalarm.get_label(self.config.groupalarm_label)
-			self.label_persons.update({
-				user['id']: user
-				for user in self.groupalarm.get_users()
-				if user['pending'] is False and user['id'] in data['assignees']
-			})
+		# standby replicas schedule the reminders as well, so they can send them if the leader fails in the meantime
+		leader = self.coordination.should_handle()
+		if not leader:
+			self.logger.debug('Not the leader, only scheduling reminders')
+
+		self.roster.refresh(self.config.groupalarm_labels)
+		event_starts = self._run(timedelta(weeks=1), send=leader)
+		self._reschedule(event_starts, timedelta(weeks=1))
+
+	def _sync(self):
+		"""Pick up appointments that were added, moved or cancelled since the weekly run and poll again."""
+		event_starts = None
+		try:
+			self.roster.refresh(self.config.groupalarm_labels)
+			event_starts = self._run(SYNC_HORIZON, send=False)
+		except Exception:
+			self.logger.exception('Failed to synchronize appointments')
 		else:
-			self.label_persons.update({
-				user['id']: user
-				for user in self.groupalarm.get_users()
-				if user['pending'] is False
-			})
+			self._reschedule(event_starts, SYNC_HORIZON)
+
+		if self.config.event_driven:
+			self.scheduler.once(self._poll_interval(event_starts), self._sync, id=f'{self.name}.sync', owner=self.name)
+
+	def _on_webhook(self, data: dict|None):
+		# replaces the pending poll, so a burst of notifications results in a single synchronization
+		self.scheduler.once(WEBHOOK_DELAY, self._sync, id=f'{self.name}.sync', owner=self.name)
+
+	def _poll_interval(self, event_starts: set[datetime]|None) -> timedelta:
+		"""
+		Polling is only a safety net while webhooks are received, else the interval shrinks as the next reminder gets
+		closer, so late changes are still picked up before it is sent; after failures it is retried soon.
+		"""
+		if event_starts is None:
+			return self.config.min_poll_interval
+		if self.config.webhook_port is not None:
+			return self.config.max_poll_interval
+
+		now = self.scheduler.now()
+		reminders = [start - self.config.reminder_time for start in event_starts if start - self.config.reminder_time > now]
+		if len(reminders) == 0:
+			return self.config.max_poll_interval
+		return min(self.config.max_poll_interval, max(self.config.min_poll_interval, (min(reminders) - now) / 4))
+
+	def _reschedule(self, event_starts: set[datetime], timespan: timedelta):
+		"""Bring the pending reminders of the next `timespan` in line with `event_starts`, leaving the unchanged ones alone."""
+		prefix = f'{self.name}.reminder.'
+		now = self.scheduler.now()
+		pending = {
+			job.id: job for job in self.scheduler.jobs(owner=self.name)
+			if job.id.startswith(prefix) and job.next_run > now and job.next_run + self.config.reminder_time <= now + timespan
+		}
+
+		added = 0
+		for event_start in event_starts:
+			if event_start - self.config.reminder_time <= now:
+				continue
+			id = f'{prefix}{event_start.isoformat()}'
+			if pending.pop(id, None) is None:
+				self.scheduler.once(event_start - self.config.reminder_time, f'{self.name}.reminder', id=id, owner=self.name)
+				added += 1
+		# the appointments were cancelled, moved or no longer have participants
+		for job in pending.values():
+			job.cancel()
+
+		if added > 0 or len(pending) > 0:
+			self.logger.info('Rescheduled reminders: %d added, %d cancelled', added, len(pending))
+
+	def _reminder_run(self):
+		if not self.coordination.should_handle():
+			self.logger.debug('Not the leader, skipping reminders')
+			return
+
+		# pending reminders are restored before the first weekly run after a restart, and the roster may be stale by now
+		self.roster.refresh(self.config.groupalarm_labels)
+		self._run(self.config.reminder_time)
 	
-	def _handle_event(self, event) -> datetime|None:
+	def _handle_event(self, event, *, send: bool = True) -> datetime|None:
 		tz = ZoneInfo(event['timezone'])
 		start = parse_datetime(event['startDate']).astimezone(tz)
 		end = parse_datetime(event['endDate']).astimezone(tz)
@@ -107,20 +237,28 @@ class Ausbildungsdienst(Module[_Config]):
 		if len(participants) == 0:
 			return None
 
-		self.logger.info('Found event: %s %s', event['name'], start)
+		# synchronizations look at the same events on every poll
+		self.logger.log(logging.INFO if send else logging.DEBUG, 'Found event: %s %s', event['name'], start)
+		if not send:
+			return start
 
-		message = f'📅 **{event["name"]}**\n_{start:%A, %d.%m.%Y, %H:%M} – {end:%H:%M}_\n\n'
-		for participant in participants:
-			user = self.label_persons[participant['userID']]
-			name = f'{user["name"]} {user["surname"]}'
-			message += f'- {name:<20} {_feedbackStatus(participant)}'
-			if len(participant["feedbackMessage"]) > 0:
-				message += f' (_"{participant["feedbackMessage"]}"_)'
-			message += '\n'
-		message += '\n\n_🤖 automatically sent message_'
-		
-		self.logger.debug('Sending message to Hermine: %s', message)
-		self.hermine.send_msg(('channel', self.config.hermine_channel), message, is_styled=True)
+		message = self.templates.builder('event').add('header', event=event, start=start, end=end)
+		for participant, user in participants:
+			message.add(
+				'participant_feedback' if len(participant['feedbackMessage']) > 0 else 'participant',
+				name=f'{user.name} {user.surname}',
+				status=_feedbackStatus(participant),
+				feedback=participant['feedbackMessage'],
+				user=user,
+			)
+		message.add('footer')
+
+		futures = []
+		for chunk in message.split():
+			self.logger.debug('Sending message to Hermine: %s', Payload(chunk))
+			futures.append(self.outbox.send_msg(('channel', self.config.hermine_channel), chunk, priority=Priority.REMINDER, is_styled=True))
+		for future in futures:
+			future.result()
 
 		return start
 
@@ -130,11 +268,18 @@ class Ausbildungsdienst(Module[_Config]):
 			return iter(events)
 		return (event for event in events if event['name'] in filters)
 
-	def _filter_participants(self, participants: list) -> list:
-		filters = self.label_persons.keys()
-		if len(filters) == 0:
-			return participants
-		return [person for person in participants if person['userID'] in filters]
+	def _filter_participants(self, participants: list) -> list[tuple[dict, Person]]:
+		"""The participants that are members of the configured labels (or active users), in their order."""
+		selected = self.roster.mask(participant['userID'] for participant in participants) & self.roster.members(self.config.groupalarm_labels)
+		if selected == 0:
+			return []
+
+		result = []
+		for participant in participants:
+			person = self.roster.get(participant['userID'])
+			if person is not None and selected >> person.index & 1:
+				result.append((participant, person))
+		return result
 
 def _feedbackStatus(participant) -> str:
 	if participant['feedback'] == 0:
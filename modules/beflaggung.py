@@ -1,46 +1,63 @@
 from typeguard import check_type
-from imap_tools.mailbox import BaseMailBox
 from imap_tools.message import MailMessage
 
-import time
 import re
+import logging
 import requests
-from imap_tools import MailBox, AND, consts
-from icalevents import icalevents
 from datetime import time as dtime, timedelta
 from astral import Degrees, Elevation, Observer, sun
 
-from config import Config, load_toml_data, IMAPConfig, HermineConfig, CalDAVConfig, TOMLDict
+from config import Config, load_toml_data, IMAPConfig, HermineConfig, CalDAVConfig, TemplatesConfig, TOMLDict
 from modules.module import ModuleConfig, Module
-from modules.clients import get_hermine_client, get_caldav_client
+from modules.coordination import Mode
+from modules.clients import get_hermine_client, get_hermine_dispatcher, get_caldav_client
+from modules.dispatcher import Priority
+from modules.mail import MailRule, get_mail_service
+from modules.calendars import parse_calendar
+from modules.utils import parallel
+from modules.templates import MessageTemplates
+from modules.logs import Payload
+
+
+# options of the module before the mailbox was shared with other modules, and the [imap] options replacing them
+LEGACY_IMAP_OPTIONS = {
+	'max_con_time': None,
+	'idle_timeout': 'idle_timeout',
+	'recon_delay': 'reconnect_delay',
+}
 
 
 class _Config(ModuleConfig):
 	imap: IMAPConfig
 	hermine: HermineConfig
 	caldav: CalDAVConfig
+	templates: TemplatesConfig
 
+	folders: list[str]
 	filter_from: list[str]
 	location: tuple[Degrees, Degrees, Elevation]|None
 	hermine_channel: int
 	calendar: str
 
-	max_con_time: int
-	idle_timeout: int
-	recon_delay: int
-
 	def load(self, data: TOMLDict, cfg: Config) -> None:
 		self.imap = load_toml_data(data.get('imap'), cfg.imap)
 		self.hermine = load_toml_data(data.get('hermine'), cfg.hermine)
 		self.caldav = load_toml_data(data.get('caldav'), cfg.caldav)
+		self.templates = load_toml_data(data.get('templates'), cfg.templates)
 
+		self.set_value('folders', data, default=[self.imap.folder])
 		self.set_value('filter_from', data, default=[])
 		self.set_value('location', data, converter=self._conv_loc)
 		self.set_value('hermine_channel', data)
 		self.set_value('calendar', data)
-		self.set_value('max_con_time', data, default=29 * 60)
-		self.set_value('idle_timeout', data, default=3 * 60)
-		self.set_value('recon_delay', data, default=60)
+
+		for option, replacement in LEGACY_IMAP_OPTIONS.items():
+			if option not in data:
+				continue
+			if replacement is None:
+				logging.getLogger('modules.beflaggung').warning('Ignoring the option "%s", the IMAP connection is no longer renewed periodically', option)
+			else:
+				logging.getLogger('modules.beflaggung').warning('Ignoring the option "%s", set "%s" in the [imap] table instead', option, replacement)
 	
 	def _conv_loc(self, loc: TOMLDict) -> tuple[Degrees, Degrees, Elevation]|None:
 		if loc.get('latitude') is not None and loc.get('longitude') is not None:
@@ -56,54 +73,42 @@ class _Config(ModuleConfig):
 TIMEZONE = 'Europe/Berlin'
 EARLIEST_START_TIME = dtime(7, 0)
 
+TEMPLATES = {
+	'flag': {
+		'header': '📅 **{event.summary}**\n_{event.start:%A, %d.%m.%Y}_',
+		'daylight': ' _({start:%H:%M} – {end:%H:%M})_',
+		'body': '\n\n{event.description}\n\n{event.url}',
+	},
+}
+
 
 class Beflaggung(Module[_Config]):
+	# every replica watches the mailbox, the first one to claim a mail handles it
+	coordination_mode = Mode.ACTIVE
 
 	def init(self) -> None:
-		self.hermine = get_hermine_client(self.config.hermine.device_id, self.config.hermine.username, self.config.hermine.password, self.config.hermine.encryption_password)
-		self.caldav = get_caldav_client(self.config.caldav.url, self.config.caldav.username, self.config.caldav.password)
+		self.hermine, self.caldav = parallel(
+			lambda: get_hermine_client(self.config.hermine.device_id, self.config.hermine.username, self.config.hermine.password, self.config.hermine.encryption_password),
+			lambda: get_caldav_client(self.config.caldav.url, self.config.caldav.username, self.config.caldav.password),
+		)
+		self.outbox = get_hermine_dispatcher(self.hermine, self.config.hermine.username, self.config.hermine.send_rate, self.config.hermine.send_burst, self.config.hermine.target_send_rate, self.config.hermine.target_send_burst, self.config.hermine.send_retries)
+		self.templates = MessageTemplates(TEMPLATES, self.config.templates)
 
 		self.observer = Observer(latitude=self.config.location[0], longitude=self.config.location[1], elevation=self.config.location[2]) if self.config.location is not None else None
 
+		# the mailbox is watched by the mail service, shared with every other rule on the same folders
+		get_mail_service().add_rule(self.config.imap, MailRule(self.name, self._on_mail, folders=self.config.folders, from_=self.config.filter_from))
+
 	def run(self) -> None:
-		def _run(mailbox: BaseMailBox):
-			for msg in mailbox.fetch(AND(from_=self.config.filter_from, seen=False), charset='utf-8', mark_seen=False):
-				found_event = self._handle_msg(msg)
-
-				if found_event:
-					mailbox.flag(msg.uid, consts.MailMessageFlags.SEEN, True)
-
-		done = False
-		while not done:
-			con_start_time = time.monotonic()
-			con_live_time = 0.0
-
-			try:
-				with MailBox(self.config.imap.host, self.config.imap.port).login(self.config.imap.username, self.config.imap.password, self.config.imap.folder) as mailbox:
-					self.logger.debug('new connection')
-
-					# fetch messages that have been received while the connection was down
-					_run(mailbox)
-
-					while con_live_time < self.config.max_con_time:
-						try:
-							responses = mailbox.idle.wait(timeout=self.config.idle_timeout)
-
-							self.logger.debug('IDLE responses: %s', responses)
-
-							if len(responses) > 0:
-								_run(mailbox)
-
-							con_live_time = time.monotonic() - con_start_time
-						except KeyboardInterrupt:
-							done = True
-							break
-			except Exception as e:
-				self.logger.error('Error: %s\nreconnect in %d seconds…', e, self.config.recon_delay)
-				time.sleep(self.config.recon_delay)
-		
 		self.logger.info('Module finished!')
-	
+
+	def _on_mail(self, msg: MailMessage) -> bool|None:
+		handle = self.coordination.should_handle(msg.headers.get('message-id', (msg.uid,))[0])
+		if not handle:
+			# None while a replica ranked before this one may still claim it, the mail is offered again then
+			return handle
+		return self._handle_msg(msg)
+
 	def _handle_msg(self, msg: MailMessage) -> bool:
 		self.logger.info('found message: %s %s %s', msg.subject, msg.from_, msg.date)
 
@@ -113,27 +118,28 @@ class Beflaggung(Module[_Config]):
 			return False
 
 		ics = requests.get(ics_url.group(1)).text
-		events = icalevents.events(string_content=ics, start=msg.date, end=msg.date + timedelta(days=365))
-
-		if len(events) > 0:
-			event = events[0]
+		event = parse_calendar(ics).first(msg.date, msg.date + timedelta(days=365))
 
+		if event is not None:
 			if event.url is None:
 				event.url = ics_url.group(2)
 
-			message = f'📅 **{event.summary}**\n_{event.start:%A, %d.%m.%Y}_'
+			message = self.templates.builder('flag').add('header', event=event)
 
 			if self.observer is not None:
 				date = event.start.date()
 				start = max(sun.sunrise(self.observer, date, TIMEZONE).time(), EARLIEST_START_TIME)
 				end = sun.sunset(self.observer, date, TIMEZONE)
-				message += f' _({start:%H:%M} – {end:%H:%M})_'
+				message.add('daylight', start=start, end=end)
+
+			message.add('body', event=event).add('footer')
 
-			message += f'\n\n{event.description}\n\n{event.url}'
-			message += '\n\n_🤖 automatically sent message_'
-			
-			self.logger.debug('Sending message to Hermine: %s', message)
-			self.hermine.send_msg(('channel', self.config.hermine_channel), message, is_styled=True)
+			futures = []
+			for chunk in message.split():
+				self.logger.debug('Sending message to Hermine: %s', Payload(chunk))
+				futures.append(self.outbox.send_msg(('channel', self.config.hermine_channel), chunk, priority=Priority.NOTICE, is_styled=True))
+			for future in futures:
+				future.result()
 			# FIXME calling save_event currently does not update the event if it already exists
 			self.caldav.get_principal().calendar(cal_id=self.config.calendar).add_event(**{
 				'uid': event.uid,
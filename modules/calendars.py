@@ -0,0 +1,158 @@
+from collections.abc import Iterator
+
+import heapq
+import hashlib
+import itertools
+from datetime import date, datetime, time, timedelta, tzinfo
+from icalendar import Calendar, Component, vRecur
+from icalevents.icalparser import Event, create_event, get_timezone
+from dateutil.rrule import rrule, rruleset, rrulestr
+from dateutil.tz import UTC
+
+from modules.utils import LRUCache
+
+
+# parsed calendars kept by the hash of their content, e.g. the same feed referenced by several mails
+CACHE_SIZE = 16
+CACHE_TTL = 24 * 60 * 60
+
+
+class ParsedCalendar:
+	"""
+	The events of an ICS calendar, parsed once. Occurrences of recurring events are only computed while iterating
+	`events`, so looking up the next event does not expand every recurrence of the calendar.
+	"""
+
+	def __init__(self, content: str, *, tz: tzinfo = UTC):
+		calendar = Calendar.from_ical(content)
+
+		# like icalevents: the only timezone named in the calendar applies to floating times, otherwise `tz`
+		timezones = {str(component['TZID']) for component in calendar.walk('VTIMEZONE')}
+		if 'X-WR-TIMEZONE' in calendar:
+			timezones.add(str(calendar['X-WR-TIMEZONE']))
+		self.tz: tzinfo = (get_timezone(next(iter(timezones))) or tz) if len(timezones) == 1 else tz
+		# whether an event recurs without COUNT or UNTIL, so iterating `events` without an end never stops
+		self.endless = False
+
+		# every event with the rule of its occurrences, built once as the calendar is never changed afterwards
+		self._events: list[tuple[Event, rruleset|None]] = []
+		# occurrences of recurring events replaced by an event of their own, by uid and original start
+		self._overridden: set[tuple[str, datetime]] = set()
+		for component in calendar.walk('VEVENT'):
+			event = create_event(component, False)
+			if event.recurrence_id is not None:
+				self._overridden.add((event.uid, self._normalized(event.recurrence_id)))
+			self._events.append((event, self._rule(component) if 'RRULE' in component or 'RDATE' in component else None))
+			self.endless |= any('COUNT' not in recur and 'UNTIL' not in recur for recur in self._recurs(component))
+
+	def events(self, start: datetime, end: datetime|None = None) -> Iterator[Event]:
+		"""Copies of the events and occurrences overlapping `start` to `end`, ordered by their start."""
+		if start.tzinfo is None:
+			start = start.astimezone()
+		occurrences = heapq.merge(*(self._occurrences(event, rule, start) for event, rule in self._events), key=lambda event: event.start)
+		if end is None:
+			return occurrences
+		if end.tzinfo is None:
+			end = end.astimezone()
+		return itertools.takewhile(lambda event: event.start <= end, occurrences)
+
+	def first(self, start: datetime, end: datetime|None = None) -> Event|None:
+		return next(self.events(start, end), None)
+
+	@property
+	def start(self) -> datetime|None:
+		"""Start of the earliest event, None for a calendar without events."""
+		return min((self._normalized(event.start) for event, _ in self._events), default=None)
+
+	def __len__(self) -> int:
+		return len(self._events)
+
+	def _occurrences(self, event: Event, rule: rruleset|None, start: datetime) -> Iterator[Event]:
+		event_start = self._normalized(event.start)
+		duration = self._normalized(event.end) - event_start
+
+		if rule is None:
+			if event_start + duration >= start and not self._excluded(event, event_start):
+				yield self._copy(event, event_start, duration)
+			return
+
+		# occurrences are computed in the form of DTSTART, naive for dates and floating times
+		after = start - duration
+		if isinstance(event.start, datetime) and event.start.tzinfo is not None:
+			after = after.astimezone(event.start.tzinfo)
+		else:
+			after = after.astimezone(self.tz).replace(tzinfo=None)
+
+		for occurrence in rule.xafter(after, inc=True):
+			occurrence = occurrence.astimezone(self.tz) if occurrence.tzinfo is not None else occurrence.replace(tzinfo=self.tz)
+			if (event.uid, occurrence) in self._overridden or occurrence + duration < start:
+				continue
+			yield self._copy(event, occurrence, duration)
+
+	def _rule(self, component: Component) -> rruleset:
+		"""The RRULEs, RDATEs and EXDATEs of `component`, read without changing it."""
+		start = component['DTSTART'].dt
+		if isinstance(start, datetime) and start.tzinfo is not None:
+			# pytz zones keep the offset of DTSTART, occurrences on the other side of a DST change need the zone itself
+			start = start.replace(tzinfo=get_timezone(str(start.tzinfo)) or start.tzinfo)
+		start = self._rule_value(start, start)
+		rule = rruleset()
+
+		for recur in self._recurs(component):
+			until = recur.get('UNTIL')
+			parsed: rrule = rrulestr(vRecur({key: value for key, value in recur.items() if key != 'UNTIL'}).to_ical().decode(), dtstart=start)
+			if until:
+				parsed = parsed.replace(until=self._rule_value(until[0], start, end_of_day=True))
+			rule.rrule(parsed)
+		for value in self._dates(component, 'RDATE'):
+			rule.rdate(self._rule_value(value, start))
+		for value in self._dates(component, 'EXDATE'):
+			rule.exdate(self._rule_value(value, start))
+		return rule
+
+	def _rule_value(self, value: date|datetime, start: date|datetime, *, end_of_day: bool = False) -> datetime:
+		"""`value` in the form of the rule's start `start`, which dateutil requires of all its dates."""
+		if not isinstance(value, datetime):
+			value = datetime.combine(value, time.max if end_of_day else time.min)
+		if not isinstance(start, datetime) or start.tzinfo is None:
+			return value.astimezone(self.tz).replace(tzinfo=None) if value.tzinfo is not None else value
+		return value if value.tzinfo is not None else value.replace(tzinfo=start.tzinfo)
+
+	def _excluded(self, event: Event, event_start: datetime) -> bool:
+		return any(self._normalized(exdate) == event_start for exdate in self._dates(event.component, 'EXDATE'))
+
+	@staticmethod
+	def _recurs(component: Component) -> list[vRecur]:
+		recurs = component.get('RRULE', [])
+		return recurs if isinstance(recurs, list) else [recurs]
+
+	@staticmethod
+	def _dates(component: Component, name: str) -> Iterator[date|datetime]:
+		values = component.get(name, [])
+		for value in values if isinstance(values, list) else [values]:
+			for item in value.dts:
+				# the start of a PERIOD
+				yield item.dt[0] if isinstance(item.dt, tuple) else item.dt
+
+	def _copy(self, event: Event, start: datetime, duration: timedelta) -> Event:
+		"""A copy, so callers may change the events they are given without affecting the cached calendar."""
+		copy = event.copy_to(start, event.uid)
+		copy.end = start + duration
+		copy.recurrence_id = event.recurrence_id
+		copy.sequence = event.sequence
+		return copy
+
+	def _normalized(self, value: date|datetime) -> datetime:
+		if not isinstance(value, datetime):
+			return datetime(value.year, value.month, value.day, tzinfo=self.tz)
+		if value.tzinfo is None:
+			return value.replace(tzinfo=self.tz)
+		return value.astimezone(self.tz)
+
+
+_calendars: LRUCache[str, ParsedCalendar] = LRUCache(CACHE_SIZE, CACHE_TTL)
+
+def parse_calendar(content: str) -> ParsedCalendar:
+	"""The calendar of the ICS `content`, parsed only once for the same content."""
+	digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+	return _calendars.get(digest, lambda: ParsedCalendar(content))
@@ -1,22 +1,32 @@
+from typing import TYPE_CHECKING
+from collections.abc import Callable
 from typeguard import typechecked
 
 import logging
-from paho.mqtt.client import Client as MQTTClient
-from paho.mqtt.enums import CallbackAPIVersion
-from caldav.davclient import get_davclient, DAVClient
+from threading import Lock
 
-from .utils import synchronized, cached
-from lib.hermine import StashCatClient
+from .utils import cached
+from .dispatcher import OutboundDispatcher
+from lib.hermine import StashCatClient, Directory
+from .hermine import InstrumentedStashCatClient, InstrumentedDirectory
 from lib.groupalarm import GroupalarmClient
 
+# imported when a client is first requested, so the libraries of clients that no enabled module uses are never loaded
+if TYPE_CHECKING:
+	from paho.mqtt.client import Client as MQTTClient, MQTTMessage
+	from paho.mqtt.reasoncodes import ReasonCode
+	from caldav.davclient import DAVClient
 
-@synchronized
-@cached
+# per factory, enough for every module to use its own credentials; clients of superseded credentials are evicted
+MAX_CLIENTS = 8
+
+
+@cached(maxsize=MAX_CLIENTS)
 @typechecked
 def get_hermine_client(device_id: str | None, username: str, password: str, encryption_password: str) -> StashCatClient:
 	logging.info('Initializing Hermine client for user "%s"…', username)
 
-	client = StashCatClient(device_id)
+	client = InstrumentedStashCatClient(device_id)
 	data = client.login(username, password)
 	if not data:
 		raise ValueError('Login failed')
@@ -24,8 +34,23 @@ def get_hermine_client(device_id: str | None, username: str, password: str, encr
 
 	return client
 
-@synchronized
-@cached
+@cached(maxsize=MAX_CLIENTS, close=lambda dispatcher: dispatcher.close())
+@typechecked
+def get_hermine_dispatcher(client: StashCatClient, name: str, rate: float, burst: int, target_rate: float, target_burst: int, max_retries: int) -> OutboundDispatcher:
+	logging.info('Initializing outbound dispatcher for Hermine user "%s"…', name)
+
+	return OutboundDispatcher(client, name=name, rate=rate, burst=burst, target_rate=target_rate, target_burst=target_burst, max_retries=max_retries)
+
+@cached(maxsize=MAX_CLIENTS, close=lambda directory: directory.stop())
+@typechecked
+def get_hermine_directory(client: StashCatClient, interval: float) -> Directory:
+	logging.info('Loading Hermine directory…')
+
+	directory = InstrumentedDirectory(client, interval=interval)
+	directory.start()
+	return directory
+
+@cached(maxsize=MAX_CLIENTS, close=lambda client: client.close())
 @typechecked
 def get_groupalarm_client(api_key: str) -> GroupalarmClient:
 	logging.info('Initializing Groupalarm client…')
@@ -35,10 +60,12 @@ def get_groupalarm_client(api_key: str) -> GroupalarmClient:
 
 	return client
 
-@synchronized
-@cached
+@cached(maxsize=MAX_CLIENTS, close=lambda client: client.disconnect())
 @typechecked
-def get_mqtt_client(host: str, port: int, use_ssl: bool, username: str, password: str, client_id: str) -> MQTTClient:
+def get_mqtt_client(host: str, port: int, use_ssl: bool, username: str, password: str, client_id: str) -> 'SharedMQTTClient':
+	from paho.mqtt.client import Client as MQTTClient
+	from paho.mqtt.enums import CallbackAPIVersion
+
 	logging.info('Initializing MQTT client for user "%s"…', username)
 
 	client = MQTTClient(CallbackAPIVersion.VERSION2, client_id)
@@ -47,12 +74,13 @@ def get_mqtt_client(host: str, port: int, use_ssl: bool, username: str, password
 		client.tls_set_context()
 	client.connect(host, port)
 
-	return client
+	return SharedMQTTClient(client)
 
-@synchronized
-@cached
+@cached(maxsize=MAX_CLIENTS, close=lambda client: client.close())
 @typechecked
-def get_caldav_client(url: str, username: str, password: str) -> DAVClient:
+def get_caldav_client(url: str, username: str, password: str) -> 'DAVClient':
+	from caldav.davclient import get_davclient
+
 	logging.info('Initializing CalDAV client for user "%s"…', username)
 
 	client = get_davclient(url=url, username=username, password=password)
@@ -61,3 +89,68 @@ def get_caldav_client(url: str, username: str, password: str) -> DAVClient:
 	if not client.supports_caldav():
 		raise ValueError('CalDAV server does not support required features')
 	return client
+
+
+class SharedMQTTClient:
+	"""
+	MQTT client shared by all modules using the same broker and credentials. Every module subscribes with its own
+	callback, and the network loop is run by whichever module calls `loop_forever()` first.
+	"""
+
+	def __init__(self, client: 'MQTTClient'):
+		self.client = client
+		self._subscriptions: dict[str, list[Callable[['MQTTMessage'], None]]] = {}
+		self._lock = Lock()
+		self._loop = Lock()
+
+		client.on_connect = self._on_connect
+		client.on_disconnect = self._on_disconnect
+
+	def subscribe(self, topic: str, callback: Callable[['MQTTMessage'], None]) -> None:
+		with self._lock:
+			callbacks = self._subscriptions.get(topic)
+			if callbacks is not None:
+				callbacks.append(callback)
+				return
+			callbacks = self._subscriptions[topic] = [callback]
+
+		def _(client: 'MQTTClient', userdata, msg: 'MQTTMessage'):
+			for callback in list(callbacks):
+				callback(msg)
+		self.client.message_callback_add(topic, _)
+		if self.client.is_connected():
+			self.client.subscribe(topic)
+
+	def loop_forever(self) -> None:
+		"""Run the network loop until the client is disconnected, or wait for it if another module runs it already."""
+		if not self._loop.acquire(blocking=False):
+			with self._loop:
+				return
+		try:
+			self.client.loop_forever(retry_first_connection=True)
+		finally:
+			self._loop.release()
+
+	def publish(self, topic: str, payload: str|bytes, *, qos: int = 0, retain: bool = False) -> None:
+		self.client.publish(topic, payload, qos=qos, retain=retain)
+
+	def is_connected(self) -> bool:
+		return self.client.is_connected()
+
+	def disconnect(self) -> None:
+		self.client.disconnect()
+
+	def _on_connect(self, client: 'MQTTClient', userdata, connect_flags, reason_code: 'ReasonCode', properties) -> None:
+		if reason_code != 0:
+			logging.error('Failed to connect to MQTT broker: %s', reason_code)
+			return
+		logging.debug('Successfully connected to MQTT broker at "%s:%d"', client.host, client.port)
+
+		# subscriptions do not survive a new session
+		with self._lock:
+			topics = list(self._subscriptions)
+		for topic in topics:
+			client.subscribe(topic)
+
+	def _on_disconnect(self, client: 'MQTTClient', userdata, disconnect_flags, reason_code: 'ReasonCode', properties) -> None:
+		logging.debug('Disconnected from MQTT broker: %s', reason_code)
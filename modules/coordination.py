@@ -0,0 +1,617 @@
+from typing import TYPE_CHECKING, Any, ClassVar
+from collections.abc import Callable, Iterable, Iterator
+
+import os
+import json
+import time
+import fcntl
+import socket
+import tempfile
+import sqlite3
+import hashlib
+import logging
+import threading
+from enum import Enum
+from datetime import timedelta
+from abc import ABCMeta, abstractmethod
+from threading import Condition, Lock
+from contextlib import contextmanager
+
+from config import CoordinationConfig, MQTTConfig
+from lib.metrics import Counter, Gauge
+
+if TYPE_CHECKING:
+	from paho.mqtt.client import MQTTMessage
+	from modules.clients import SharedMQTTClient
+
+
+LEADER = Gauge('coordination_leader', 'Whether this replica holds the lease of a leader-only module', ('module',))
+MEMBERS = Gauge('coordination_members', 'Live replicas seen by this replica')
+SKIPPED = Counter('coordination_skipped', 'Work items left to another replica', ('module',))
+
+# how long a claimed work item stays claimed, i.e. how long duplicates of it are recognised
+CLAIM_TIME = 3600.0
+# how long the replica preferred for a work item has to claim it before the next one takes over
+CLAIM_CONFIRM_TIME = 2.0
+# heartbeats a member may miss before it is no longer considered live
+MISSED_HEARTBEATS = 2
+
+
+class Mode(Enum):
+	LEADER = 'leader'
+	"""Only the replica holding the module's lease does any work, the others stand by."""
+	ACTIVE = 'active'
+	"""Every replica works; each item is handled by the replica that claims it first."""
+	SHARDED = 'sharded'
+	"""
+	Items are partitioned over the live replicas by rendezvous hashing of their key. If the replica an item belongs to
+	does not claim it in time, e.g. because it just crashed, the next one in line takes it over.
+	"""
+
+
+def ranked(key: str, members: Iterable[str]) -> list[str]:
+	"""
+	`members` by their rendezvous hash for `key`, highest first, i.e. in the order they take over the item. Only the
+	keys of members that join or leave are moved.
+	"""
+	return sorted(members, key=lambda member: int.from_bytes(hashlib.blake2b(f'{member}\0{key}'.encode('utf-8'), digest_size=8).digest()), reverse=True)
+
+def default_replica_id() -> str:
+	return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class Backend(metaclass=ABCMeta):
+	# whether `claim` decides atomically between replicas claiming the same item at the same time
+	atomic_claims: ClassVar[bool] = True
+
+	@abstractmethod
+	def acquire(self, name: str, owner: str, ttl: float) -> bool:
+		"""Acquire or renew the lease `name` for `ttl` seconds, returning whether `owner` holds it."""
+
+	@abstractmethod
+	def release(self, name: str, owner: str) -> None:
+		...
+
+	@abstractmethod
+	def claim(self, key: str, owner: str, ttl: float) -> bool:
+		"""
+		Claim the work item `key` for `ttl` seconds, returning False if another replica claimed it already. Claiming an
+		item again, e.g. to retry it, succeeds for the replica that holds the claim.
+		"""
+
+	@abstractmethod
+	def heartbeat(self, owner: str, ttl: float) -> list[str]:
+		"""Announce `owner` as live for `ttl` seconds, returning all live members."""
+
+	def close(self, owner: str) -> None:
+		...
+
+
+class FileBackend(Backend):
+	"""
+	Coordination of replicas on a single host through a shared directory.
+
+	Leases are files holding their owner and expiry, read and renewed under a short `flock()`, so a leader that hangs
+	loses its lease once it stops renewing it. Claims are files created exclusively, and members are files whose
+	modification time is their expiry. Both are written to `tmp` first and only then linked into place with their
+	expiry set, so a sweep of another replica never removes them while they are being created.
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+		for kind in ('leases', 'claims', 'members', 'tmp'):
+			os.makedirs(os.path.join(path, kind), exist_ok=True)
+
+	def acquire(self, name: str, owner: str, ttl: float) -> bool:
+		with self._locked_lease(name) as f:
+			holder, expires = self._read_lease(f)
+			if holder is not None and holder != owner and expires >= time.time():
+				return False
+			self._write_lease(f, owner, time.time() + ttl)
+			return True
+
+	def release(self, name: str, owner: str) -> None:
+		with self._locked_lease(name) as f:
+			holder, _ = self._read_lease(f)
+			if holder == owner:
+				f.truncate(0)
+
+	def claim(self, key: str, owner: str, ttl: float) -> bool:
+		path = self._file('claims', key)
+		try:
+			self._create(path, owner, time.time() + ttl, exclusive=True)
+		except FileExistsError:
+			# expired claims are removed by the heartbeat, so the item can be claimed again afterwards
+			try:
+				with open(path) as f:
+					return f.read() == owner
+			except FileNotFoundError:
+				return self.claim(key, owner, ttl)
+		return True
+
+	def heartbeat(self, owner: str, ttl: float) -> list[str]:
+		self._create(self._file('members', owner), owner, time.time() + ttl, exclusive=False)
+
+		members = []
+		now = time.time()
+		for kind in ('members', 'claims'):
+			for entry in os.scandir(os.path.join(self.path, kind)):
+				try:
+					if entry.stat().st_mtime < now:
+						os.unlink(entry.path)
+					elif kind == 'members':
+						with open(entry.path) as f:
+							members.append(f.read())
+				except FileNotFoundError:
+					pass
+		return sorted(members)
+
+	def close(self, owner: str) -> None:
+		for entry in os.scandir(os.path.join(self.path, 'leases')):
+			with self._locked_file(entry.path) as f:
+				holder, _ = self._read_lease(f)
+				if holder == owner:
+					f.truncate(0)
+		try:
+			os.unlink(self._file('members', owner))
+		except FileNotFoundError:
+			pass
+
+	def _file(self, kind: str, name: str) -> str:
+		return os.path.join(self.path, kind, hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+	def _create(self, path: str, content: str, expires: float, *, exclusive: bool) -> None:
+		"""Put a file holding `content` with the modification time `expires` at `path`, failing if it exists and `exclusive` is set."""
+		fd, tmp = tempfile.mkstemp(dir=os.path.join(self.path, 'tmp'))
+		try:
+			with os.fdopen(fd, 'w') as f:
+				f.write(content)
+			os.utime(tmp, (expires, expires))
+			if exclusive:
+				os.link(tmp, path)
+			else:
+				os.replace(tmp, path)
+		finally:
+			try:
+				os.unlink(tmp)
+			except FileNotFoundError:
+				pass
+
+	def _locked_lease(self, name: str):
+		return self._locked_file(self._file('leases', name))
+
+	@contextmanager
+	def _locked_file(self, path: str) -> Iterator[Any]:
+		with open(path, 'a+') as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				yield f
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+	def _read_lease(self, f) -> tuple[str|None, float]:
+		f.seek(0)
+		try:
+			data = json.loads(f.read() or 'null')
+		except ValueError:
+			data = None
+		return (data['owner'], data['expires']) if data is not None else (None, 0.0)
+
+	def _write_lease(self, f, owner: str, expires: float) -> None:
+		f.truncate(0)
+		f.write(json.dumps({'owner': owner, 'expires': expires}))
+		f.flush()
+
+
+class SQLiteBackend(Backend):
+	"""Coordination of replicas on a single host through a shared SQLite database."""
+
+	def __init__(self, path: str):
+		self._db = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+		self._lock = Lock()
+		with self._lock:
+			self._db.executescript('''
+				PRAGMA journal_mode = WAL;
+				CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+				CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+				CREATE TABLE IF NOT EXISTS members (id TEXT PRIMARY KEY, expires REAL NOT NULL);
+			''')
+
+	def acquire(self, name: str, owner: str, ttl: float) -> bool:
+		now = time.time()
+		with self._transaction() as db:
+			cursor = db.execute('UPDATE leases SET owner = ?, expires = ? WHERE name = ? AND (owner = ? OR expires < ?)', (owner, now + ttl, name, owner, now))
+			if cursor.rowcount == 0:
+				cursor = db.execute('INSERT OR IGNORE INTO leases VALUES (?, ?, ?)', (name, owner, now + ttl))
+			return cursor.rowcount == 1
+
+	def release(self, name: str, owner: str) -> None:
+		with self._transaction() as db:
+			db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+	def claim(self, key: str, owner: str, ttl: float) -> bool:
+		now = time.time()
+		with self._transaction() as db:
+			db.execute('DELETE FROM claims WHERE key = ? AND expires < ?', (key, now))
+			if db.execute('INSERT OR IGNORE INTO claims VALUES (?, ?, ?)', (key, owner, now + ttl)).rowcount == 1:
+				return True
+			return db.execute('SELECT owner FROM claims WHERE key = ?', (key,)).fetchone()[0] == owner
+
+	def heartbeat(self, owner: str, ttl: float) -> list[str]:
+		now = time.time()
+		with self._transaction() as db:
+			db.execute('INSERT OR REPLACE INTO members VALUES (?, ?)', (owner, now + ttl))
+			db.execute('DELETE FROM members WHERE expires < ?', (now,))
+			db.execute('DELETE FROM claims WHERE expires < ?', (now,))
+			return [row[0] for row in db.execute('SELECT id FROM members ORDER BY id')]
+
+	def close(self, owner: str) -> None:
+		with self._transaction() as db:
+			db.execute('DELETE FROM leases WHERE owner = ?', (owner,))
+			db.execute('DELETE FROM members WHERE id = ?', (owner,))
+		self._db.close()
+
+	@contextmanager
+	def _transaction(self) -> Iterator[sqlite3.Connection]:
+		with self._lock:
+			self._db.execute('BEGIN IMMEDIATE')
+			try:
+				yield self._db
+			except BaseException:
+				self._db.execute('ROLLBACK')
+				raise
+			self._db.execute('COMMIT')
+
+
+class MQTTBackend(Backend):
+	"""
+	Coordination of replicas on several hosts through retained messages on the MQTT broker.
+
+	Leases and members are retained messages below `topic`; their expiry is measured locally from the time they are
+	received, so clocks do not need to be in sync. A lease is only held once the broker has echoed it back without
+	another replica having overwritten it. Claims are messages as well, but not atomic: two replicas claiming an item
+	at the same time both get it, so the `Coordinator` lets them claim one after another.
+	"""
+
+	atomic_claims = False
+
+	def __init__(self, client: 'SharedMQTTClient', topic: str):
+		self.client = client
+		self.topic = topic
+
+		self._leases: dict[str, tuple[str, float]] = {}
+		self._members: dict[str, float] = {}
+		# hashed key → owner and expiry of the claims seen
+		self._claims: dict[str, tuple[str, float]] = {}
+		self._lock = Lock()
+
+		client.subscribe(f'{topic}/leases/+', self._on_lease)
+		client.subscribe(f'{topic}/members/+', self._on_member)
+		client.subscribe(f'{topic}/claims/+', self._on_claim)
+		threading.Thread(name='Thread-coordination-mqtt', target=client.loop_forever, daemon=True).start()
+
+	def acquire(self, name: str, owner: str, ttl: float) -> bool:
+		with self._lock:
+			holder, expires = self._leases.get(name, (None, 0.0))
+		if holder is not None and holder != owner and expires > time.monotonic():
+			return False
+
+		self.client.publish(f'{self.topic}/leases/{name}', json.dumps({'owner': owner, 'ttl': ttl}), qos=1, retain=True)
+		return holder == owner
+
+	def release(self, name: str, owner: str) -> None:
+		with self._lock:
+			holder, _ = self._leases.get(name, (None, 0.0))
+		if holder == owner:
+			self.client.publish(f'{self.topic}/leases/{name}', b'', qos=1, retain=True)
+
+	def claim(self, key: str, owner: str, ttl: float) -> bool:
+		digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+		now = time.monotonic()
+		with self._lock:
+			holder, expires = self._claims.get(digest, (None, 0.0))
+			if holder is not None and expires > now:
+				return holder == owner
+			self._claims[digest] = (owner, now + ttl)
+		self.client.publish(f'{self.topic}/claims/{digest}', json.dumps({'owner': owner, 'ttl': ttl}), qos=1)
+		return True
+
+	def heartbeat(self, owner: str, ttl: float) -> list[str]:
+		self.client.publish(f'{self.topic}/members/{owner}', json.dumps({'ttl': ttl}), qos=1, retain=True)
+		now = time.monotonic()
+		with self._lock:
+			for digest, (_, expires) in list(self._claims.items()):
+				if expires <= now:
+					del self._claims[digest]
+			return sorted(self._live_members() | {owner})
+
+	def close(self, owner: str) -> None:
+		with self._lock:
+			names = [name for name, (holder, _) in self._leases.items() if holder == owner]
+		for name in names:
+			self.release(name, owner)
+		self.client.publish(f'{self.topic}/members/{owner}', b'', qos=1, retain=True)
+
+	def _live_members(self) -> set[str]:
+		now = time.monotonic()
+		return {member for member, expires in self._members.items() if expires > now}
+
+	def _on_lease(self, msg: 'MQTTMessage') -> None:
+		name = msg.topic.rsplit('/', 1)[1]
+		with self._lock:
+			if not msg.payload:
+				self._leases.pop(name, None)
+				return
+			data = json.loads(msg.payload)
+			self._leases[name] = (data['owner'], time.monotonic() + data['ttl'])
+
+	def _on_claim(self, msg: 'MQTTMessage') -> None:
+		digest = msg.topic.rsplit('/', 1)[1]
+		data = json.loads(msg.payload)
+		now = time.monotonic()
+		with self._lock:
+			holder, expires = self._claims.get(digest, (None, 0.0))
+			# the first claim seen wins, a replica that claimed at the same time has handled the item already anyway
+			if holder is None or expires <= now:
+				self._claims[digest] = (data['owner'], now + data['ttl'])
+
+	def _on_member(self, msg: 'MQTTMessage') -> None:
+		member = msg.topic.rsplit('/', 1)[1]
+		with self._lock:
+			if not msg.payload:
+				self._members.pop(member, None)
+				return
+			self._members[member] = time.monotonic() + json.loads(msg.payload)['ttl']
+
+
+class ModuleCoordination:
+	"""Decides for a single module whether this replica should handle a work item."""
+
+	def __init__(self, coordinator: 'Coordinator', name: str, mode: Mode):
+		self.coordinator = coordinator
+		self.name = name
+		self.mode = mode
+
+	def should_handle(self, key: str|None = None, *, item: str|None = None) -> bool|None:
+		"""
+		Whether this replica handles the work item `key` (ignored for leader-only modules) now, None while a replica
+		ranked before this one may still claim it. Items that are offered again, like unseen mails, are then taken over
+		from a replica that did not claim them in time. In sharded modules, `key` is the partition and `item` identifies
+		the work item within it, if there can be several.
+		"""
+		decision = self._decide(key, item)
+		if decision is False:
+			SKIPPED.labels(self.name).inc()
+		return decision if isinstance(decision, bool) else None
+
+	def handle(self, key: str, func: Callable[[], Any], *, item: str|None = None) -> bool:
+		"""
+		Call `func` if this replica handles the work item `key`, which is only offered once, e.g. a received alarm.
+		If a replica ranked before this one may still claim it, `func` is called later in case that one does not.
+		Returns whether `func` was called right away.
+		"""
+		decision = self._decide(key, item)
+		if decision is True:
+			func()
+			return True
+		if decision is False:
+			SKIPPED.labels(self.name).inc()
+			return False
+
+		from modules.scheduler import get_scheduler
+
+		def _retry():
+			if self._decide(key, item) is True:
+				self.coordinator.logger.info('Taking over "%s:%s" from a replica that did not claim it', self.name, key)
+				func()
+			else:
+				SKIPPED.labels(self.name).inc()
+		get_scheduler().once(timedelta(seconds=decision), _retry, grace=None)
+		return False
+
+	def _decide(self, key: str|None, item: str|None) -> bool|float:
+		match self.mode:
+			case Mode.LEADER:
+				return self.coordinator.is_leader(self.name)
+			case Mode.ACTIVE:
+				return self.coordinator.claim(f'{self.name}:{key}')
+			case Mode.SHARDED:
+				return self.coordinator.owns(f'{self.name}:{key}', f'{self.name}:{key}:{item}' if item is not None else None)
+
+
+class Coordinator:
+	"""
+	Coordination of redundant replicas of this process, shared by all modules.
+
+	Without a backend, this replica is the only one and handles everything. Otherwise it announces itself with a
+	heartbeat, and keeps the leases of its leader-only modules; a lease is considered lost locally once it could not be
+	renewed for `lease_time`, before any other replica may take it over. A member that missed `MISSED_HEARTBEATS`
+	heartbeats is no longer live.
+
+	Work items that are not claimed atomically are ranked over the live members by rendezvous hashing. The first one
+	claims an item right away, every following one only once those before it had `CLAIM_CONFIRM_TIME` each to claim it,
+	so an item that belongs to a replica that just crashed is handled by the next one instead of by nobody.
+	"""
+
+	def __init__(self):
+		self.logger = logging.getLogger('coordination')
+
+		self._cond = Condition()
+		self._running = False
+		self._settings: tuple|None = None
+
+		self.backend: Backend|None = None
+		self.replica_id = default_replica_id()
+		self.lease_time = 15.0
+		self.heartbeat_interval = 5.0
+
+		self._modules: dict[str, ModuleCoordination] = {}
+		self._held: dict[str, float] = {}
+		self._members: list[str] = [self.replica_id]
+		# key → when this replica first saw the work item, for replicas ranked after the first one
+		self._seen: dict[str, float] = {}
+
+	def configure(self, config: CoordinationConfig, mqtt: MQTTConfig) -> None:
+		settings = (config.backend, config.path, config.replica_id, config.topic, config.lease_time, config.heartbeat_interval)
+		with self._cond:
+			if self._settings is not None:
+				if settings != self._settings:
+					self.logger.warning('Changing the coordination settings requires a restart')
+				return
+			self._settings = settings
+
+			self.replica_id = config.replica_id or default_replica_id()
+			self.lease_time = config.lease_time
+			self.heartbeat_interval = config.heartbeat_interval
+
+		match config.backend:
+			case None:
+				return
+			case 'file':
+				backend = FileBackend(config.path)
+			case 'sqlite':
+				backend = SQLiteBackend(config.path)
+			case 'mqtt':
+				from modules.clients import get_mqtt_client
+				client = get_mqtt_client(mqtt.host, mqtt.port, mqtt.use_ssl, mqtt.username, mqtt.password, f'{mqtt.client_id}-{self.replica_id}')
+				backend = MQTTBackend(client, config.topic)
+		self.logger.info('Coordinating replicas through the %s backend as "%s"', config.backend, self.replica_id)
+
+		with self._cond:
+			self.backend = backend
+		self._heartbeat()
+
+	@property
+	def enabled(self) -> bool:
+		return self.backend is not None
+
+	def module(self, name: str, mode: Mode) -> ModuleCoordination:
+		with self._cond:
+			handle = self._modules.get(name)
+			if handle is None or handle.mode is not mode:
+				handle = self._modules[name] = ModuleCoordination(self, name, mode)
+		if mode is Mode.LEADER and self.enabled:
+			self._renew(name, time.monotonic())
+		return handle
+
+	def unique(self, name: str) -> str:
+		"""`name` made unique per replica, e.g. for MQTT client IDs."""
+		return f'{name}-{self.replica_id}' if self.enabled else name
+
+	def is_leader(self, name: str) -> bool:
+		if not self.enabled:
+			return True
+		with self._cond:
+			return self._held.get(name, 0.0) > time.monotonic()
+
+	def claim(self, key: str) -> bool|float:
+		"""
+		Whether this replica handles the work item `key`, taken by whichever replica claims it first. Without atomic
+		claims, the seconds after which to ask again if it is not decided yet (see `owns`).
+		"""
+		if not self.enabled:
+			return True
+		if not self.backend.atomic_claims:
+			return self.owns(key)
+		return self._claim(key)
+
+	def owns(self, key: str, item: str|None = None) -> bool|float:
+		"""
+		Whether this replica handles the work item `item` of the partition `key` (the item itself by default),
+		preferably the first live member by rendezvous hashing of `key`. Replicas ranked after it get the seconds after
+		which to ask again, when they may take the item over.
+		"""
+		item = item if item is not None else key
+		if not self.enabled:
+			return True
+		now = time.monotonic()
+		with self._cond:
+			rank = ranked(key, self._members).index(self.replica_id) if self.replica_id in self._members else 0
+			seen = self._seen.setdefault(item, now) if rank > 0 else now
+		wait = seen + rank * CLAIM_CONFIRM_TIME - now
+		if wait > 0:
+			return wait
+		return self._claim(item)
+
+	def _claim(self, key: str) -> bool:
+		try:
+			return self.backend.claim(key, self.replica_id, CLAIM_TIME)
+		except Exception as e:
+			# handling an item twice is better than not at all
+			self.logger.warning('Failed to claim "%s", handling it anyway: %s', key, e)
+			return True
+
+	def members(self) -> list[str]:
+		with self._cond:
+			return list(self._members)
+
+	def run(self) -> None:
+		"""Send heartbeats and renew leases in the calling thread until `stop()` is called."""
+		with self._cond:
+			self._running = True
+		while True:
+			with self._cond:
+				self._cond.wait(self.heartbeat_interval)
+				if not self._running:
+					return
+			if self.enabled:
+				self._heartbeat()
+
+	def stop(self) -> None:
+		"""Stop the heartbeat and give up all leases, so other replicas take over right away."""
+		with self._cond:
+			self._running = False
+			self._held.clear()
+			self._cond.notify_all()
+		if self.backend is not None:
+			self.backend.close(self.replica_id)
+
+	def _heartbeat(self) -> None:
+		now = time.monotonic()
+		try:
+			members = self.backend.heartbeat(self.replica_id, MISSED_HEARTBEATS * self.heartbeat_interval)
+		except Exception as e:
+			self.logger.warning('Failed to send heartbeat: %s', e)
+		else:
+			with self._cond:
+				if members != self._members:
+					self.logger.info('Live replicas: %s', ', '.join(members))
+				self._members = members
+			MEMBERS.set(len(members))
+
+		with self._cond:
+			for key, seen in list(self._seen.items()):
+				if seen < now - CLAIM_TIME:
+					del self._seen[key]
+
+		with self._cond:
+			names = [name for name, handle in self._modules.items() if handle.mode is Mode.LEADER]
+		for name in names:
+			self._renew(name, now)
+
+	def _renew(self, name: str, now: float) -> None:
+		try:
+			held = self.backend.acquire(name, self.replica_id, self.lease_time)
+		except Exception as e:
+			self.logger.warning('Failed to renew the lease of "%s": %s', name, e)
+			return
+
+		with self._cond:
+			was_held = self._held.get(name, 0.0) > now
+			if held:
+				self._held[name] = now + self.lease_time
+			else:
+				self._held.pop(name, None)
+		if held != was_held:
+			self.logger.info('%s the lease of "%s"', 'Acquired' if held else 'Lost', name)
+		LEADER.labels(name).set(1 if held else 0)
+
+
+_COORDINATOR = Coordinator()
+
+def get_coordinator() -> Coordinator:
+	return _COORDINATOR
+
+def configure_coordinator(config: CoordinationConfig, mqtt: MQTTConfig) -> Coordinator:
+	_COORDINATOR.configure(config, mqtt)
+	return _COORDINATOR
@@ -0,0 +1,249 @@
+from typing import Any
+from collections.abc import Callable, Hashable
+
+import time
+import logging
+import itertools
+import contextvars
+import requests
+import urllib3.exceptions
+from enum import IntEnum
+from threading import Condition, Thread
+from concurrent.futures import Future
+
+from lib.hermine import StashCatClient, RateLimitedError
+from lib.metrics import Counter, Gauge, Histogram
+
+
+QUEUE_DEPTH = Gauge('dispatcher_queue_depth', 'Pending outbound requests', ('dispatcher',))
+QUEUE_WAIT = Histogram('dispatcher_wait_seconds', 'Time outbound requests spent queued before being sent', ('dispatcher', 'priority'))
+RETRIES = Counter('dispatcher_retries', 'Retried outbound requests', ('dispatcher', 'endpoint'))
+
+
+class Priority(IntEnum):
+	ALARM = 0
+	REPLY = 1
+	NOTICE = 2
+	REMINDER = 3
+
+
+class TokenBucket:
+	def __init__(self, rate: float, burst: float):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+
+	def delay(self, now: float) -> float:
+		"""Seconds until a token is available."""
+		self._refill(now)
+		return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+	def consume(self, now: float) -> None:
+		self._refill(now)
+		self.tokens -= 1
+
+	def _refill(self, now: float) -> None:
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+
+class _Request:
+	def __init__(self, seq: int, priority: Priority, endpoint: str, target: Hashable|None, key: Hashable|None, func: Callable, args: tuple, kwargs: dict):
+		self.seq = seq
+		self.priority = priority
+		self.endpoint = endpoint
+		self.target = target
+		self.key = key
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+
+		self.future: Future = Future()
+		# of the caller, so the request is part of its trace and sees its context variables
+		self.context = contextvars.copy_context()
+		self.queued = time.monotonic()
+		self.not_before = 0.0
+		self.attempts = 0
+
+
+class OutboundDispatcher:
+	"""
+	Shared queue for outbound Hermine requests.
+
+	Requests are sent in priority order, limited by a token bucket per endpoint and one per target
+	(channel/conversation). Requests to the same target are sent one at a time and in order. Rate limited requests
+	are retried after the `Retry-After` the server asked for, requests that failed to connect with exponential
+	backoff. Other network errors are raised, as the server may have received the request already.
+	Identical pending sends are coalesced into one request, alarms only if the caller marks them as the same.
+	"""
+
+	def __init__(self, client: StashCatClient, *, name: str = 'hermine', rate: float = 5.0, burst: int = 10, target_rate: float = 1.0, target_burst: int = 5, max_retries: int = 5, workers: int = 2):
+		self.client = client
+		self.name = name
+		self.logger = logging.getLogger(f'dispatcher.{name}')
+
+		self.rate = rate
+		self.burst = burst
+		self.target_rate = target_rate
+		self.target_burst = target_burst
+		self.max_retries = max_retries
+
+		self._cond = Condition()
+		self._queue: list[_Request] = []
+		self._pending: dict[Hashable, _Request] = {}
+		self._in_flight: set[Hashable] = set()
+		self._endpoint_buckets: dict[str, TokenBucket] = {}
+		self._target_buckets: dict[Hashable, TokenBucket] = {}
+		self._seq = itertools.count()
+		self._closed = False
+
+		QUEUE_DEPTH.labels(name).set_function(lambda: len(self._queue))
+
+		for i in range(workers):
+			Thread(name=f'Thread-dispatcher-{name}-{i}', target=self._work, daemon=True).start()
+
+	def send_msg(self, target: tuple[str, int], message: str, *, priority: Priority = Priority.NOTICE, dedup_key: Hashable|None = None, **kwargs) -> Future:
+		"""
+		Send a message, coalesced with an identical pending one. Alarms are only coalesced if they have the same `dedup_key`
+		(e.g. the event id), as separate alarms may well have the same text.
+		"""
+		if priority == Priority.ALARM and dedup_key is None:
+			key = None
+		else:
+			key = ('message/send', target, message, repr(sorted(kwargs.items())), dedup_key)
+		return self.submit('message/send', self.client.send_msg, target, message, priority=priority, target=target, key=key, **kwargs)
+
+	def submit(self, endpoint: str, func: Callable, *args, priority: Priority = Priority.NOTICE, target: Hashable|None = None, key: Hashable|None = None, **kwargs) -> Future:
+		"""Queue `func(*args, **kwargs)`; if a pending request has the same `key`, its future is returned instead."""
+		with self._cond:
+			if self._closed:
+				raise RuntimeError(f'Dispatcher "{self.name}" is closed')
+			if key is not None and key in self._pending:
+				pending = self._pending[key]
+				if priority < pending.priority:
+					pending.priority = priority
+				self.logger.debug('Coalescing request to %s with pending request #%d', endpoint, pending.seq)
+				return pending.future
+
+			request = _Request(next(self._seq), priority, endpoint, target, key, func, args, kwargs)
+			self._queue.append(request)
+			if key is not None:
+				self._pending[key] = request
+			self._cond.notify()
+		return request.future
+
+	def depth(self) -> int:
+		with self._cond:
+			return len(self._queue)
+
+	def close(self) -> None:
+		"""Stop accepting requests; the workers exit once the queued ones are sent."""
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+
+	def _work(self) -> None:
+		while True:
+			request = self._next()
+			if request is None:
+				return
+			QUEUE_WAIT.labels(self.name, request.priority.name.lower()).observe(time.monotonic() - request.queued)
+
+			try:
+				result = request.context.run(request.func, *request.args, **request.kwargs)
+			except RateLimitedError as e:
+				self._retry(request, e, e.retry_after if e.retry_after is not None else self._backoff(request))
+			except requests.RequestException as e:
+				if _unsent(e):
+					self._retry(request, e, self._backoff(request))
+				else:
+					self._finish(request)
+					request.future.set_exception(e)
+			except Exception as e:
+				self._finish(request)
+				request.future.set_exception(e)
+			else:
+				self._finish(request)
+				request.future.set_result(result)
+
+	def _next(self) -> _Request|None:
+		"""Wait for the highest priority request that may be sent now and take it from the queue, None once closed and drained."""
+		with self._cond:
+			while True:
+				if self._closed and not self._queue and not self._in_flight:
+					return None
+				now = time.monotonic()
+				timeout = None
+				# targets of requests that have to wait, so later requests to them stay in order
+				blocked = set(self._in_flight)
+				for request in sorted(self._queue, key=lambda r: (r.priority, r.seq)):
+					if request.target is not None and request.target in blocked:
+						continue
+
+					endpoint_bucket = self._bucket(self._endpoint_buckets, request.endpoint, self.rate, self.burst)
+					target_bucket = self._bucket(self._target_buckets, request.target, self.target_rate, self.target_burst) if request.target is not None else None
+					delay = max(
+						request.not_before - now,
+						endpoint_bucket.delay(now),
+						target_bucket.delay(now) if target_bucket is not None else 0.0,
+					)
+					if delay > 0:
+						timeout = delay if timeout is None else min(timeout, delay)
+						if request.target is not None:
+							blocked.add(request.target)
+						continue
+
+					endpoint_bucket.consume(now)
+					if target_bucket is not None:
+						target_bucket.consume(now)
+						self._in_flight.add(request.target)
+					self._queue.remove(request)
+					if request.key is not None and self._pending.get(request.key) is request:
+						del self._pending[request.key]
+					return request
+				self._cond.wait(timeout)
+
+	def _finish(self, request: _Request) -> None:
+		with self._cond:
+			self._in_flight.discard(request.target)
+			self._cond.notify_all()
+
+	def _retry(self, request: _Request, error: Exception, delay: float) -> None:
+		request.attempts += 1
+		if request.attempts > self.max_retries:
+			self.logger.error('Giving up on request to %s after %d attempts: %s', request.endpoint, request.attempts, error)
+			self._finish(request)
+			request.future.set_exception(error)
+			return
+
+		self.logger.warning('Request to %s failed (%s), retrying in %.1f seconds…', request.endpoint, error, delay)
+		RETRIES.labels(self.name, request.endpoint).inc()
+		with self._cond:
+			request.not_before = time.monotonic() + delay
+			self._queue.append(request)
+			if request.key is not None:
+				self._pending.setdefault(request.key, request)
+			self._in_flight.discard(request.target)
+			self._cond.notify_all()
+
+	def _backoff(self, request: _Request) -> float:
+		return min(60.0, 2.0 ** request.attempts)
+
+	@staticmethod
+	def _bucket(buckets: dict[Any, TokenBucket], key: Any, rate: float, burst: int) -> TokenBucket:
+		bucket = buckets.get(key)
+		if bucket is None:
+			bucket = buckets[key] = TokenBucket(rate, burst)
+		return bucket
+
+
+def _unsent(error: requests.RequestException) -> bool:
+	"""Whether `error` happened while connecting, so sending the request again cannot do anything twice."""
+	if isinstance(error, requests.ConnectTimeout):
+		return True
+	if not isinstance(error, requests.ConnectionError) or isinstance(error, requests.exceptions.SSLError):
+		return False
+	# e.g. refused connections and failed DNS lookups, after urllib3 gave up on them
+	reason = error.args[0] if error.args else None
+	return isinstance(getattr(reason, 'reason', reason), urllib3.exceptions.NewConnectionError)
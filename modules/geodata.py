@@ -0,0 +1,214 @@
+from collections.abc import Iterable, Iterator
+
+import os
+import csv
+import math
+import mmap
+import bisect
+import struct
+import logging
+
+from modules.utils import cached
+
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+DEFAULT_CELL_SIZE = 0.01
+
+_MAGIC = b'GEOI'
+_VERSION = 1
+# magic, version, cell size in degrees, number of cells and of places
+_HEADER = struct.Struct('<4sHxxdII')
+# latitude, longitude and the offsets of the name and the municipality in the string table
+_PLACE = struct.Struct('<ddII')
+_LENGTH = struct.Struct('<H')
+
+
+class Place:
+	__slots__ = ('latitude', 'longitude', 'name', 'municipality')
+
+	def __init__(self, latitude: float, longitude: float, name: str, municipality: str):
+		self.latitude = latitude
+		self.longitude = longitude
+		self.name = name
+		self.municipality = municipality
+
+	def __getitem__(self, key: str):
+		return getattr(self, key)
+
+	def __repr__(self) -> str:
+		return f'Place({self.latitude}, {self.longitude}, {self.name!r}, {self.municipality!r})'
+
+
+class GeoIndex:
+	"""
+	Grid index of places (addresses, hydrants, sites, …) in a file that is memory-mapped instead of read, so opening it
+	is instant whatever its size and only the cells around a lookup are ever paged in.
+
+	The file holds the sorted keys of all non-empty grid cells, the index of the first place of every cell, the places
+	ordered by cell and a table of their names. `build_index` writes it, e.g. from a CSV exported from OpenStreetMap.
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+
+		with open(path, 'rb') as fp:
+			self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, self.cell_size, cells, self._count = _HEADER.unpack_from(self._mmap, 0)
+		if magic != _MAGIC or version != _VERSION:
+			self._mmap.close()
+			raise ValueError(f'{path} is not a geodata index of version {_VERSION}')
+
+		view = memoryview(self._mmap)
+		offset = _HEADER.size
+		self._keys = view[offset:offset + 8 * cells].cast('q')
+		offset += 8 * cells
+		self._starts = view[offset:offset + 4 * (cells + 1)].cast('I')
+		offset += _padded(4 * (cells + 1))
+		self._places = offset
+		self._strings = offset + _PLACE.size * self._count
+
+	def nearest(self, latitude: float, longitude: float, *, max_distance: float) -> tuple[Place, float]|None:
+		"""The place closest to the coordinates and its distance in meters, None if there is none within `max_distance`."""
+		row, col = _cell(latitude, longitude, self.cell_size)
+		# meters per degree of longitude shrink towards the poles, so the grid cells are narrower than they are high
+		scale = max(math.cos(math.radians(latitude)), 1e-6)
+		cell_width = self.cell_size * METERS_PER_DEGREE * scale
+		rings = min(math.ceil(max_distance / cell_width) + 1, 1000)
+
+		best = None
+		# squared, of the equirectangular projection, which is accurate enough over a few kilometers
+		best_distance = max_distance ** 2
+		for ring in range(rings + 1):
+			for key in _ring(row, col, ring):
+				i = bisect.bisect_left(self._keys, key)
+				if i == len(self._keys) or self._keys[i] != key:
+					continue
+				for index in range(self._starts[i], self._starts[i + 1]):
+					lat, lon, _, _ = _PLACE.unpack_from(self._mmap, self._places + index * _PLACE.size)
+					dx = (lon - longitude) * scale
+					dy = lat - latitude
+					squared = (dx * dx + dy * dy) * METERS_PER_DEGREE ** 2
+					if squared <= best_distance:
+						best = index
+						best_distance = squared
+			# places in the rings further out are at least this far away
+			if best is not None and best_distance <= (ring * cell_width) ** 2:
+				break
+
+		if best is None:
+			return None
+		place = self._place(best)
+		return place, distance(latitude, longitude, place.latitude, place.longitude)
+
+	def __len__(self) -> int:
+		return self._count
+
+	def close(self) -> None:
+		self._keys.release()
+		self._starts.release()
+		self._mmap.close()
+
+	def _place(self, index: int) -> Place:
+		lat, lon, name, municipality = _PLACE.unpack_from(self._mmap, self._places + index * _PLACE.size)
+		return Place(lat, lon, self._string(name), self._string(municipality))
+
+	def _string(self, offset: int) -> str:
+		offset += self._strings
+		length, = _LENGTH.unpack_from(self._mmap, offset)
+		return self._mmap[offset + _LENGTH.size:offset + _LENGTH.size + length].decode('utf-8')
+
+
+@cached(close=lambda index: index.close())
+def open_geodata(path: str) -> GeoIndex:
+	return GeoIndex(path)
+
+
+def build_index(places: Iterable[Place], path: str, *, cell_size: float = DEFAULT_CELL_SIZE) -> int:
+	"""Write the index of `places` to `path`, replacing it atomically; returns the number of places."""
+	strings = bytearray()
+	offsets: dict[str, int] = {}
+
+	def _intern(value: str) -> int:
+		offset = offsets.get(value)
+		if offset is None:
+			data = value.encode('utf-8')[:0xffff]
+			offset = offsets[value] = len(strings)
+			strings.extend(_LENGTH.pack(len(data)))
+			strings.extend(data)
+		return offset
+
+	entries = sorted(
+		(_key(*_cell(place.latitude, place.longitude, cell_size)), place.latitude, place.longitude, _intern(place.name), _intern(place.municipality))
+		for place in places
+	)
+	keys: list[int] = []
+	starts: list[int] = []
+	for i, entry in enumerate(entries):
+		if not keys or keys[-1] != entry[0]:
+			keys.append(entry[0])
+			starts.append(i)
+	starts.append(len(entries))
+
+	tmp = f'{path}.tmp'
+	with open(tmp, 'wb') as fp:
+		fp.write(_HEADER.pack(_MAGIC, _VERSION, cell_size, len(keys), len(entries)))
+		fp.write(struct.pack(f'<{len(keys)}q', *keys))
+		fp.write(struct.pack(f'<{len(starts)}I', *starts))
+		fp.write(b'\0' * (_padded(4 * len(starts)) - 4 * len(starts)))
+		for _, lat, lon, name, municipality in entries:
+			fp.write(_PLACE.pack(lat, lon, name, municipality))
+		fp.write(strings)
+	os.replace(tmp, path)
+	logging.getLogger('geodata').info('Wrote %d places in %d cells to %s', len(entries), len(keys), path)
+	return len(entries)
+
+def read_csv(path: str) -> Iterator[Place]:
+	"""Places from a CSV file with the columns `latitude`, `longitude`, `name` and optionally `municipality`."""
+	with open(path, newline='', encoding='utf-8') as fp:
+		for row in csv.DictReader(fp):
+			yield Place(float(row['latitude']), float(row['longitude']), row['name'], row.get('municipality') or '')
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+	"""Great-circle distance in meters."""
+	phi1, phi2 = math.radians(lat1), math.radians(lat2)
+	a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+	return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def _cell(latitude: float, longitude: float, cell_size: float) -> tuple[int, int]:
+	return math.floor(latitude / cell_size), math.floor(longitude / cell_size)
+
+def _key(row: int, col: int) -> int:
+	return (row << 32) | (col & 0xffffffff)
+
+def _ring(row: int, col: int, ring: int) -> Iterator[int]:
+	"""Keys of the cells at a Chebyshev distance of `ring` cells."""
+	if ring == 0:
+		yield _key(row, col)
+		return
+	for c in range(col - ring, col + ring + 1):
+		yield _key(row - ring, c)
+		yield _key(row + ring, c)
+	for r in range(row - ring + 1, row + ring):
+		yield _key(r, col - ring)
+		yield _key(r, col + ring)
+
+def _padded(size: int) -> int:
+	return -(size // -8) * 8
+
+
+class Enrichment:
+	"""Details for the location of an alarm: the nearest place of the index and the distance from the Unterkunft."""
+
+	def __init__(self, index: GeoIndex|None, unterkunft: tuple[float, float]|None, *, max_distance: float):
+		self.index = index
+		self.unterkunft = unterkunft
+		self.max_distance = max_distance
+
+	def nearest(self, latitude: float, longitude: float) -> tuple[Place, float]|None:
+		return self.index.nearest(latitude, longitude, max_distance=self.max_distance) if self.index is not None else None
+
+	def from_unterkunft(self, latitude: float, longitude: float) -> float|None:
+		"""In meters."""
+		return distance(self.unterkunft[0], self.unterkunft[1], latitude, longitude) if self.unterkunft is not None else None
@@ -0,0 +1,64 @@
+import time
+from contextlib import contextmanager
+
+from lib.hermine import StashCatClient, Directory, set_crypto_hook
+from lib.metrics import Counter, Histogram
+from lib.tracing import TRACER, CLIENT
+
+
+REQUEST_SECONDS = Histogram('hermine_request_seconds', 'Latency of Hermine API requests', ('endpoint',))
+REQUEST_ERRORS = Counter('hermine_request_errors', 'Failed Hermine API requests', ('endpoint',))
+CRYPTO_SECONDS = Histogram('hermine_crypto_seconds', 'Time spent in RSA and AES operations', ('operation',), buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+KEY_CACHE_REQUESTS = Counter('hermine_key_cache_requests', 'Lookups of encrypted conversation keys', ('result',))
+DIRECTORY_REFRESHES = Counter('hermine_directory_refreshes', 'Refreshes of the Hermine directory', ('result',))
+
+
+class InstrumentedStashCatClient(StashCatClient):
+	"""
+	Hermine client recording metrics and spans of its requests. Its RSA and AES operations are timed through the crypto
+	hook of `lib.hermine` instead, as they run in the middle of its methods.
+	"""
+
+	def _post(self, url, *, data, include_auth=True, **kwargs):
+		start = time.perf_counter()
+		with TRACER.span('hermine.http', kind=CLIENT, endpoint=url):
+			try:
+				return super()._post(url, data=data, include_auth=include_auth, **kwargs)
+			except Exception:
+				REQUEST_ERRORS.labels(url).inc()
+				raise
+			finally:
+				REQUEST_SECONDS.labels(url).observe(time.perf_counter() - start)
+
+	def _get_conversation_key(self, target):
+		if target not in self._key_cache:
+			KEY_CACHE_REQUESTS.labels('miss').inc()
+			# a cache miss shows up as a nested request
+			with TRACER.span('hermine.key_fetch', target=target[0]):
+				return super()._get_conversation_key(target)
+
+		KEY_CACHE_REQUESTS.labels('hit').inc()
+		return super()._get_conversation_key(target)
+
+
+@contextmanager
+def _timed(operation: str):
+	if operation != 'aes_encrypt':
+		with CRYPTO_SECONDS.labels(operation).time():
+			yield
+		return
+	# nests under the span of the chunk being sent
+	with TRACER.span('hermine.encrypt'), CRYPTO_SECONDS.labels(operation).time():
+		yield
+
+set_crypto_hook(_timed)
+
+
+class InstrumentedDirectory(Directory):
+	def refresh(self, *, force=False):
+		try:
+			super().refresh(force=force)
+		except Exception:
+			DIRECTORY_REFRESHES.labels('failed').inc()
+			raise
+		DIRECTORY_REFRESHES.labels('ok').inc()
@@ -0,0 +1,206 @@
+from collections.abc import Iterable
+
+import logging
+from time import perf_counter
+from threading import Lock
+from concurrent.futures import Future
+
+from modules.dispatcher import OutboundDispatcher, Priority
+from modules.roster import Roster
+from modules.templates import MessageTemplates
+from modules.utils import LRUCache, parse_datetime
+from lib.hermine import StashCatClient, Directory, INVITE_BATCH_SIZE
+from lib.metrics import Counter, Histogram
+from lib.tracing import TRACER, Span, NoopSpan, use_span
+
+
+INCIDENT_SECONDS = Histogram('incident_channel_seconds', 'Time from receiving an alarm until a stage of its incident channel was done', ('module', 'stage'))
+INCIDENTS = Counter('incident_channels', 'Incident channels provisioned for alarms', ('module', 'result'))
+
+# how long updates of an alarm are posted to the channel it got, instead of a new one
+CHANNEL_TTL = 24 * 60 * 60
+
+
+class _Incident:
+	"""The channel of an alarm and the users invited to it so far."""
+
+	def __init__(self, created: Future):
+		self.created = created
+		self.invited: set[int] = set()
+		self.lock = Lock()
+
+
+# by module and event id, kept over reloads of the module
+_incidents: LRUCache[tuple[str, str], _Incident] = LRUCache(1024, CHANNEL_TTL)
+
+
+class IncidentChannels:
+	"""
+	Provisions a Hermine channel per alarm: creates it, posts the alarm there and invites the responders. Updates of
+	the alarm, i.e. messages for the same event, are posted to the same channel and only invite new responders.
+
+	The Hermine users of the Groupalarm labels (matched by name) and of the Hermine channels of units are resolved
+	beforehand by `prepare`, so an alarm only looks them up. All requests go through the dispatcher with alarm
+	priority, the invites in batches that are sent concurrently once the channel exists; nothing blocks the caller.
+	"""
+
+	def __init__(self, name: str, hermine: StashCatClient, outbox: OutboundDispatcher, directory: Directory, roster: Roster|None, templates: MessageTemplates, *, company_id: int, labels: list[int], unit_channels: dict[int, int], budget: float):
+		self.name = name
+		self.hermine = hermine
+		self.outbox = outbox
+		self.directory = directory
+		self.roster = roster
+		self.templates = templates
+		self.company_id = company_id
+		self.labels = labels
+		self.unit_channels = unit_channels
+		self.budget = budget
+		self.logger = logging.getLogger(f'incidents.{name}')
+
+		# Groupalarm label / unit id → Hermine users to invite
+		self._label_users: dict[int, list[dict]] = {}
+		self._unit_users: dict[int, list[dict]] = {}
+
+	def prepare(self) -> None:
+		"""Resolve the Hermine users of the labels and units again, e.g. after the members changed."""
+		label_users = {}
+		if self.roster is not None and len(self.labels) > 0:
+			self.roster.refresh(self.labels)
+			for label_id in self.labels:
+				users = []
+				missing = 0
+				for person in self.roster.persons(self.roster.members([label_id])):
+					user = self.directory.user_by_name(f'{person.name} {person.surname}')
+					if user is not None:
+						users.append(user)
+					else:
+						missing += 1
+				if missing > 0:
+					self.logger.warning('%d members of label #%d have no unique Hermine user of the same name', missing, label_id)
+				label_users[label_id] = users
+
+		unit_users = {unit_id: self.directory.members(channel_id) for unit_id, channel_id in self.unit_channels.items()}
+
+		self._label_users = label_users
+		self._unit_users = unit_users
+		self.logger.debug('Resolved %d users of %d labels and %d users of %d units', sum(map(len, label_users.values())), len(label_users), sum(map(len, unit_users.values())), len(unit_users))
+
+	def responders(self, data: dict) -> list[dict]:
+		"""The Hermine users to invite for the alarm `data`, without duplicates and the bot itself."""
+		users: dict[int, dict] = {}
+		resources = data.get('alarmResources', {})
+		for label in resources.get('labels', []):
+			for user in self._label_users.get(int(label['label']['id']), ()):
+				users.setdefault(int(user['id']), user)
+		for unit in resources.get('units', []):
+			for user in self._unit_users.get(int(unit['id']), ()):
+				users.setdefault(int(user['id']), user)
+		users.pop(int(self.hermine.user_id), None)
+		return [user for user in users.values() if user.get('public_key')]
+
+	def provision(self, data: dict, chunks: Iterable[str], location: tuple|None, *, received: float, trace: Span|NoopSpan) -> Future:
+		"""
+		Create the channel of the alarm `data` unless its event has one already, post `chunks` there and invite its
+		responders; the future is done once everything was, `received` (`perf_counter()`) is the start of the latency
+		budget.
+		"""
+		result: Future = Future()
+		span = TRACER.start_span('alarm.incident', parent=trace)
+		chunks = list(chunks)
+
+		values = {'event': data['event'], 'message': data['message'], 'alarm': data, 'start': parse_datetime(data['event']['startDate']).astimezone()}
+		name = self.templates.builder('incident').add('channel', **values).build()
+		new = False
+
+		def _create() -> _Incident:
+			nonlocal new
+			new = True
+			with use_span(span):
+				return _Incident(self.outbox.submit('channels/create', self.hermine.create_channel, name, self.company_id, priority=Priority.ALARM))
+
+		event_id = data['event'].get('id')
+		if event_id is None:
+			incident = _create()
+		else:
+			key = (self.name, str(event_id))
+			incident = _incidents.get(key, _create)
+			if incident.created.done() and incident.created.exception() is not None:
+				# the channel could not be created for an earlier message, try again
+				_incidents.pop(key)
+				incident = _incidents.get(key, _create)
+		span.set_attribute('update', not new)
+
+		with incident.lock:
+			responders = [user for user in self.responders(data) if int(user['id']) not in incident.invited]
+			incident.invited.update(int(user['id']) for user in responders)
+		span.set_attribute('responders', len(responders))
+
+		def _created(future: Future):
+			if future.exception() is not None:
+				_done([future])
+				return
+			channel_id = future.result()['id']
+			span.set_attribute('channel', channel_id)
+			if new:
+				self._observe('created', received)
+
+			text = self.templates.builder('incident').add('invite', **values).build()
+			futures = []
+			with use_span(span):
+				for i, chunk in enumerate(chunks):
+					futures.append(self.outbox.send_msg(('channel', channel_id), chunk, priority=Priority.ALARM, location=location if i == 0 else None, is_styled=True))
+				# every batch is a request of its own without a target, so the dispatcher sends them concurrently
+				for i in range(0, len(responders), INVITE_BATCH_SIZE):
+					futures.append(self.outbox.submit('channels/createInvite', self.hermine.invite, channel_id, responders[i:i + INVITE_BATCH_SIZE], text, priority=Priority.ALARM))
+			if len(chunks) > 0:
+				futures[len(chunks) - 1].add_done_callback(lambda _: self._observe('posted', received))
+			_gather(futures).add_done_callback(lambda _: _done(futures))
+
+		def _done(futures: list[Future]):
+			errors = [future.exception() for future in futures if future.exception() is not None]
+			elapsed = self._observe('ready', received)
+			if len(errors) > 0:
+				self.logger.error('Failed to provision incident channel "%s": %s', name, errors[0])
+				INCIDENTS.labels(self.name, 'failed').inc()
+				span.set_error(errors[0])
+				result.set_exception(errors[0])
+			else:
+				late = elapsed > self.budget
+				if late:
+					self.logger.warning('Incident channel "%s" was ready after %.1f seconds, over the budget of %.1f seconds', name, elapsed, self.budget)
+				elif new:
+					self.logger.info('Incident channel "%s" with %d responders ready after %.1f seconds', name, len(responders), elapsed)
+				else:
+					self.logger.info('Incident channel "%s" updated with %d new responders after %.1f seconds', name, len(responders), elapsed)
+				INCIDENTS.labels(self.name, 'late' if late else 'ready' if new else 'updated').inc()
+				result.set_result(elapsed)
+			span.finish()
+
+		incident.created.add_done_callback(_created)
+		return result
+
+	def _observe(self, stage: str, received: float) -> float:
+		elapsed = perf_counter() - received
+		INCIDENT_SECONDS.labels(self.name, stage).observe(elapsed)
+		return elapsed
+
+
+def _gather(futures: list[Future]) -> Future:
+	"""Done once all `futures` are, whether they failed or not."""
+	gathered: Future = Future()
+	pending = len(futures)
+	lock = Lock()
+
+	def _(_: Future):
+		nonlocal pending
+		with lock:
+			pending -= 1
+			if pending > 0:
+				return
+		gathered.set_result(None)
+
+	if pending == 0:
+		gathered.set_result(None)
+	for future in futures:
+		future.add_done_callback(_)
+	return gathered
@@ -0,0 +1,198 @@
+from typing import Any
+
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import logging.handlers
+from datetime import datetime
+from threading import Lock
+
+from config import LoggingConfig, LoggerConfig
+from lib.metrics import Counter
+
+
+LOG_RECORDS_DROPPED = Counter('log_records_dropped', 'Log records dropped before being written', ('logger', 'reason'))
+
+TEXT_FORMAT = '%(asctime)s %(threadName)s %(name)s [%(levelname)s] %(message)s'
+
+# attributes every record has, everything else was passed with `extra=`
+_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+_redact: frozenset[str] = frozenset()
+_max_payload_length = 200
+
+
+class Payload:
+	"""
+	Log argument for message bodies and API data, e.g. `logger.debug('Sending %s', Payload(chunk))`. It is only
+	rendered when the record is written, with the configured fields redacted and long values shortened.
+	"""
+
+	__slots__ = ('value',)
+
+	def __init__(self, value: Any):
+		self.value = value
+
+	def __str__(self) -> str:
+		value = _redacted(self.value)
+		text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=repr)
+		if len(text) > _max_payload_length:
+			return f'{text[:_max_payload_length]}… ({len(text)} characters)'
+		return text
+
+	__repr__ = __str__
+
+def _redacted(value: Any) -> Any:
+	if isinstance(value, dict):
+		return {key: '***' if key in _redact else _redacted(item) for key, item in value.items()}
+	if isinstance(value, (list, tuple)):
+		return [_redacted(item) for item in value]
+	if isinstance(value, bytes):
+		return value.decode('utf-8', errors='replace')
+	return value
+
+
+class _Limiter:
+	__slots__ = ('sample', 'rate', 'burst', 'tokens', 'updated')
+
+	def __init__(self, config: LoggerConfig):
+		self.sample = config.sample
+		self.rate = config.rate
+		self.burst = config.burst
+		self.tokens = float(config.burst)
+		self.updated = time.monotonic()
+
+	def allow(self) -> str|None:
+		"""None if a record may pass, else why it is dropped."""
+		if self.sample < 1.0 and random.random() >= self.sample:
+			return 'sampled'
+		if self.rate is not None:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			if self.tokens < 1.0:
+				return 'rate_limited'
+			self.tokens -= 1.0
+		return None
+
+
+class SamplingFilter(logging.Filter):
+	"""Samples and rate limits the records below WARNING per logger, with the settings of the closest configured parent."""
+
+	def __init__(self, loggers: dict[str, LoggerConfig]):
+		super().__init__()
+		self._lock = Lock()
+		self._limiters = {name: _Limiter(config) for name, config in loggers.items() if config.sample < 1.0 or config.rate is not None}
+		# logger name → name of the limiter that applies to it, '' for none
+		self._resolved: dict[str, str] = {}
+
+	def filter(self, record: logging.LogRecord) -> bool:
+		if record.levelno >= logging.WARNING or not self._limiters:
+			return True
+
+		name = self._resolved.get(record.name)
+		if name is None:
+			name = self._resolved[record.name] = _closest(record.name, self._limiters)
+		if name == '':
+			return True
+
+		with self._lock:
+			reason = self._limiters[name].allow()
+		if reason is not None:
+			LOG_RECORDS_DROPPED.labels(name, reason).inc()
+			return False
+		return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+	"""Hands records to the listener thread as they are, without formatting them or ever blocking the caller."""
+
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		# the arguments are formatted by the listener, so records that are dropped later cost nothing; the queue
+		# stays within the process, so nothing has to be pickled either
+		return record
+
+	def enqueue(self, record: logging.LogRecord) -> None:
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			LOG_RECORDS_DROPPED.labels(record.name, 'queue_full').inc()
+
+
+class JSONFormatter(logging.Formatter):
+	def format(self, record: logging.LogRecord) -> str:
+		data = {
+			'time': self.formatTime(record),
+			'level': record.levelname,
+			'logger': record.name,
+			'thread': record.threadName,
+			'message': record.getMessage(),
+		}
+		for key, value in record.__dict__.items():
+			if key not in _RECORD_ATTRIBUTES:
+				data[key] = _redacted(value.value if isinstance(value, Payload) else value)
+		if record.exc_info:
+			data['exception'] = self.formatException(record.exc_info)
+		if record.stack_info:
+			data['stack'] = self.formatStack(record.stack_info)
+		return json.dumps(data, ensure_ascii=False, default=str)
+
+	def formatTime(self, record: logging.LogRecord, datefmt: str|None = None) -> str:
+		return datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds')
+
+
+_LISTENER: logging.handlers.QueueListener|None = None
+# loggers whose level was set, to reset the ones no longer configured
+_CONFIGURED: set[str] = set()
+
+def configure_logging(config: LoggingConfig) -> None:
+	"""
+	Route all records through a queue to a listener thread that formats and writes them, so logging never blocks the
+	calling thread; can be called again to apply a new config.
+	"""
+	global _LISTENER, _redact, _max_payload_length
+
+	_redact = frozenset(config.redact)
+	_max_payload_length = config.max_payload_length
+
+	handler = logging.StreamHandler(sys.stderr)
+	handler.setFormatter(JSONFormatter() if config.format == 'json' else logging.Formatter(TEXT_FORMAT))
+
+	queue_handler = _QueueHandler(queue.Queue(config.queue_size))
+	queue_handler.addFilter(SamplingFilter(config.loggers))
+
+	root = logging.getLogger()
+	if _LISTENER is not None:
+		_LISTENER.stop()
+	for old in list(root.handlers):
+		root.removeHandler(old)
+	root.addHandler(queue_handler)
+	root.setLevel(config.level)
+
+	for name in _CONFIGURED - config.loggers.keys():
+		logging.getLogger(name).setLevel(logging.NOTSET)
+	for name, logger_config in config.loggers.items():
+		logging.getLogger(name).setLevel(logger_config.level if logger_config.level is not None else logging.NOTSET)
+	_CONFIGURED.clear()
+	_CONFIGURED.update(config.loggers)
+
+	_LISTENER = logging.handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+	_LISTENER.start()
+
+def stop_logging() -> None:
+	"""Write the records still queued."""
+	global _LISTENER
+	if _LISTENER is not None:
+		_LISTENER.stop()
+		_LISTENER = None
+
+def _closest(name: str, names: dict[str, Any]) -> str:
+	while True:
+		if name in names:
+			return name
+		if '.' not in name:
+			return ''
+		name = name.rsplit('.', 1)[0]
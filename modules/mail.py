@@ -0,0 +1,339 @@
+from collections.abc import Callable, Collection, Iterable
+from typing import TYPE_CHECKING
+
+import re
+import time
+import random
+import imaplib
+import logging
+from threading import Event, Lock, Thread
+
+from config import IMAPConfig
+from lib.metrics import Counter, Gauge, Histogram
+from modules.logs import Payload
+
+if TYPE_CHECKING:
+	from imap_tools.mailbox import BaseMailBox
+	from imap_tools.message import MailMessage
+
+
+IMAP_IDLE_CYCLES = Counter('imap_idle_cycles', 'Completed IMAP IDLE wait cycles', ('mailbox',))
+IMAP_CONNECTIONS = Counter('imap_connections', 'IMAP connections (re-)established', ('mailbox', 'reason'))
+IMAP_WATCHERS = Gauge('imap_watchers', 'Watched IMAP folders')
+MAIL_RULES = Counter('mail_rules', 'Mails routed to a rule', ('rule', 'result'))
+IMAP_IDLE_RENEWAL = Gauge('imap_idle_renewal_seconds', 'Interval IDLE is currently re-issued at', ('mailbox',))
+MAIL_PUSH_LATENCY = Histogram('mail_push_latency_seconds', 'Time from the Date header of a mail until it was routed to the rules', ('mailbox',),
+	buckets=(1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0))
+
+# IDLE is renewed at least this long after it was issued, however early the server drops it
+MIN_IDLE_RENEWAL = 30.0
+# the renewal interval stays this far below the shortest IDLE the server dropped
+IDLE_RENEWAL_MARGIN = 0.8
+# cycles in a row without a drop after which the renewal interval grows again, and by how much
+STABLE_IDLE_CYCLES = 10
+IDLE_RENEWAL_GROWTH = 1.25
+
+# (host, port, use_ssl, username, folder)
+type WatchKey = tuple[str, int, bool, str, str]
+type MailHandler = Callable[['MailMessage'], bool|None]
+
+
+class MailRule:
+	"""
+	Routes the unseen mails of `folders` that match all given criteria to `handler`. The handler returns whether it is
+	done with the mail, which is then marked as seen, or None if it cannot decide yet; those mails and the ones it
+	raises on are offered again after the next IDLE cycle.
+	"""
+
+	__slots__ = ('name', 'handler', 'folders', 'from_', 'subject')
+
+	def __init__(self, name: str, handler: MailHandler, *, folders: Iterable[str] = ('INBOX',), from_: Iterable[str] = (), subject: str|None = None):
+		self.name = name
+		self.handler = handler
+		self.folders = frozenset(folders)
+		self.from_ = frozenset(address.lower() for address in from_)
+		self.subject = re.compile(subject) if subject is not None else None
+
+	def matches(self, msg: 'MailMessage') -> bool:
+		if self.from_ and msg.from_.lower() not in self.from_:
+			return False
+		if self.subject is not None and self.subject.search(msg.subject) is None:
+			return False
+		return True
+
+
+class _ServerBye(Exception):
+	"""The server ended the session with an untagged BYE, e.g. because it restarts or limits the session length."""
+
+
+class MailWatcher:
+	"""
+	Watches one folder of an account over a single long-lived connection and runs the matching rules for every new
+	mail, so any number of rules on the same folder cost one login. IDLE is ended and re-issued periodically with a
+	UID SEARCH in between, which keeps the session alive and catches mails the server did not announce.
+
+	The renewal interval starts at `idle_timeout`. When the server (or a NAT on the way) drops an IDLE earlier, it is
+	lowered below the time the IDLE lasted, and it grows back towards `idle_timeout` while no more drops are seen.
+	A BYE of the server is followed by a new login right away, errors by a new login after an exponential backoff
+	with jitter.
+	"""
+
+	def __init__(self, config: IMAPConfig, folder: str):
+		self.config = config
+		self.folder = folder
+		self.label = f'{config.username}@{config.host}/{folder}'
+		self.logger = logging.getLogger(f'mail.{self.label}')
+
+		self.rules: dict[str, MailRule] = {}
+		# UIDs every rule has been run on and decided about without an error during the current session
+		self._processed: set[str] = set()
+
+		self._thread: Thread|None = None
+		self._stopped = Event()
+
+		self._renewal = float(config.idle_timeout)
+		# shortest IDLE the server dropped, the renewal interval never grows beyond it again
+		self._dropped_after: float|None = None
+		self._stable_cycles = 0
+
+	def start(self) -> None:
+		self._thread = Thread(name=f'Thread-mail-{self.label}', target=self.run, daemon=True)
+		self._thread.start()
+
+	def stop(self) -> None:
+		# takes effect after the current IDLE cycle
+		self._stopped.set()
+
+	def run(self) -> None:
+		reason = 'startup'
+		attempt = 0
+		while not self._stopped.is_set():
+			mailbox = None
+			connected = time.monotonic()
+			try:
+				mailbox = self._login()
+				self.logger.debug('new connection')
+				IMAP_CONNECTIONS.labels(self.label, reason).inc()
+				self._processed.clear()
+				self._idle(mailbox)
+			except Exception as e:
+				if self._stopped.is_set():
+					break
+				# sessions that end right away count as failed attempts, so a flapping server is not hammered
+				if time.monotonic() - connected > self.config.max_reconnect_delay:
+					attempt = 0
+				if isinstance(e, _ServerBye) or (mailbox is not None and _said_bye(mailbox)):
+					reason = 'bye'
+					delay = 0.0 if attempt == 0 else self._backoff(attempt)
+					self.logger.info('Server closed the connection (%s), reconnecting in %.1f seconds…', e, delay)
+				else:
+					reason = 'error'
+					delay = self._backoff(attempt)
+					self.logger.error('Error: %s\nreconnect in %.1f seconds…', e, delay)
+				attempt += 1
+				self._stopped.wait(delay)
+			finally:
+				if mailbox is not None:
+					_logout(mailbox)
+
+		self.logger.debug('Stopped watching')
+
+	def _login(self) -> 'BaseMailBox':
+		from imap_tools import MailBox, MailBoxUnencrypted
+
+		mailbox_class = MailBox if self.config.use_ssl else MailBoxUnencrypted
+		return mailbox_class(self.config.host, self.config.port).login(self.config.username, self.config.password, self.folder)
+
+	def _backoff(self, attempt: int) -> float:
+		# "full jitter", so the watchers of many folders do not log in at the same time
+		return random.uniform(0, min(self.config.max_reconnect_delay, self.config.reconnect_delay * 2 ** attempt))
+
+	def _idle(self, mailbox: 'BaseMailBox') -> None:
+		# fetch messages that have been received while the connection was down
+		self._fetch(mailbox)
+
+		supports_idle = 'IDLE' in mailbox.client.capabilities
+		if not supports_idle:
+			self.logger.info('Server does not support IDLE, polling every %d seconds', self.config.idle_timeout)
+
+		while not self._stopped.is_set():
+			if supports_idle:
+				responses = self._idle_cycle(mailbox)
+				self.logger.debug('IDLE responses: %s', Payload(responses))
+				IMAP_IDLE_CYCLES.labels(self.label).inc()
+			else:
+				self._stopped.wait(self.config.idle_timeout)
+
+			# also after a timeout: the search is the keepalive, and a dead connection surfaces here
+			self._fetch(mailbox)
+
+	def _idle_cycle(self, mailbox: 'BaseMailBox') -> list[bytes]:
+		"""Issue IDLE, wait for responses or until it is time to renew it, and end it again."""
+		# the latest config applies from the next cycle on, and it always stays within the 29 minutes of RFC 2177
+		renewal = min(self._renewal, float(self.config.idle_timeout))
+		IMAP_IDLE_RENEWAL.labels(self.label).set(renewal)
+
+		mailbox.idle.start()
+		started = time.monotonic()
+		responses = mailbox.idle.poll(timeout=renewal)
+		if any(line.startswith(b'* BYE') for line in responses):
+			self._dropped(time.monotonic() - started)
+			raise _ServerBye(b' '.join(responses).decode('utf-8', errors='replace'))
+		try:
+			mailbox.idle.stop()
+		except (OSError, imaplib.IMAP4.abort):
+			# dropped without a BYE, e.g. by a NAT that forgot the idle connection
+			self._dropped(time.monotonic() - started)
+			raise
+
+		if len(responses) == 0:
+			self._stable_cycles += 1
+			ceiling = float(self.config.idle_timeout)
+			if self._dropped_after is not None:
+				ceiling = min(ceiling, max(MIN_IDLE_RENEWAL, self._dropped_after * IDLE_RENEWAL_MARGIN))
+			if self._stable_cycles >= STABLE_IDLE_CYCLES and self._renewal < ceiling:
+				self._renewal = min(ceiling, self._renewal * IDLE_RENEWAL_GROWTH)
+				self._stable_cycles = 0
+				self.logger.debug('Renewing IDLE every %.0f seconds', self._renewal)
+		return responses
+
+	def _dropped(self, after: float) -> None:
+		self._stable_cycles = 0
+		self._dropped_after = after if self._dropped_after is None else min(self._dropped_after, after)
+		self._renewal = max(MIN_IDLE_RENEWAL, after * IDLE_RENEWAL_MARGIN)
+		self.logger.info('Server dropped IDLE after %.0f seconds, renewing it every %.0f seconds from now on', after, self._renewal)
+
+	def _fetch(self, mailbox: 'BaseMailBox') -> None:
+		from imap_tools import AND
+
+		rules = list(self.rules.values())
+		if len(rules) == 0:
+			return
+
+		# the UID search is cheap, only mails that have not been through the rules yet are downloaded; mails that
+		# arrive while the rules run are not announced outside of IDLE, so search again until there are none
+		failed: set[str] = set()
+		while True:
+			unseen = mailbox.uids(AND(seen=False))
+			self._processed.intersection_update(unseen)
+			new = [uid for uid in unseen if uid not in self._processed and uid not in failed]
+			if len(new) == 0:
+				break
+
+			for msg in mailbox.fetch(AND(uid=new), charset='utf-8', mark_seen=False):
+				if not self._route(mailbox, msg, rules):
+					# offered again with the next search after the IDLE cycle
+					failed.add(msg.uid)
+
+	def _route(self, mailbox: 'BaseMailBox', msg: 'MailMessage', rules: list[MailRule]) -> bool:
+		"""Run the matching rules on `msg`, returns False if any of them failed or could not decide yet."""
+		from imap_tools import consts
+
+		# how long the mail took from its sender to us, including our own detection latency
+		if msg.date.tzinfo is not None and msg.date.year > 1900:
+			MAIL_PUSH_LATENCY.labels(self.label).observe(max(0.0, time.time() - msg.date.timestamp()))
+
+		done = False
+		failed = False
+		deferred = False
+		for rule in rules:
+			if not rule.matches(msg):
+				continue
+			try:
+				handled = rule.handler(msg)
+			except Exception:
+				self.logger.exception('Rule "%s" failed for message: %s', rule.name, msg.subject)
+				MAIL_RULES.labels(rule.name, 'error').inc()
+				failed = True
+				continue
+			if handled is None:
+				MAIL_RULES.labels(rule.name, 'deferred').inc()
+				deferred = True
+				continue
+			MAIL_RULES.labels(rule.name, 'handled' if handled else 'skipped').inc()
+			done = done or handled
+
+		if done:
+			mailbox.flag(msg.uid, consts.MailMessageFlags.SEEN, True)
+		elif not failed and not deferred:
+			self._processed.add(msg.uid)
+		return not failed and not deferred
+
+
+def _said_bye(mailbox: 'BaseMailBox') -> bool:
+	return 'BYE' in mailbox.client.untagged_responses
+
+def _logout(mailbox: 'BaseMailBox') -> None:
+	try:
+		mailbox.logout()
+	except Exception:
+		# the connection is gone already
+		pass
+
+
+class MailService:
+	"""Shares one `MailWatcher` per watched account and folder between all mail rules."""
+
+	def __init__(self):
+		self.logger = logging.getLogger('mail')
+		self._lock = Lock()
+		self._watchers: dict[WatchKey, MailWatcher] = {}
+		self._running = False
+		self._stopped = Event()
+
+	def add_rule(self, config: IMAPConfig, rule: MailRule) -> None:
+		"""Add `rule` for the account of `config`, replacing any rule of the same name."""
+		keys = {(config.host, config.port, config.use_ssl, config.username, folder) for folder in rule.folders}
+		with self._lock:
+			# watchers that keep the rule keep their connection
+			self._remove_rule(rule.name, keep=keys)
+			for key in keys:
+				watcher = self._watchers.get(key)
+				if watcher is None:
+					watcher = self._watchers[key] = MailWatcher(config, key[-1])
+					if self._running:
+						watcher.start()
+				# the latest timeouts and credentials apply from the next cycle or connection on
+				watcher.config = config
+				watcher.rules[rule.name] = rule
+			IMAP_WATCHERS.set(len(self._watchers))
+
+	def remove_rule(self, name: str) -> None:
+		with self._lock:
+			self._remove_rule(name)
+			IMAP_WATCHERS.set(len(self._watchers))
+
+	def _remove_rule(self, name: str, keep: Collection[WatchKey] = ()) -> None:
+		for key, watcher in list(self._watchers.items()):
+			if key in keep:
+				continue
+			watcher.rules.pop(name, None)
+			if len(watcher.rules) == 0:
+				watcher.stop()
+				del self._watchers[key]
+
+	def run(self) -> None:
+		"""Watch the folders of all rules, including ones added later, until `stop()` is called."""
+		with self._lock:
+			self._running = True
+			self._stopped.clear()
+			for watcher in self._watchers.values():
+				watcher.start()
+
+		self._stopped.wait()
+
+	def stop(self) -> None:
+		"""Stop all watchers and forget their rules."""
+		with self._lock:
+			self._running = False
+			for watcher in self._watchers.values():
+				watcher.stop()
+			self._watchers.clear()
+			IMAP_WATCHERS.set(0)
+		self._stopped.set()
+
+
+_MAIL = MailService()
+
+def get_mail_service() -> MailService:
+	return _MAIL
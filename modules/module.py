@@ -1,9 +1,11 @@
 from abc import ABCMeta, abstractmethod
-from typing import final
+from typing import ClassVar, final, get_args, get_origin
 
 import logging
 
 from config import IConfig, TOMLDict, Config
+from modules.coordination import Mode, get_coordinator
+from modules.utils import holding
 
 
 class ModuleConfig(IConfig):
@@ -17,19 +19,34 @@ class ModuleConfig(IConfig):
 		...
 
 class Module[T: ModuleConfig](metaclass=ABCMeta):
+	# how redundant replicas of the process share the work of this module
+	coordination_mode: ClassVar[Mode] = Mode.LEADER
+
 	def __init__(self, name: str, *, config: T|None = None):
 		self.name = name
 
 		self.logger = logging.getLogger(f'modules.{name}')
+		self.coordination = get_coordinator().module(name, self.coordination_mode)
 
 		if config is not None:
 			self.update_config(config)
 
+	@classmethod
+	def config_class(cls) -> type[T]:
+		"""The config class given as type argument, e.g. `_Config` for `class Alarmierung(Module[_Config])`."""
+		for klass in cls.__mro__:
+			for base in getattr(klass, '__orig_bases__', ()):
+				if get_origin(base) is Module:
+					return get_args(base)[0]
+		raise TypeError(f'{cls.__name__} does not declare its config class')
+
 	@final
 	def update_config(self, config: T) -> None:
 		self.config = config
 
-		self.init()
+		# clients of the previous config are closed once no other module uses them
+		with holding(self):
+			self.init()
 
 		self.logger.info('Module configured successfully')
 	
@@ -0,0 +1,207 @@
+from collections.abc import Callable, Iterable
+
+import time
+import random
+import logging
+from threading import Event, Lock
+
+from lib.hermine import StashCatClient
+from lib.metrics import Counter, Gauge
+
+
+PUSH_CONNECTED = Gauge('push_connected', 'Whether the socket.io connection to Hermine is up', ('connection',))
+PUSH_DISCONNECTS = Counter('push_disconnects', 'Lost socket.io connections to Hermine', ('connection',))
+PUSH_CAUGHT_UP = Counter('push_caught_up_messages', 'Messages fetched after a reconnect that had been missed while disconnected', ('connection',))
+
+type Source = tuple[str, int]
+type MessageCallback = Callable[[Source, dict, dict|None], None]
+
+PAGE_SIZE = 30
+
+
+class PushConnection:
+	"""
+	socket.io connection to Hermine that reconnects with jittered exponential backoff.
+
+	After every reconnect, the messages of the watched sources that are newer than the last one delivered are fetched
+	and delivered in order before any live event, so nothing sent while disconnected is lost. Callbacks get the source,
+	the event (or fetched message) and the already decrypted message if it was fetched; they are called with a lock held
+	on the socket.io receive thread and should hand any slow work off.
+	"""
+
+	def __init__(self, client: StashCatClient, sources: Iterable[Source], *, name: str, reconnect_delay: float = 1.0, max_reconnect_delay: float = 60.0, heartbeat_interval: float = 30.0, catch_up_limit: int = 200):
+		self.client = client
+		self.name = name
+		self.logger = logging.getLogger(f'push.{name}')
+
+		self.reconnect_delay = reconnect_delay
+		self.max_reconnect_delay = max_reconnect_delay
+		self.heartbeat_interval = heartbeat_interval
+		self.catch_up_limit = catch_up_limit
+
+		self._callbacks: list[MessageCallback] = []
+		self._last_ids: dict[Source, int|None] = {source: None for source in sources}
+
+		self._lock = Lock()
+		self._catching_up = False
+		self._buffer: list[dict] = []
+
+		self._sio = None
+		self._disconnected = Event()
+		self._stopped = Event()
+
+	def on_message(self, callback: MessageCallback) -> MessageCallback:
+		self._callbacks.append(callback)
+		return callback
+
+	def set_sources(self, sources: Iterable[Source]) -> None:
+		"""Watch `sources` from now on, e.g. after a config change, continuing where the kept ones left off."""
+		sources = list(sources)
+		with self._lock:
+			self._last_ids = {source: self._last_ids.get(source) for source in sources}
+
+	def run(self) -> None:
+		"""Keep the connection up until `stop()` is called."""
+		attempt = 0
+		while not self._stopped.is_set():
+			try:
+				self._connect()
+			except Exception as e:
+				delay = self._backoff(attempt)
+				attempt += 1
+				self.logger.warning('Failed to connect to the push server (%s), retrying in %.1f seconds…', e, delay)
+				self._stopped.wait(delay)
+				continue
+
+			connected = time.monotonic()
+			self._watch()
+			if self._stopped.is_set():
+				break
+
+			# connections that drop right away count as failed attempts, so a flapping server is not hammered
+			if time.monotonic() - connected > self.max_reconnect_delay:
+				attempt = 0
+			delay = self._backoff(attempt)
+			attempt += 1
+			PUSH_DISCONNECTS.labels(self.name).inc()
+			self.logger.warning('Lost the connection to the push server, reconnecting in %.1f seconds…', delay)
+			self._stopped.wait(delay)
+
+	def stop(self) -> None:
+		self._stopped.set()
+		self._disconnected.set()
+
+	def _connect(self) -> None:
+		sio = self.client.get_socket(connect=False, reconnection=False, handle_sigint=False)
+		sio.on('message_sync', self._on_event)
+		sio.on('disconnect', lambda *args: self._disconnected.set())
+
+		with self._lock:
+			self._catching_up = True
+		self._disconnected.clear()
+		try:
+			sio.connect(self.client.push_url)
+		except Exception:
+			with self._lock:
+				self._catching_up = False
+				self._buffer.clear()
+			raise
+
+		self._sio = sio
+		PUSH_CONNECTED.labels(self.name).set(1)
+		self.logger.debug('Connected to the push server')
+		self._catch_up()
+
+	def _watch(self) -> None:
+		"""Wait until the connection is lost; engine.io's ping timeout detects dead connections, this checks on it."""
+		while not self._stopped.is_set():
+			if self._disconnected.wait(self.heartbeat_interval):
+				break
+			if not self._sio.connected:
+				self.logger.warning('Push connection is gone without a disconnect event')
+				break
+
+		PUSH_CONNECTED.labels(self.name).set(0)
+		try:
+			self._sio.disconnect()
+		except Exception:
+			pass
+
+	def _catch_up(self) -> None:
+		try:
+			for source, last_id in list(self._last_ids.items()):
+				if last_id is None:
+					# on the first connection there is nothing to catch up on, only where to continue from later
+					newest = next(self.client.get_messages(source, limit=1), None)
+					with self._lock:
+						if source in self._last_ids:
+							self._last_ids[source] = newest['id'] if newest is not None else 0
+					continue
+
+				missed = self._fetch_since(source, last_id)
+				if len(missed) > 0:
+					self.logger.info('Catching up on %d messages in %s #%d', len(missed), *source)
+					PUSH_CAUGHT_UP.labels(self.name).inc(len(missed))
+				with self._lock:
+					for message in missed:
+						self._deliver(source, message, message)
+		except Exception as e:
+			self.logger.error('Failed to catch up on missed messages: %s', e)
+		finally:
+			with self._lock:
+				self._catching_up = False
+				buffered, self._buffer = self._buffer, []
+				for data in sorted(buffered, key=lambda data: data['id']):
+					self._deliver(_source(data), data, None)
+
+	def _fetch_since(self, source: Source, last_id: int) -> list[dict]:
+		"""The messages newer than `last_id` in ascending order, at most the `catch_up_limit` newest ones."""
+		messages = []
+		offset = 0
+		while len(messages) < self.catch_up_limit:
+			page = list(self.client.get_messages(source, limit=PAGE_SIZE, offset=offset))
+			newer = [message for message in page if message['id'] > last_id]
+			messages.extend(newer)
+			if len(newer) < len(page) or len(page) < PAGE_SIZE:
+				break
+			offset += len(page)
+
+		if len(messages) > self.catch_up_limit:
+			self.logger.warning('Skipping %d missed messages in %s #%d', len(messages) - self.catch_up_limit, *source)
+		return sorted(messages, key=lambda message: message['id'])[-self.catch_up_limit:]
+
+	def _on_event(self, data: dict) -> None:
+		source = _source(data)
+		if source not in self._last_ids:
+			return
+
+		with self._lock:
+			if self._catching_up:
+				self._buffer.append(data)
+				return
+			self._deliver(source, data, None)
+
+	def _deliver(self, source: Source, data: dict, message: dict|None) -> None:
+		if source not in self._last_ids:
+			# no longer watched since the config changed
+			return
+		last_id = self._last_ids[source]
+		if last_id is not None and data['id'] <= last_id:
+			return
+		self._last_ids[source] = data['id']
+
+		for callback in self._callbacks:
+			try:
+				callback(source, data, message)
+			except Exception:
+				self.logger.exception('Message callback failed')
+
+	def _backoff(self, attempt: int) -> float:
+		# "full jitter", so reconnecting replicas do not hit the server at the same time
+		return random.uniform(0, min(self.max_reconnect_delay, self.reconnect_delay * 2 ** attempt))
+
+
+def _source(data: dict) -> Source:
+	if data.get('channel_id'):
+		return ('channel', data['channel_id'])
+	return ('conversation', data.get('conversation_id'))
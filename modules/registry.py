@@ -0,0 +1,66 @@
+import logging
+from importlib.metadata import EntryPoint, entry_points
+
+from config import Config
+from modules.module import Module, ModuleConfig
+
+
+# modules of other packages register themselves as entry points in this group, e.g. in their pyproject.toml:
+#   [project.entry-points."automatisierung.modules"]
+#   wetter = "automatisierung_wetter:Wetter"
+ENTRY_POINT_GROUP = 'automatisierung.modules'
+
+# a module is only imported if a `[modules.<name>]` table uses its type
+BUILTIN_MODULES: dict[str, str] = {
+	'alarmierung': 'modules.alarmierung:Alarmierung',
+	'ausbildungsdienst': 'modules.ausbildungsdienst:Ausbildungsdienst',
+	'beflaggung': 'modules.beflaggung:Beflaggung',
+	'user_interface': 'modules.user_interface:UserInterface',
+}
+
+# name → (type, instance) of every module created, so modules can query each other
+_INSTANCES: dict[str, tuple[str, Module]] = {}
+
+
+def module_types() -> dict[str, EntryPoint]:
+	types = {name: EntryPoint(name, value, ENTRY_POINT_GROUP) for name, value in BUILTIN_MODULES.items()}
+	for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+		if entry_point.name in types:
+			logging.warning('Module type "%s" of "%s" is shadowed by a built-in module', entry_point.name, entry_point.value)
+			continue
+		types[entry_point.name] = entry_point
+	return types
+
+def load_module_class(type_name: str, types: dict[str, EntryPoint]|None = None) -> type[Module]:
+	types = types if types is not None else module_types()
+	if type_name not in types:
+		raise ValueError(f'Unknown module type "{type_name}"')
+
+	module_class = types[type_name].load()
+	if not (isinstance(module_class, type) and issubclass(module_class, Module)):
+		raise TypeError(f'Module type "{type_name}" does not refer to a Module subclass: {module_class!r}')
+	return module_class
+
+def create_module(name: str, type_name: str, types: dict[str, EntryPoint]|None = None) -> tuple[Module, ModuleConfig]:
+	logging.debug('Loading module "%s" of type "%s"…', name, type_name)
+
+	module_class = load_module_class(type_name, types)
+	module = module_class(name)
+	_INSTANCES[name] = (type_name, module)
+	return module, module_class.config_class()()
+
+def create_modules(config: Config) -> list[tuple[Module, ModuleConfig]]:
+	"""Instantiate a module for every `[modules.<name>]` table, importing only the module types that are used."""
+	types = module_types()
+
+	modules: list[tuple[Module, ModuleConfig]] = []
+	for name in config.module_names():
+		modules.append(create_module(name, config.module_type(name), types))
+
+	if not modules:
+		logging.warning('No modules are enabled')
+	return modules
+
+def find_modules(type_name: str) -> list[Module]:
+	"""All instances of the module type `type_name`, in the order they were created."""
+	return [module for type_, module in _INSTANCES.values() if type_ == type_name]
@@ -0,0 +1,156 @@
+from collections.abc import Iterable
+
+import time
+import logging
+from threading import Lock
+
+from modules.utils import cached
+from lib.groupalarm import GroupalarmClient
+from lib.metrics import Gauge
+
+
+ROSTER_PERSONS = Gauge('roster_persons', 'Active users in the roster index', ('organization',))
+
+# users and labels are fetched again at most this often, however many modules use the roster
+MAX_AGE = 3600.0
+
+
+class Person:
+	__slots__ = ('id', 'name', 'surname', 'index')
+
+	def __init__(self, id: int, name: str, surname: str, index: int):
+		self.id = id
+		self.name = name
+		self.surname = surname
+		# the bit of the person in all bitsets of the roster
+		self.index = index
+
+	def __getitem__(self, key: str):
+		# templates were written for the user dicts of the API, e.g. `{user[name]}`
+		return getattr(self, key)
+
+	def __repr__(self) -> str:
+		return f'Person({self.id}, {self.name!r}, {self.surname!r})'
+
+
+class Roster:
+	"""
+	Index of the active users of a Groupalarm organization and the members of its labels.
+
+	Every person has a bit, so the members of labels and the participants of events are plain ints and filtering them
+	is a bitwise AND. Refreshing only touches the persons and labels that changed; bits of removed persons are reused.
+	"""
+
+	def __init__(self, client: GroupalarmClient, *, max_age: float = MAX_AGE):
+		self.client = client
+		self.max_age = max_age
+		self.logger = logging.getLogger('roster')
+
+		self._lock = Lock()
+		self._persons: dict[int, Person] = {}
+		# person of every bit, None for the bits of removed persons until they are reused
+		self._slots: list[Person|None] = []
+		self._free: list[int] = []
+		# bitset of all persons, and of the members of every label
+		self._all = 0
+		self._labels: dict[int, int] = {}
+
+		self._users_at: float|None = None
+		self._labels_at: dict[int, float] = {}
+
+		ROSTER_PERSONS.labels(str(client.organization_id)).set_function(lambda: len(self._persons))
+
+	def refresh(self, labels: Iterable[int] = (), *, force: bool = False) -> None:
+		"""Fetch the users and the members of `labels` again if they are older than `max_age` or `force` is set."""
+		with self._lock:
+			now = time.monotonic()
+			if force or self._users_at is None or now - self._users_at >= self.max_age:
+				if self._update_users(self.client.get_users()) > 0:
+					# new persons are not in the bitsets of the labels yet
+					self._labels_at.clear()
+				self._users_at = now
+			for label_id in labels:
+				at = self._labels_at.get(label_id)
+				if force or at is None or now - at >= self.max_age:
+					self._labels[label_id] = self._mask(self.client.get_label(label_id)['assignees'])
+					self._labels_at[label_id] = now
+
+	def get(self, user_id: int) -> Person|None:
+		return self._persons.get(user_id)
+
+	def members(self, labels: Iterable[int] = ()) -> int:
+		"""Bitset of the members of any of `labels`, of all persons if there are none."""
+		mask = 0
+		empty = True
+		for label_id in labels:
+			mask |= self._labels.get(label_id, 0)
+			empty = False
+		return self._all if empty else mask
+
+	def mask(self, user_ids: Iterable[int]) -> int:
+		"""Bitset of the persons with the given ids, unknown ids are left out."""
+		with self._lock:
+			return self._mask(user_ids)
+
+	def persons(self, mask: int) -> list[Person]:
+		"""The persons whose bits are set in `mask`."""
+		persons = []
+		while mask:
+			bit = mask & -mask
+			person = self._slots[bit.bit_length() - 1]
+			if person is not None:
+				persons.append(person)
+			mask ^= bit
+		return persons
+
+	def __len__(self) -> int:
+		return len(self._persons)
+
+	def _mask(self, user_ids: Iterable[int]) -> int:
+		mask = 0
+		for user_id in user_ids:
+			person = self._persons.get(user_id)
+			if person is not None:
+				mask |= 1 << person.index
+		return mask
+
+	def _update_users(self, users: list[dict]) -> int:
+		"""Apply the differences to `users`, returns the number of persons added."""
+		users = [user for user in users if user['pending'] is False]
+		active = {user['id'] for user in users}
+
+		# removed first, so their bits can be reused by the persons added in the same refresh
+		removed = [person for user_id, person in self._persons.items() if user_id not in active]
+		for person in removed:
+			del self._persons[person.id]
+			self._slots[person.index] = None
+			bit = 1 << person.index
+			self._all &= ~bit
+			for label_id in self._labels:
+				self._labels[label_id] &= ~bit
+			self._free.append(person.index)
+
+		added = changed = 0
+		for user in users:
+			person = self._persons.get(user['id'])
+			if person is None:
+				if self._free:
+					index = self._free.pop()
+				else:
+					index = len(self._slots)
+					self._slots.append(None)
+				self._persons[user['id']] = self._slots[index] = Person(user['id'], user['name'], user['surname'], index)
+				self._all |= 1 << index
+				added += 1
+			elif person.name != user['name'] or person.surname != user['surname']:
+				person.name = user['name']
+				person.surname = user['surname']
+				changed += 1
+
+		self.logger.debug('Refreshed roster: %d persons, %d added, %d changed, %d removed', len(self._persons), added, changed, len(removed))
+		return added
+
+
+@cached
+def get_roster(client: GroupalarmClient) -> Roster:
+	return Roster(client)
@@ -0,0 +1,457 @@
+from typing import Any
+from collections.abc import Callable
+
+import os
+import json
+import time
+import heapq
+import logging
+import itertools
+from collections import deque
+from threading import Condition
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, tzinfo
+from datetime import time as dtime
+from zoneinfo import ZoneInfo
+
+from config import SchedulerConfig
+from lib.metrics import Counter, Histogram
+
+
+SCHEDULER_LAG = Histogram('scheduler_lag_seconds', 'Delay between the due time of a job and the start of its execution', ('owner',))
+SCHEDULER_JOBS = Counter('scheduler_jobs', 'Executed scheduler jobs', ('owner', 'result'))
+
+
+_WEEKDAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+_MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+# how far into the future a cron expression is searched for its next match
+_MAX_CRON_LOOKAHEAD = timedelta(days=5 * 366)
+
+
+class Cron:
+	"""
+	A cron-like recurring trigger (`minute hour day month weekday`) evaluated in a given timezone.
+
+	Fields support `*`, `*/n`, `a-b`, `a-b/n`, lists (`a,b`) and, for months and weekdays, three-letter names.
+	Weekdays are numbered `0` (Sunday) to `6` (Saturday); `7` is accepted as Sunday as well.
+	"""
+
+	def __init__(self, expr: str, tz: tzinfo|None = None):
+		fields = expr.split()
+		if len(fields) != 5:
+			raise ValueError(f'Invalid cron expression "{expr}": expected 5 fields, got {len(fields)}')
+
+		self.expr = expr
+		self.tz = tz
+
+		self.minutes = sorted(_parse_cron_field(fields[0], 0, 59))
+		self.hours = sorted(_parse_cron_field(fields[1], 0, 23))
+		self.days = _parse_cron_field(fields[2], 1, 31)
+		self.months = _parse_cron_field(fields[3], 1, 12, _MONTHS, offset=1)
+		self.weekdays = {day % 7 for day in _parse_cron_field(fields[4], 0, 7, _WEEKDAYS)}
+
+		self._any_day = fields[2] == '*'
+		self._any_weekday = fields[4] == '*'
+
+	@classmethod
+	def weekly(cls, weekday: str, at: str, tz: tzinfo|None = None) -> 'Cron':
+		hour, minute = at.split(':')[:2]
+		return cls(f'{int(minute)} {int(hour)} * * {weekday}', tz)
+
+	def next_after(self, after: datetime) -> datetime:
+		local = _to_local(after, self.tz).replace(second=0, microsecond=0, tzinfo=None) + timedelta(minutes=1)
+
+		day = local.date()
+		while day - local.date() < _MAX_CRON_LOOKAHEAD:
+			if self._matches_day(day):
+				for hour in self.hours:
+					for minute in self.minutes:
+						candidate = datetime.combine(day, dtime(hour, minute))
+						if candidate >= local:
+							return _from_local(candidate, self.tz)
+			day += timedelta(days=1)
+
+		raise ValueError(f'Cron expression "{self.expr}" never matches')
+
+	def _matches_day(self, day: date) -> bool:
+		if day.month not in self.months:
+			return False
+
+		dom = day.day in self.days
+		dow = day.isoweekday() % 7 in self.weekdays
+		if self._any_day:
+			return dow
+		if self._any_weekday:
+			return dom
+		# like cron, if both fields are restricted, matching either is sufficient
+		return dom or dow
+
+	def __repr__(self) -> str:
+		return f'Cron({self.expr!r}, {self.tz!r})'
+
+
+class Job:
+	def __init__(self, scheduler: 'Scheduler', id: str, func: Callable|str, args: tuple, kwargs: dict, *, trigger: Cron|None, owner: str|None, grace: timedelta|None):
+		self.scheduler = scheduler
+		self.id = id
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.trigger = trigger
+		self.owner = owner
+		self.grace = grace
+
+		self.next_run: datetime
+		self.deadline: float
+		self.cancelled = False
+
+	@property
+	def persistent(self) -> bool:
+		return isinstance(self.func, str)
+
+	def cancel(self) -> None:
+		self.scheduler.cancel(self)
+
+	def __repr__(self) -> str:
+		return f'Job({self.id!r}, next_run={self.next_run.isoformat()}, trigger={self.trigger!r})'
+
+
+class Scheduler:
+	"""
+	Timer scheduler shared by all modules.
+
+	Pending jobs are kept in a min-heap ordered by their monotonic deadline, so the scheduler thread sleeps exactly
+	until the next job is due and is woken up whenever an earlier job is added. Jobs are executed on a small worker pool,
+	those of the same owner one at a time and in the order they became due.
+
+	Jobs whose function is given as the name of a handler (see `handler()`) are persisted to `state_file` and restored
+	on the next start.
+	"""
+
+	def __init__(self, *, timezone: str|None = None, state_file: str|None = None, workers: int = 4):
+		self.logger = logging.getLogger('scheduler')
+
+		self._cond = Condition()
+		self._heap: list[tuple[float, int, Job]] = []
+		self._jobs: dict[str, Job] = {}
+		self._handlers: dict[str, Callable] = {}
+		self._orphans: dict[str, dict[str, Any]] = {}
+		self._seq = itertools.count()
+		self._ids = itertools.count()
+		self._running = False
+		# owner → jobs waiting for the running job of that owner to finish
+		self._owner_queues: dict[str, deque[Callable[[], None]]] = {}
+
+		self.tz: tzinfo|None = None
+		self.state_file: str|None = None
+		self._executor: ThreadPoolExecutor|None = None
+		self._workers = workers
+
+		self.configure(timezone=timezone, state_file=state_file, workers=workers)
+
+	def configure(self, *, timezone: str|None = None, state_file: str|None = None, workers: int = 4) -> None:
+		with self._cond:
+			self.tz = ZoneInfo(timezone) if timezone is not None else None
+
+			if workers != self._workers and self._executor is not None:
+				# running jobs finish on the previous pool, everything dispatched from now on uses the new one
+				self._executor.shutdown(wait=False)
+				self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Thread-scheduler-worker')
+			self._workers = workers
+
+			if state_file != self.state_file:
+				self.state_file = state_file
+				self._load_state()
+
+	def handler(self, name: str, func: Callable) -> None:
+		"""Register a named handler that persistent jobs refer to, restoring any pending jobs saved for it."""
+		with self._cond:
+			self._handlers[name] = func
+
+			for id, entry in list(self._orphans.items()):
+				if entry['handler'] == name:
+					del self._orphans[id]
+					self._restore(id, entry)
+
+	def once(self, when: datetime|timedelta, func: Callable|str, *args, id: str|None = None, owner: str|None = None, grace: timedelta|None = timedelta(minutes=10), **kwargs) -> Job:
+		"""
+		Schedule `func` to be run once at `when`.
+
+		If `func` is the name of a registered handler, the job is persisted and arguments have to be JSON serializable.
+		Scheduling a job with the `id` of a pending job replaces it. Jobs that are more than `grace` overdue are skipped.
+		"""
+		if isinstance(when, timedelta):
+			when = self.now() + when
+		elif when.tzinfo is None:
+			when = _from_local(when, self.tz)
+
+		with self._cond:
+			job = self._make_job(id, func, args, kwargs, trigger=None, owner=owner, grace=grace)
+			self._push(job, when)
+			if job.persistent:
+				self._save_state()
+		return job
+
+	def cron(self, trigger: Cron|str, func: Callable, *args, id: str|None = None, owner: str|None = None, **kwargs) -> Job:
+		"""Schedule `func` to be run whenever `trigger` matches."""
+		if isinstance(trigger, str):
+			trigger = Cron(trigger, self.tz)
+
+		with self._cond:
+			job = self._make_job(id, func, args, kwargs, trigger=trigger, owner=owner, grace=None)
+			self._push(job, trigger.next_after(self.now()))
+		return job
+
+	def cancel(self, job: Job|str|None = None, *, owner: str|None = None) -> None:
+		"""Cancel a single job (by object or id) or all jobs of an `owner`."""
+		with self._cond:
+			if isinstance(job, str):
+				jobs = [self._jobs[job]] if job in self._jobs else []
+			elif job is not None:
+				jobs = [job]
+			else:
+				jobs = [job for job in self._jobs.values() if job.owner == owner]
+
+			persistent = False
+			for job in jobs:
+				job.cancelled = True
+				if self._jobs.get(job.id) is job:
+					del self._jobs[job.id]
+				persistent |= job.persistent
+
+			if persistent:
+				self._save_state()
+			self._cond.notify()
+
+	def jobs(self, *, owner: str|None = None) -> list[Job]:
+		with self._cond:
+			return sorted(
+				(job for job in self._jobs.values() if owner is None or job.owner == owner),
+				key=lambda job: job.deadline,
+			)
+
+	def now(self) -> datetime:
+		return datetime.now(self.tz).astimezone(self.tz)
+
+	def run(self) -> None:
+		"""Run the scheduler loop in the calling thread until `stop()` is called."""
+		with self._cond:
+			self._running = True
+			self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='Thread-scheduler-worker')
+
+		try:
+			while True:
+				with self._cond:
+					job = self._next_due()
+					if job is None:
+						if not self._running:
+							break
+						continue
+
+				self._dispatch(job)
+		finally:
+			with self._cond:
+				self._executor.shutdown(wait=False)
+				self._executor = None
+
+	def stop(self) -> None:
+		with self._cond:
+			self._running = False
+			self._cond.notify()
+
+	def _next_due(self) -> Job|None:
+		"""Pop the next due job or wait until it is due, a new job is added or the scheduler is stopped."""
+		while self._running:
+			while self._heap and self._heap[0][2].cancelled:
+				heapq.heappop(self._heap)
+
+			if not self._heap:
+				self.logger.debug('No pending jobs, waiting…')
+				self._cond.wait()
+				continue
+
+			deadline, _, job = self._heap[0]
+			delay = deadline - time.monotonic()
+			if delay > 0:
+				self.logger.debug('Sleeping for %.1f seconds until %r…', delay, job)
+				self._cond.wait(delay)
+				continue
+
+			heapq.heappop(self._heap)
+			if job.trigger is not None:
+				self._push(job, job.trigger.next_after(max(self.now(), job.next_run)))
+			else:
+				del self._jobs[job.id]
+				if job.persistent:
+					self._save_state()
+
+				if job.grace is not None and -delay > job.grace.total_seconds():
+					self.logger.warning('Skipping %r, it is overdue by %d seconds', job, -delay)
+					continue
+			return job
+		return None
+
+	def _dispatch(self, job: Job) -> None:
+		if isinstance(job.func, str):
+			func = self._handlers.get(job.func)
+			if func is None:
+				self.logger.error('No handler "%s" registered for %r', job.func, job)
+				return
+		else:
+			func = job.func
+
+		owner = job.owner or ''
+		deadline = job.deadline
+
+		def _run():
+			SCHEDULER_LAG.labels(owner).observe(time.monotonic() - deadline)
+			self.logger.debug('Running %r', job)
+			try:
+				func(*job.args, **job.kwargs)
+			except Exception:
+				SCHEDULER_JOBS.labels(owner, 'error').inc()
+				self.logger.exception('Job %r raised an exception', job)
+			else:
+				SCHEDULER_JOBS.labels(owner, 'success').inc()
+
+		self._submit(job.owner, _run)
+
+	def _submit(self, owner: str|None, run: Callable[[], None]) -> None:
+		"""Run `run` on the worker pool, after the running and waiting jobs of the same `owner`."""
+		with self._cond:
+			if owner is not None:
+				if owner in self._owner_queues:
+					self._owner_queues[owner].append(run)
+					return
+				self._owner_queues[owner] = deque()
+			if self._executor is None:
+				self._owner_queues.pop(owner, None)
+				return
+			self._executor.submit(self._run_serialized, owner, run)
+
+	def _run_serialized(self, owner: str|None, run: Callable[[], None]) -> None:
+		try:
+			run()
+		finally:
+			if owner is not None:
+				with self._cond:
+					queue = self._owner_queues[owner]
+					if queue and self._executor is not None:
+						self._executor.submit(self._run_serialized, owner, queue.popleft())
+					else:
+						del self._owner_queues[owner]
+
+	def _make_job(self, id: str|None, func: Callable|str, args: tuple, kwargs: dict, **options) -> Job:
+		if isinstance(func, str) and func not in self._handlers:
+			raise KeyError(f'No handler "{func}" registered')
+
+		if id is None:
+			id = f'{getattr(func, '__qualname__', func)}#{next(self._ids)}'
+		elif id in self._jobs:
+			self._jobs[id].cancelled = True
+
+		job = Job(self, id, func, args, kwargs, **options)
+		self._jobs[id] = job
+		return job
+
+	def _push(self, job: Job, when: datetime) -> None:
+		job.next_run = when
+		job.deadline = time.monotonic() + (when - self.now()).total_seconds()
+
+		wake = not self._heap or job.deadline < self._heap[0][0]
+		heapq.heappush(self._heap, (job.deadline, next(self._seq), job))
+		if wake:
+			self._cond.notify()
+
+	def _restore(self, id: str, entry: dict[str, Any]) -> None:
+		grace = timedelta(seconds=entry['grace']) if entry.get('grace') is not None else None
+		job = self._make_job(id, entry['handler'], tuple(entry['args']), entry['kwargs'], trigger=None, owner=entry.get('owner'), grace=grace)
+		self._push(job, datetime.fromisoformat(entry['next_run']))
+		self.logger.debug('Restored %r', job)
+
+	def _load_state(self) -> None:
+		if self.state_file is None or not os.path.exists(self.state_file):
+			return
+
+		try:
+			with open(self.state_file, 'r') as f:
+				entries: dict[str, dict[str, Any]] = json.load(f)
+		except (OSError, ValueError) as e:
+			self.logger.error('Failed to load scheduler state from "%s": %s', self.state_file, e)
+			return
+
+		for id, entry in entries.items():
+			if id in self._jobs:
+				continue
+			if entry['handler'] in self._handlers:
+				self._restore(id, entry)
+			else:
+				self._orphans[id] = entry
+
+	def _save_state(self) -> None:
+		if self.state_file is None:
+			return
+
+		entries = {
+			job.id: {
+				'handler': job.func,
+				'next_run': job.next_run.isoformat(),
+				'args': list(job.args),
+				'kwargs': job.kwargs,
+				'owner': job.owner,
+				'grace': job.grace.total_seconds() if job.grace is not None else None,
+			}
+			for job in self._jobs.values()
+			if job.persistent
+		}
+		# keep pending jobs of handlers that have not been registered (yet)
+		entries.update(self._orphans)
+
+		tmp_file = f'{self.state_file}.tmp'
+		try:
+			with open(tmp_file, 'w') as f:
+				json.dump(entries, f)
+			os.replace(tmp_file, self.state_file)
+		except OSError as e:
+			self.logger.error('Failed to save scheduler state to "%s": %s', self.state_file, e)
+
+
+_SCHEDULER = Scheduler()
+
+def get_scheduler() -> Scheduler:
+	return _SCHEDULER
+
+def configure_scheduler(config: SchedulerConfig) -> Scheduler:
+	_SCHEDULER.configure(timezone=config.timezone, state_file=config.state_file, workers=config.workers)
+	return _SCHEDULER
+
+
+def _parse_cron_field(field: str, lo: int, hi: int, names: list[str]|None = None, *, offset: int = 0) -> set[int]:
+	values = set()
+	for part in field.split(','):
+		value, _, step = part.partition('/')
+		step = int(step) if step else 1
+
+		if value == '*':
+			start, end = lo, hi
+		else:
+			start, _, end = value.partition('-')
+			start = _parse_cron_value(start, names, offset)
+			end = _parse_cron_value(end, names, offset) if end else (hi if step > 1 else start)
+
+		if start < lo or end > hi or start > end or step < 1:
+			raise ValueError(f'Invalid cron field "{field}"')
+		values.update(range(start, end + 1, step))
+	return values
+
+def _parse_cron_value(value: str, names: list[str]|None, offset: int) -> int:
+	if names is not None and value.lower() in names:
+		return names.index(value.lower()) + offset
+	return int(value)
+
+def _to_local(dt: datetime, tz: tzinfo|None) -> datetime:
+	return dt.astimezone(tz) if tz is not None else dt.astimezone()
+
+def _from_local(dt: datetime, tz: tzinfo|None) -> datetime:
+	return dt.replace(tzinfo=tz) if tz is not None else dt.astimezone()
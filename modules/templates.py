@@ -0,0 +1,105 @@
+from typing import Any, Self
+from collections.abc import Mapping
+
+import string
+
+from config import TemplatesConfig
+
+
+FOOTER = '\n\n_🤖 automatically sent message_'
+
+_FORMATTER = string.Formatter()
+
+
+class Template:
+	"""A `str.format`-style template that is parsed once and rendered by joining its pre-split parts."""
+
+	__slots__ = ('source', '_parts')
+
+	def __init__(self, source: str):
+		self.source = source
+		# parsing eagerly also surfaces syntax errors (e.g. unmatched braces) when the config is loaded
+		self._parts = tuple(_FORMATTER.parse(source))
+
+	def render(self, values: Mapping[str, Any]) -> str:
+		out = []
+		append = out.append
+		for literal, field, spec, conversion in self._parts:
+			if literal:
+				append(literal)
+			if field is not None:
+				obj, _ = _FORMATTER.get_field(field, (), values)
+				if conversion:
+					obj = _FORMATTER.convert_field(obj, conversion)
+				append(format(obj, spec or ''))
+		return ''.join(out)
+
+	def __repr__(self) -> str:
+		return f'Template({self.source!r})'
+
+
+class MessageTemplates:
+	"""The compiled templates of a module, grouped by message kind and part."""
+
+	def __init__(self, defaults: dict[str, dict[str, str]], config: TemplatesConfig):
+		self.max_length = config.max_length
+		self._templates = {
+			kind: {
+				part: Template(source)
+				for part, source in {'footer': FOOTER, **parts, **config.overrides.get(kind, {})}.items()
+			}
+			for kind, parts in defaults.items()
+		}
+
+	def builder(self, kind: str) -> 'MessageBuilder':
+		return MessageBuilder(self._templates[kind], self.max_length)
+
+
+class MessageBuilder:
+	def __init__(self, templates: dict[str, Template], max_length: int):
+		self._templates = templates
+		self._max_length = max_length
+		self._parts: list[str] = []
+
+	def add(self, part: str, /, **values) -> Self:
+		self._parts.append(self._templates[part].render(values))
+		return self
+
+	def build(self) -> str:
+		return ''.join(self._parts)
+
+	def split(self) -> list[str]:
+		"""
+		Build the message as chunks of at most `max_length` characters.
+
+		Chunks are only split between parts (e.g. between two participants) unless a single part is too long,
+		in which case it is split at line breaks or, as a last resort, hard at the limit.
+		"""
+		chunks: list[str] = []
+		current: list[str] = []
+		size = 0
+		for part in self._parts:
+			for piece in _split_part(part, self._max_length):
+				if size + len(piece) > self._max_length and current:
+					chunks.append(''.join(current))
+					current.clear()
+					size = 0
+				current.append(piece)
+				size += len(piece)
+		if current:
+			chunks.append(''.join(current))
+		return chunks
+
+
+def _split_part(part: str, max_length: int) -> list[str]:
+	if len(part) <= max_length:
+		return [part]
+
+	pieces = []
+	for line in part.splitlines(keepends=True):
+		while len(line) > max_length:
+			pieces.append(line[:max_length])
+			line = line[max_length:]
+		if line:
+			pieces.append(line)
+	return pieces
@@ -1,52 +1,265 @@
-from config import Config, load_toml_data, HermineConfig, TOMLDict
+from collections.abc import Callable
+from time import perf_counter
+from zoneinfo import ZoneInfo
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from config import Config, load_toml_data, HermineConfig, TemplatesConfig, TOMLDict
 from modules.module import ModuleConfig, Module
-from modules.clients import get_hermine_client
+from modules.coordination import Mode
+from modules.clients import get_hermine_client, get_hermine_dispatcher
+from modules.dispatcher import Priority
+from modules.registry import find_modules
+from modules.push import PushConnection
+from modules.templates import MessageTemplates, MessageBuilder
+from modules.logs import Payload
+from modules.utils import parse_datetime
+from lib.metrics import Counter, Histogram
 
 from lib.hermine import unpaginate
 
 
+COMMANDS = Counter('commands', 'Received chat commands', ('module', 'command', 'result'))
+COMMAND_LATENCY = Histogram('command_latency_seconds', 'Time from receiving a command until it was handled', ('module', 'command'))
+
+
+TEMPLATES = {
+	'help': {
+		'header': '**Commands**',
+		'command': '\n- `{prefix}{name}` {help}',
+	},
+	'unknown': {
+		'body': 'Unknown command `{prefix}{command}`, see `{prefix}help`',
+	},
+	'error': {
+		'body': '❗ Command `{prefix}{command}` failed',
+	},
+	'pong': {
+		'body': 'pong {text}',
+	},
+	'training': {
+		'header': '📅 **{event[name]}**\n_{start:%A, %d.%m.%Y, %H:%M} – {end:%H:%M}_',
+		'none': 'No upcoming trainings',
+	},
+	'alarm': {
+		'header': '🚨 **{event[name]}**\n_{start:%A, %d.%m.%Y, %H:%M}_\n\n{message}',
+		'none': 'No alarms since the last start',
+	},
+	'alarms': {
+		'header': '🗄️ **Last {count} alarms**',
+		'alarm': '\n- _{received:%d.%m.%Y, %H:%M}_ {event[name]}: {message}',
+		'none': 'No alarms have been archived',
+	},
+}
+
+
 class _Config(ModuleConfig):
 	hermine: HermineConfig
+	templates: TemplatesConfig
 
 	prefix: str
-	hermine_channel: int
+	hermine_channels: list[int]
+	workers: int
 
 	def load(self, data: TOMLDict, cfg: Config) -> None:
 		self.hermine = load_toml_data(data.get('hermine'), cfg.hermine)
+		self.templates = load_toml_data(data.get('templates'), cfg.templates)
 
 		self.set_value('prefix', data, default='!')
-		self.set_value('hermine_channel', data)
+		self.set_value('hermine_channels', data, default=[])
+		self.set_value('workers', data, default=4)
+
+		# a single channel can still be given the old way
+		if 'hermine_channel' in data:
+			self.hermine_channels = [*data.get('hermine_channels', []), data['hermine_channel']]
+		self.hermine_channels = list(dict.fromkeys(self.hermine_channels))
+		if len(self.hermine_channels) == 0:
+			raise KeyError('hermine_channels')
+
+
+class CommandContext:
+	__slots__ = ('module', 'command', 'args', 'user', 'channel_id')
+
+	def __init__(self, module: 'UserInterface', command: str, args: list[str], user: dict, channel_id: int):
+		self.module = module
+		self.command = command
+		self.args = args
+		self.user = user
+		self.channel_id = channel_id
+
+	def builder(self, kind: str) -> MessageBuilder:
+		return self.module.templates.builder(kind)
+
+	def reply(self, message: MessageBuilder) -> Future:
+		"""Send `message` to the channel the command was sent in."""
+		message.add('footer')
+
+		for chunk in message.split():
+			future = self.module.outbox.send_msg(('channel', self.channel_id), chunk, priority=Priority.REPLY, is_styled=True)
+		return future
+
+
+class Command:
+	__slots__ = ('name', 'func', 'help')
+
+	def __init__(self, name: str, func: Callable[[CommandContext], None], help: str):
+		self.name = name
+		self.func = func
+		self.help = help
+
+
+class CommandRouter:
+	"""Dispatch table of chat commands, filled with the `command()` decorator."""
+
+	def __init__(self):
+		self._commands: dict[str, Command] = {}
+
+	def command(self, name: str, *aliases: str, help: str = ''):
+		def decorator(func: Callable[[CommandContext], None]):
+			command = Command(name, func, help)
+			for key in (name, *aliases):
+				if key in self._commands:
+					raise ValueError(f'Command "{key}" is already registered')
+				self._commands[key] = command
+			return func
+		return decorator
+
+	def get(self, name: str) -> Command|None:
+		return self._commands.get(name)
+
+	def commands(self) -> list[Command]:
+		return list({id(command): command for command in self._commands.values()}.values())
+
+
+ROUTER = CommandRouter()
+
+MAX_ARCHIVED_ALARMS = 20
 
 
 class UserInterface(Module[_Config]):
-	
+	# channels are split between the replicas, so each command is answered once
+	coordination_mode = Mode.SHARDED
+
+	_pool: ThreadPoolExecutor|None = None
+	push: PushConnection|None = None
+
 	def init(self) -> None:
 		self.hermine = get_hermine_client(self.config.hermine.device_id, self.config.hermine.username, self.config.hermine.password, self.config.hermine.encryption_password)
+		self.outbox = get_hermine_dispatcher(self.hermine, self.config.hermine.username, self.config.hermine.send_rate, self.config.hermine.send_burst, self.config.hermine.target_send_rate, self.config.hermine.target_send_burst, self.config.hermine.send_retries)
+		self.templates = MessageTemplates(TEMPLATES, self.config.templates)
+
+		self.channels = frozenset(self.config.hermine_channels)
+		if self.push is not None:
+			self.push.set_sources([('channel', channel) for channel in self.channels])
+		if self._pool is None:
+			self._pool = ThreadPoolExecutor(max_workers=self.config.workers, thread_name_prefix=f'Thread-{self.name}-command')
 
 	def run(self) -> None:
-		socket = self.hermine.get_socket()
+		self.push = PushConnection(
+			self.hermine,
+			[('channel', channel) for channel in self.channels],
+			name=self.name,
+			reconnect_delay=self.config.hermine.push_reconnect_delay,
+			max_reconnect_delay=self.config.hermine.push_max_reconnect_delay,
+			heartbeat_interval=self.config.hermine.push_heartbeat_interval,
+			catch_up_limit=self.config.hermine.push_catch_up_limit,
+		)
 
-		@socket.on('message_sync')
-		def _(data):
+		# called on the socket.io receive thread, so everything but the filtering is done on the worker pool
+		@self.push.on_message
+		def _(source, data: dict, message: dict|None):
 			if (
 				data['kind'] != 'message' or
 				data['type'] != 'text' or
 				data['text'] is None
 			):
 				return
-			if data['channel_id'] not in [self.config.hermine_channel]:
+			received = perf_counter()
+			self.coordination.handle(str(data['channel_id']), lambda: self._pool.submit(self._handle_message, data, message, received), item=str(data['id']))
+
+		self.push.run()
+
+		self.logger.info('Module finished!')
+
+	def _handle_message(self, data: dict, message: dict|None, received: float) -> None:
+		try:
+			# messages caught up on after a reconnect have been fetched already
+			if message is None:
+				message = next(filter(lambda msg: msg['id'] == data['id'], self.hermine.get_messages(('channel', data['channel_id']))))
+			text = str(message['text'] if message['encrypted'] is False else message['text_decrypted']).strip()
+
+			if not text.startswith(self.config.prefix) or len(text) == len(self.config.prefix):
 				return
-			
-			msg = next(filter(lambda msg: msg['id'] == data['id'], self.hermine.get_messages(('channel', data['channel_id']))))
-			text = str(msg['text'] if msg['encrypted'] is False else msg['text_decrypted']).strip()
+			cmd, *args = text[len(self.config.prefix):].split(None)
+			self._handle_command(CommandContext(self, cmd.lower(), args, data['sender'], data['channel_id']), received)
+		except Exception:
+			self.logger.exception('Failed to handle message #%s', data['id'])
 
-			if text.startswith(self.config.prefix):
-				cmd, *args = text[len(self.config.prefix):].split(None)
-				self._handle_command(cmd.lower(), args, data['sender'], data['channel'])
+	def _handle_command(self, ctx: CommandContext, received: float) -> None:
+		self.logger.debug('Received command "%s" with args %s from user "%s %s" in channel #%d', ctx.command, Payload(ctx.args), ctx.user['first_name'], ctx.user['last_name'], ctx.channel_id)
 
-		socket.wait()
+		command = ROUTER.get(ctx.command)
+		if command is None:
+			COMMANDS.labels(self.name, '', 'unknown').inc()
+			ctx.reply(ctx.builder('unknown').add('body', prefix=self.config.prefix, command=ctx.command))
+			return
 
-		self.logger.info('Module finished!')
-	
-	def _handle_command(self, command: str, args: list[str], user, channel) -> None:
-		self.logger.debug('Received command "%s" with args %s from user "%s %s" in channel #%s', command, args, user['first_name'], user['last_name'], channel['name'])
+		try:
+			command.func(ctx)
+		except Exception:
+			self.logger.exception('Command "%s" failed', command.name)
+			COMMANDS.labels(self.name, command.name, 'error').inc()
+			ctx.reply(ctx.builder('error').add('body', prefix=self.config.prefix, command=ctx.command))
+		else:
+			COMMANDS.labels(self.name, command.name, 'ok').inc()
+		COMMAND_LATENCY.labels(self.name, command.name).observe(perf_counter() - received)
+
+
+@ROUTER.command('help', 'hilfe', help='lists all commands')
+def _help(ctx: CommandContext) -> None:
+	message = ctx.builder('help').add('header')
+	for command in ROUTER.commands():
+		message.add('command', prefix=ctx.module.config.prefix, name=command.name, help=command.help)
+	ctx.reply(message)
+
+
+@ROUTER.command('ping', help='checks whether the bot is listening')
+def _ping(ctx: CommandContext) -> None:
+	ctx.reply(ctx.builder('pong').add('body', text=' '.join(ctx.args)))
+
+
+@ROUTER.command('training', 'ausbildung', 'dienst', help='shows the next training')
+def _training(ctx: CommandContext) -> None:
+	events = [event for module in find_modules('ausbildungsdienst') for event in module.upcoming_events()]
+	if len(events) == 0:
+		ctx.reply(ctx.builder('training').add('none'))
+		return
+
+	event = min(events, key=lambda event: parse_datetime(event['startDate']))
+	tz = ZoneInfo(event['timezone'])
+	ctx.reply(ctx.builder('training').add('header', event=event, start=parse_datetime(event['startDate']).astimezone(tz), end=parse_datetime(event['endDate']).astimezone(tz)))
+
+
+@ROUTER.command('alarm', 'einsatz', help='shows the last alarm')
+def _alarm(ctx: CommandContext) -> None:
+	alarms = [module.last_alarm for module in find_modules('alarmierung') if module.last_alarm is not None]
+	if len(alarms) == 0:
+		ctx.reply(ctx.builder('alarm').add('none'))
+		return
+
+	alarm = max(alarms, key=lambda alarm: parse_datetime(alarm['event']['startDate']))
+	ctx.reply(ctx.builder('alarm').add('header', event=alarm['event'], start=parse_datetime(alarm['event']['startDate']).astimezone(), message=alarm['message']))
+
+
+@ROUTER.command('alarms', 'alarme', 'archiv', help='lists the last archived alarms, `[count]`')
+def _alarms(ctx: CommandContext) -> None:
+	count = min(int(ctx.args[0]), MAX_ARCHIVED_ALARMS) if len(ctx.args) > 0 and ctx.args[0].isdigit() else 5
+	archives = {id(module.archive): module.archive for module in find_modules('alarmierung') if module.archive is not None}
+	alarms = sorted((alarm for archive in archives.values() for alarm in archive.last(count) if alarm.message is not None), key=lambda alarm: alarm.received)[-count:]
+	if len(alarms) == 0:
+		ctx.reply(ctx.builder('alarms').add('none'))
+		return
+
+	message = ctx.builder('alarms').add('header', count=len(alarms))
+	for alarm in reversed(alarms):
+		message.add('alarm', received=alarm.received.astimezone(), event=alarm.payload['event'], message=alarm.payload['message'])
+	ctx.reply(message)
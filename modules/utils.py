@@ -1,9 +1,23 @@
+from typing import Any
+from collections.abc import Callable, Collection, Iterator
+
 from typeguard import typechecked
-from functools import wraps, cache
-from datetime import datetime, timedelta
+import time
+import logging
+import weakref
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+from datetime import datetime
 from threading import Lock
-from schedule import Job, Scheduler
-from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.metrics import Counter
+
+
+CACHE_REQUESTS = Counter('cache_requests', 'Lookups of cached factories', ('function', 'result'))
+CACHE_EVICTIONS = Counter('cache_evictions', 'Values dropped from the caches of cached factories', ('function',))
 
 
 @typechecked
@@ -12,27 +26,208 @@ def parse_datetime(date: str) -> datetime:
 		date = date[:-1] + '+00:00'
 	return datetime.fromisoformat(date)
 
-_LOCKS: dict[str, Lock] = {}
-def synchronized(func):
-	@wraps(func)
-	def inner(*args, **kwargs):
-		with lock:
-			return func(*args, **kwargs)
-	
-	key = str(func.__qualname__)
-	lock = _LOCKS.get(key)
-	if key not in _LOCKS:
-		lock = _LOCKS[key] = Lock()
+_MISSING = object()
 
-	return inner
+# who requests values of caches with `on_evict`, and the values requested in the current `holding()` block
+_holder: contextvars.ContextVar[Any] = contextvars.ContextVar('cache_holder', default=None)
+_acquired: contextvars.ContextVar[list[tuple['LRUCache', int]]|None] = contextvars.ContextVar('cache_acquired', default=None)
+_closing_caches: 'weakref.WeakSet[LRUCache]' = weakref.WeakSet()
 
-def cached(func):
-	return wraps(func)(cache(func))
+@contextmanager
+def holding(holder: Any) -> Iterator[None]:
+	"""
+	Values of caches with `on_evict` requested within are held by `holder` instead of the ones it requested in its
+	previous block, e.g. the clients of a module while it is configured. Values requested outside of a block are held
+	for good.
+	"""
+	acquired: list[tuple[LRUCache, int]] = []
+	holder_token = _holder.set(holder)
+	acquired_token = _acquired.set(acquired)
+	try:
+		yield
+	finally:
+		_acquired.reset(acquired_token)
+		_holder.reset(holder_token)
 
-@typechecked
-def onetime_job(scheduler: Scheduler, time: datetime, job_func: Callable, *args, **kwargs) -> Job:
-	job = Job(1, scheduler).week
-	job.do(job_func, *args, **kwargs)
-	job.next_run = time
-	job.cancel_after = time + timedelta(minutes=10)
-	return job
+	# the previous values stay held if the block failed
+	for cache in list(_closing_caches):
+		cache.release(holder, {value_id for owner, value_id in acquired if owner is cache})
+
+class LRUCache[K, V]:
+	"""
+	Mapping with least-recently-used and time-to-live eviction, `on_evict` is called with every value that is dropped,
+	e.g. to close a client. Values are created under a lock of their own key, so creating one value blocks neither
+	lookups nor the creation of values for other keys, and each is created only once.
+
+	With `on_evict`, the holders of every value handed out are counted (see `holding()`): a dropped value is only
+	passed to `on_evict` once no holder uses it anymore.
+	"""
+
+	def __init__(self, maxsize: int|None = 128, ttl: float|None = None, on_evict: Callable[[V], None]|None = None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.on_evict = on_evict
+
+		self._lock = Lock()
+		# least recently used first; value and the time it expires at
+		self._data: OrderedDict[K, tuple[V, float]] = OrderedDict()
+		# key → lock and number of threads using it, dropped again once unused
+		self._key_locks: dict[K, list[Any]] = {}
+		# id of a value handed out → the value and its holders
+		self._held: dict[int, tuple[V, set[Any]]] = {}
+		if on_evict is not None:
+			_closing_caches.add(self)
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key: K, factory: Callable[[], V]) -> V:
+		"""The value of `key`, created with `factory()` if it is not cached or has expired."""
+		evicted: list[V] = []
+		try:
+			with self._lock:
+				value = self._lookup(key, evicted)
+				if value is not _MISSING:
+					self.hits += 1
+					self._hold(value)
+					return value
+				key_lock = self._key_locks.setdefault(key, [Lock(), 0])
+				key_lock[1] += 1
+
+			try:
+				with key_lock[0]:
+					with self._lock:
+						# created by another thread while this one waited for the key
+						value = self._lookup(key, evicted)
+						if value is not _MISSING:
+							self.hits += 1
+							self._hold(value)
+							return value
+						self.misses += 1
+
+					value = factory()
+					with self._lock:
+						self._data[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else float('inf'))
+						self._hold(value)
+						self._shrink(evicted)
+					return value
+			finally:
+				with self._lock:
+					key_lock[1] -= 1
+					if key_lock[1] == 0:
+						del self._key_locks[key]
+		finally:
+			for value in evicted:
+				self._evicted(value)
+
+	def pop(self, key: K) -> None:
+		with self._lock:
+			entry = self._data.pop(key, None)
+		if entry is not None:
+			self._evicted(entry[0])
+
+	def clear(self) -> None:
+		with self._lock:
+			values = [value for value, _ in self._data.values()]
+			self._data.clear()
+		for value in values:
+			self._evicted(value)
+
+	def release(self, holder: Any, keep: Collection[int] = ()) -> None:
+		"""Drop the holds of `holder` except on the values with the ids in `keep`, closing dropped values no longer held."""
+		closing: list[V] = []
+		with self._lock:
+			cached = {id(value) for value, _ in self._data.values()}
+			for value_id, (value, holders) in list(self._held.items()):
+				if value_id in keep or holder not in holders:
+					continue
+				holders.discard(holder)
+				if len(holders) == 0 and value_id not in cached:
+					del self._held[value_id]
+					closing.append(value)
+		for value in closing:
+			self._close(value)
+
+	def __len__(self) -> int:
+		return len(self._data)
+
+	def _hold(self, value: V) -> None:
+		if self.on_evict is None:
+			return
+		self._held.setdefault(id(value), (value, set()))[1].add(_holder.get())
+		acquired = _acquired.get()
+		if acquired is not None:
+			acquired.append((self, id(value)))
+
+	def _lookup(self, key: K, evicted: list[V]) -> Any:
+		entry = self._data.get(key)
+		if entry is None:
+			return _MISSING
+		value, expires = entry
+		if expires <= time.monotonic():
+			del self._data[key]
+			evicted.append(value)
+			return _MISSING
+		self._data.move_to_end(key)
+		return value
+
+	def _shrink(self, evicted: list[V]) -> None:
+		now = time.monotonic()
+		for key, (value, expires) in list(self._data.items()):
+			if expires <= now:
+				del self._data[key]
+				evicted.append(value)
+		while self.maxsize is not None and len(self._data) > self.maxsize:
+			_, (value, _) = self._data.popitem(last=False)
+			evicted.append(value)
+
+	def _evicted(self, value: V) -> None:
+		self.evictions += 1
+		if self.on_evict is None:
+			return
+		with self._lock:
+			entry = self._held.get(id(value))
+			if entry is not None and len(entry[1]) > 0:
+				# closed once the last holder releases it
+				return
+			self._held.pop(id(value), None)
+		self._close(value)
+
+	def _close(self, value: V) -> None:
+		try:
+			self.on_evict(value)
+		except Exception:
+			logging.exception('Failed to close evicted %r', value)
+
+def cached(func: Callable|None = None, /, *, maxsize: int|None = 128, ttl: float|None = None, close: Callable[[Any], None]|None = None):
+	"""
+	Cache the results of `func` by its arguments in an `LRUCache`, usable as `@cached` or `@cached(maxsize=…)`.
+	Concurrent calls with the same arguments wait for the first one, calls with other arguments do not. Results are
+	passed to `close` once they were dropped and are no longer held (see `holding()`).
+	"""
+	def decorator(func):
+		cache = LRUCache(maxsize, ttl, on_evict=close)
+
+		@wraps(func)
+		def inner(*args, **kwargs):
+			return cache.get((args, tuple(sorted(kwargs.items()))), lambda: func(*args, **kwargs))
+		inner.cache = cache
+
+		# read the statistics of the cache when collected, so lookups stay free of any overhead
+		CACHE_REQUESTS.labels(func.__qualname__, 'hit').set_function(lambda: cache.hits)
+		CACHE_REQUESTS.labels(func.__qualname__, 'miss').set_function(lambda: cache.misses)
+		CACHE_EVICTIONS.labels(func.__qualname__).set_function(lambda: cache.evictions)
+
+		return inner
+
+	return decorator(func) if func is not None else decorator
+
+def parallel(*funcs: Callable[[], Any]) -> list[Any]:
+	"""Call `funcs` concurrently and return their results in order, raising the first exception if any failed."""
+	if len(funcs) == 1:
+		return [funcs[0]()]
+	with ThreadPoolExecutor(max_workers=len(funcs), thread_name_prefix='Thread-parallel') as executor:
+		# in the context of the caller, so values of cached factories are held by the same holder
+		futures = [executor.submit(contextvars.copy_context().run, func) for func in funcs]
+	return [future.result() for future in futures]
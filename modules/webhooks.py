@@ -0,0 +1,129 @@
+from collections.abc import Callable
+
+import hmac
+import json
+import logging
+import threading
+import ipaddress
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from modules.utils import cached
+from modules.logs import Payload
+from lib.metrics import Counter
+
+
+WEBHOOK_REQUESTS = Counter('webhook_requests', 'Requests to the webhook receiver', ('path', 'result'))
+
+MAX_BODY = 1 << 20
+
+
+class WebhookServer:
+	"""
+	Lightweight HTTP receiver for push notifications, e.g. of Groupalarm. Modules route a path to a callback that is
+	called with the decoded JSON body; it should only schedule the actual work, as the sender waits for the response.
+
+	Requests have to carry the secret of the route in the `X-Webhook-Secret` header or the `token` query parameter.
+	"""
+
+	def __init__(self, host: str, port: int):
+		self.host = host
+		self.port = port
+		self.logger = logging.getLogger('webhooks')
+
+		self._lock = threading.Lock()
+		# path → secret and callback
+		self._routes: dict[str, tuple[str|None, Callable[[dict|None], None]]] = {}
+
+		server = self
+
+		class _Handler(BaseHTTPRequestHandler):
+			def do_POST(self):
+				path, _, query = self.path.partition('?')
+				self.send_response(server._handle(path, query, self.headers, self.rfile))
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+
+			def log_message(self, format, *args):
+				server.logger.debug(format, *args)
+
+		self._server = ThreadingHTTPServer((host, port), _Handler)
+		self._server.daemon_threads = True
+		threading.Thread(name='Thread-webhooks', target=self._server.serve_forever, daemon=True).start()
+		self.logger.info('Receiving webhooks on %s:%d', host, self._server.server_port)
+
+	def route(self, path: str, callback: Callable[[dict|None], None], *, secret: str|None = None) -> None:
+		"""Call `callback` for requests to `path`, replacing the previous route of the path."""
+		with self._lock:
+			self._routes[path] = (secret, callback)
+
+	def unroute(self, path: str) -> None:
+		with self._lock:
+			self._routes.pop(path, None)
+
+	def close(self) -> None:
+		self._server.shutdown()
+		self._server.server_close()
+
+	def _handle(self, path: str, query: str, headers, body) -> int:
+		with self._lock:
+			route = self._routes.get(path)
+		if route is None:
+			WEBHOOK_REQUESTS.labels('', 'not_found').inc()
+			return 404
+		secret, callback = route
+
+		if secret is not None:
+			token = headers.get('X-Webhook-Secret') or _query_token(query)
+			if token is None or not hmac.compare_digest(token.encode('utf-8'), secret.encode('utf-8')):
+				self.logger.warning('Rejected webhook to %s with a wrong secret', path)
+				WEBHOOK_REQUESTS.labels(path, 'unauthorized').inc()
+				return 401
+
+		try:
+			length = int(headers.get('Content-Length') or 0)
+		except ValueError:
+			length = -1
+		if length < 0:
+			WEBHOOK_REQUESTS.labels(path, 'bad_request').inc()
+			return 400
+		if length > MAX_BODY:
+			WEBHOOK_REQUESTS.labels(path, 'too_large').inc()
+			return 413
+		data = None
+		if length > 0:
+			try:
+				data = json.loads(body.read(length))
+			except ValueError:
+				# the notification itself is what counts, its body is only a hint
+				self.logger.debug('Webhook to %s without a JSON body', path)
+		self.logger.debug('Received webhook to %s: %s', path, Payload(data))
+
+		try:
+			callback(data)
+		except Exception:
+			self.logger.exception('Failed to handle webhook to %s', path)
+			WEBHOOK_REQUESTS.labels(path, 'failed').inc()
+			return 500
+		WEBHOOK_REQUESTS.labels(path, 'accepted').inc()
+		return 202
+
+
+@cached(close=lambda server: server.close())
+def get_webhook_server(host: str, port: int) -> WebhookServer:
+	return WebhookServer(host, port)
+
+
+def is_loopback(host: str) -> bool:
+	"""Whether `host` only accepts connections of this machine."""
+	if host == 'localhost':
+		return True
+	try:
+		return ipaddress.ip_address(host).is_loopback
+	except ValueError:
+		return False
+
+
+def _query_token(query: str) -> str|None:
+	values = parse_qs(query).get('token')
+	return values[0] if values else None
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from concurrent.futures import Future
+
+from modules.alarmierung import TEMPLATES, Alarmierung
+from modules.archive import ArchivedAlarm
+from modules.templates import MessageTemplates
+
+
+class _Outbox:
+	def __init__(self):
+		self.sent = []
+
+	def send_msg(self, target, message, **kwargs):
+		self.sent.append(target)
+		future = Future()
+		future.set_result({'id': len(self.sent)})
+		return future
+
+
+def test_replay_goes_to_the_given_channel_only():
+	module = Alarmierung('alarmierung')
+	module.config = SimpleNamespace(hermine_channel=1, groupalarm_unit=None, groupalarm_label=None, incident_severities=[])
+	module.templates = MessageTemplates(TEMPLATES, SimpleNamespace(max_length=4096, overrides={}))
+	module.enrichment = None
+	module.incidents = None
+	module.archive = None
+	module.outbox = _Outbox()
+	module.last_alarm = {'event': {'id': 1}}
+
+	payload = {'event': {'id': 2, 'name': 'Einsatz', 'severity': {'icon': '🔴', 'name': 'Hoch'}, 'startDate': '2026-10-19T12:00:00Z'}, 'message': 'Alarm', 'alarmResources': {'units': [], 'labels': []}}
+	assert module.replay([ArchivedAlarm(datetime.now(timezone.utc), 2, payload, ['Alarm'])], channel=7, speed=0) == 1
+
+	assert module.outbox.sent == [('channel', 7)]
+	assert module.last_alarm == {'event': {'id': 1}}
@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from modules.appointments import PlannedAppointment, diff, read_ics
+
+
+BERLIN = ZoneInfo('Europe/Berlin')
+
+
+def _ics(tmp_path, *events: str) -> str:
+	path = tmp_path / 'plan.ics'
+	path.write_text('BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:test\n' + ''.join(f'BEGIN:VEVENT\n{event.strip()}\nEND:VEVENT\n' for event in events) + 'END:VCALENDAR\n')
+	return str(path)
+
+
+def _existing(id: int, name: str, start: datetime, end: datetime, **fields) -> dict:
+	return {'id': id, 'name': name, 'startDate': start.isoformat(), 'endDate': end.isoformat(), **fields}
+
+
+def test_read_ics_imports_every_occurrence(tmp_path):
+	path = _ics(tmp_path, '''
+UID:dienst
+SUMMARY:Dienst
+DESCRIPTION:Fahrzeugkunde\\, Teil 1
+CLASS:PUBLIC
+DTSTART;TZID=Europe/Berlin:20260301T190000
+DURATION:PT2H
+RRULE:FREQ=WEEKLY;COUNT=4
+EXDATE;TZID=Europe/Berlin:20260315T190000
+''')
+	plan = list(read_ics(path, label_ids=[7]))
+
+	assert [appointment.start for appointment in plan] == [datetime(2026, 3, day, 19, tzinfo=BERLIN) for day in (1, 8, 22)]
+	assert all(appointment.end - appointment.start == timedelta(hours=2) for appointment in plan)
+	assert plan[0].name == 'Dienst'
+	assert plan[0].description == 'Fahrzeugkunde, Teil 1'
+	assert plan[0].label_ids == [7]
+	assert plan[0].is_public
+
+
+def test_read_ics_requires_an_end_for_endless_events(tmp_path):
+	path = _ics(tmp_path, '''
+UID:dienst
+SUMMARY:Dienst
+DTSTART;TZID=Europe/Berlin:20260301T190000
+DTEND;TZID=Europe/Berlin:20260301T210000
+RRULE:FREQ=WEEKLY
+''')
+	with pytest.raises(ValueError):
+		list(read_ics(path))
+
+	plan = list(read_ics(path, until=datetime(2026, 3, 31, tzinfo=BERLIN)))
+	assert len(plan) == 5
+
+
+def test_read_ics_floating_times_are_in_the_given_timezone(tmp_path):
+	path = _ics(tmp_path, '''
+UID:dienst
+SUMMARY:Dienst
+DTSTART:20260301T190000
+DTEND:20260301T210000
+''')
+	(appointment,) = read_ics(path, tz=BERLIN)
+
+	assert appointment.start == datetime(2026, 3, 1, 19, tzinfo=BERLIN)
+	assert not appointment.is_public
+
+
+def test_diff_matches_by_name_and_start():
+	start = datetime(2026, 3, 1, 19, tzinfo=BERLIN)
+	unchanged = PlannedAppointment('Dienst', start, start + timedelta(hours=2))
+	moved_end = PlannedAppointment('Dienst', start + timedelta(days=7), start + timedelta(days=7, hours=3))
+	new = PlannedAppointment('Ausbildung', start, start + timedelta(hours=2))
+	existing = [
+		_existing(1, 'Dienst', start, start + timedelta(hours=2)),
+		_existing(2, 'Dienst', start + timedelta(days=7), start + timedelta(days=7, hours=2)),
+		_existing(3, 'Dienst', start + timedelta(days=14), start + timedelta(days=14, hours=2)),
+	]
+
+	changes = diff([unchanged, moved_end, new], existing)
+	assert changes.create == [new]
+	assert changes.update == [(2, moved_end)]
+	assert changes.delete == []
+	assert changes.unchanged == 1
+
+	changes = diff([unchanged, moved_end, new], existing, prune=True)
+	assert [appointment['id'] for appointment in changes.delete] == [3]
+
+
+def test_diff_only_compares_fields_the_existing_appointment_has():
+	start = datetime(2026, 3, 1, 19, tzinfo=BERLIN)
+	planned = PlannedAppointment('Dienst', start, start + timedelta(hours=2), label_ids=[2, 1], is_public=True)
+
+	assert diff([planned], [_existing(1, 'Dienst', start, start + timedelta(hours=2))]).unchanged == 1
+	assert diff([planned], [_existing(1, 'Dienst', start, start + timedelta(hours=2), labelIDs=[1, 2], isPublic=True)]).unchanged == 1
+	assert len(diff([planned], [_existing(1, 'Dienst', start, start + timedelta(hours=2), labelIDs=[1])]).update) == 1
+
+
+def test_diff_deletes_duplicates_only_with_prune():
+	start = datetime(2026, 3, 1, 19, tzinfo=BERLIN)
+	planned = PlannedAppointment('Dienst', start, start + timedelta(hours=2))
+	existing = [_existing(1, 'Dienst', start, start + timedelta(hours=2)), _existing(2, 'Dienst', start, start + timedelta(hours=2))]
+
+	assert diff([planned], existing).delete == []
+	assert [appointment['id'] for appointment in diff([planned], existing, prune=True).delete] == [2]
@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+from datetime import timedelta
+
+import pytest
+
+from config import Config
+from modules.ausbildungsdienst import Ausbildungsdienst, _Config
+from modules.scheduler import Job, Scheduler
+
+
+def _config(tmp_path, text: str) -> Config:
+	path = tmp_path / 'config.toml'
+	path.write_text(text)
+	return Config(str(path))
+
+
+def test_reloading_the_config_does_not_repeat_the_old_label(tmp_path):
+	config = _config(tmp_path, '[modules.ausbildungsdienst]\nhermine_channel = 1\ngroupalarm_labels = [10, 20]\ngroupalarm_label = 20\n')
+	cfg = _Config()
+	cfg.load(config.module_data('ausbildungsdienst'), config)
+	assert cfg.groupalarm_labels == [10, 20]
+
+	cfg.load(config.module_data('ausbildungsdienst'), config)
+	assert cfg.groupalarm_labels == [10, 20]
+
+	config = _config(tmp_path, '[modules.ausbildungsdienst]\nhermine_channel = 1\ngroupalarm_label = 30\n')
+	cfg.load(config.module_data('ausbildungsdienst'), config)
+	assert cfg.groupalarm_labels == [30]
+
+
+def test_webhooks_on_public_addresses_require_a_secret(tmp_path):
+	cfg = _Config()
+	config = _config(tmp_path, '[modules.ausbildungsdienst]\nhermine_channel = 1\nwebhook_port = 8080\nwebhook_host = "0.0.0.0"\n')
+	with pytest.raises(ValueError):
+		cfg.load(config.module_data('ausbildungsdienst'), config)
+
+	config = _config(tmp_path, '[modules.ausbildungsdienst]\nhermine_channel = 1\nwebhook_port = 8080\nwebhook_host = "0.0.0.0"\nwebhook_secret = "s3cret"\n')
+	cfg.load(config.module_data('ausbildungsdienst'), config)
+
+	config = _config(tmp_path, '[modules.ausbildungsdienst]\nhermine_channel = 1\nwebhook_port = 8080\n')
+	cfg = _Config()
+	cfg.load(config.module_data('ausbildungsdienst'), config)
+	assert cfg.webhook_host == '127.0.0.1'
+
+
+def _module() -> Ausbildungsdienst:
+	module = Ausbildungsdienst('ausbildungsdienst')
+	module.scheduler = Scheduler()
+	module.scheduler.handler(f'{module.name}.reminder', lambda: None)
+	module.config = SimpleNamespace(reminder_time=timedelta(hours=10))
+	return module
+
+
+def _reminders(module: Ausbildungsdienst) -> dict[str, Job]:
+	return {job.id.removeprefix('ausbildungsdienst.reminder.'): job for job in module.scheduler.jobs(owner=module.name)}
+
+
+def test_reschedule_only_touches_changed_reminders():
+	module = _module()
+	now = module.scheduler.now().replace(microsecond=0)
+	kept, moved, soon = now + timedelta(days=2), now + timedelta(days=3), now + timedelta(hours=5)
+
+	module._reschedule({kept, moved, soon}, timedelta(weeks=1))
+	reminders = _reminders(module)
+	# the reminder of the appointment in five hours would have been due already
+	assert set(reminders) == {kept.isoformat(), moved.isoformat()}
+	assert reminders[kept.isoformat()].next_run == kept - timedelta(hours=10)
+
+	moved_to = now + timedelta(days=4)
+	module._reschedule({kept, moved_to}, timedelta(weeks=1))
+	rescheduled = _reminders(module)
+	assert set(rescheduled) == {kept.isoformat(), moved_to.isoformat()}
+	assert rescheduled[kept.isoformat()] is reminders[kept.isoformat()]
+	assert reminders[moved.isoformat()].cancelled
+
+
+def test_reschedule_leaves_reminders_beyond_the_timespan_alone():
+	module = _module()
+	now = module.scheduler.now().replace(microsecond=0)
+	later = now + timedelta(days=10)
+
+	module._reschedule({later}, timedelta(weeks=2))
+	module._reschedule(set(), timedelta(days=1))
+
+	assert set(_reminders(module)) == {later.isoformat()}
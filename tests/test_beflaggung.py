@@ -0,0 +1,15 @@
+import logging
+
+from config import Config
+from modules.beflaggung import _Config
+
+
+def test_legacy_imap_options_are_reported(tmp_path, caplog):
+	path = tmp_path / 'config.toml'
+	path.write_text('[modules.beflaggung]\nhermine_channel = 1\ncalendar = "flags"\nlocation = {}\nidle_timeout = 600\nrecon_delay = 5\n')
+	config = Config(str(path))
+
+	with caplog.at_level(logging.WARNING, logger='modules.beflaggung'):
+		_Config().load(config.module_data('beflaggung'), config)
+
+	assert [record.args for record in caplog.records] == [('idle_timeout', 'idle_timeout'), ('recon_delay', 'reconnect_delay')]
@@ -0,0 +1,101 @@
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from modules.calendars import ParsedCalendar
+
+
+BERLIN = ZoneInfo('Europe/Berlin')
+
+
+def _calendar(*events: str) -> ParsedCalendar:
+	return ParsedCalendar('BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:test\n' + ''.join(f'BEGIN:VEVENT\n{event.strip()}\nEND:VEVENT\n' for event in events) + 'END:VCALENDAR\n')
+
+
+def _starts(calendar: ParsedCalendar, start: datetime, end: datetime|None = None) -> list[datetime]:
+	return [event.start for event in calendar.events(start, end)]
+
+
+WEEKLY = '''
+UID:weekly
+SUMMARY:Dienst
+DTSTART;TZID=Europe/Berlin:20260301T190000
+DTEND;TZID=Europe/Berlin:20260301T210000
+RRULE:FREQ=WEEKLY;UNTIL=20260405T170000Z
+'''
+
+
+def test_until_does_not_drift_over_repeated_queries():
+	calendar = _calendar(WEEKLY)
+	start = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+	expected = [datetime(2026, 3, day, 19, tzinfo=BERLIN) for day in (1, 8, 15, 22, 29)] + [datetime(2026, 4, 5, 19, tzinfo=BERLIN)]
+	for _ in range(50):
+		assert _starts(calendar, start) == expected
+
+
+def test_occurrences_keep_their_local_time_across_dst():
+	calendar = _calendar(WEEKLY)
+	starts = _starts(calendar, datetime(2026, 3, 20, tzinfo=timezone.utc))
+
+	assert [start.astimezone(BERLIN).hour for start in starts] == [19, 19, 19]
+	assert [start.astimezone(BERLIN).utcoffset() for start in starts] == [timedelta(hours=1), timedelta(hours=2), timedelta(hours=2)]
+
+
+def test_events_overlapping_the_start_are_included():
+	calendar = _calendar(WEEKLY)
+
+	event = calendar.first(datetime(2026, 3, 8, 20, tzinfo=BERLIN))
+	assert event.start == datetime(2026, 3, 8, 19, tzinfo=BERLIN)
+	assert event.end == datetime(2026, 3, 8, 21, tzinfo=BERLIN)
+
+
+def test_exdate_rdate_and_overridden_occurrences():
+	calendar = _calendar(
+		WEEKLY + 'EXDATE;TZID=Europe/Berlin:20260308T190000\nRDATE;TZID=Europe/Berlin:20260310T180000\n',
+		'''
+UID:weekly
+SUMMARY:Dienst (verschoben)
+RECURRENCE-ID;TZID=Europe/Berlin:20260315T190000
+DTSTART;TZID=Europe/Berlin:20260316T190000
+DTEND;TZID=Europe/Berlin:20260316T210000
+''',
+	)
+	events = list(calendar.events(datetime(2026, 3, 1, tzinfo=BERLIN), datetime(2026, 3, 20, tzinfo=BERLIN)))
+
+	assert [(event.start, event.summary) for event in events] == [
+		(datetime(2026, 3, 1, 19, tzinfo=BERLIN), 'Dienst'),
+		(datetime(2026, 3, 10, 18, tzinfo=BERLIN), 'Dienst'),
+		(datetime(2026, 3, 16, 19, tzinfo=BERLIN), 'Dienst (verschoben)'),
+	]
+
+
+def test_all_day_events_with_a_date_until():
+	calendar = _calendar('''
+UID:flag
+SUMMARY:Beflaggung
+DTSTART;VALUE=DATE:20260501
+DTEND;VALUE=DATE:20260502
+RRULE:FREQ=YEARLY;UNTIL=20280501
+''')
+
+	assert [start.date() for start in _starts(calendar, datetime(2026, 1, 1, tzinfo=timezone.utc))] == [date(2026, 5, 1), date(2027, 5, 1), date(2028, 5, 1)]
+
+
+def test_endless_events_are_expanded_lazily():
+	calendar = _calendar('''
+UID:daily
+SUMMARY:Täglich
+DTSTART:20000101T080000Z
+DTEND:20000101T090000Z
+RRULE:FREQ=DAILY
+''')
+
+	assert calendar.first(datetime(2026, 10, 19, 12, tzinfo=timezone.utc)).start == datetime(2026, 10, 20, 8, tzinfo=timezone.utc)
+
+
+def test_events_are_copies():
+	calendar = _calendar(WEEKLY)
+	start = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+	calendar.first(start).url = 'https://example.org'
+	assert calendar.first(start).url is None
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+
+import pytest
+
+from modules import coordination
+from modules.coordination import Coordinator, FileBackend, MQTTBackend, Mode, ModuleCoordination, SQLiteBackend, ranked
+
+
+class _Message:
+	def __init__(self, topic: str, payload: bytes):
+		self.topic = topic
+		self.payload = payload
+
+
+class _Broker:
+	"""Delivers published messages to the subscriptions of all clients right away, keeping retained ones."""
+
+	def __init__(self):
+		self.subscriptions = []
+		self.retained = {}
+
+	def client(self) -> '_Client':
+		return _Client(self)
+
+	def publish(self, topic: str, payload):
+		payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+		for pattern, callback in list(self.subscriptions):
+			if _matches(pattern, topic):
+				callback(_Message(topic, payload))
+
+
+class _Client:
+	def __init__(self, broker: _Broker):
+		self.broker = broker
+
+	def subscribe(self, topic, callback):
+		self.broker.subscriptions.append((topic, callback))
+
+	def publish(self, topic, payload, *, qos=0, retain=False):
+		self.broker.publish(topic, payload)
+
+	def loop_forever(self):
+		pass
+
+
+def _matches(pattern: str, topic: str) -> bool:
+	parts, names = pattern.split('/'), topic.split('/')
+	return len(parts) == len(names) and all(part in ('+', name) for part, name in zip(parts, names))
+
+
+@pytest.fixture(params=['file', 'sqlite', 'mqtt'])
+def backends(request, tmp_path):
+	"""Two backends of different replicas sharing the same state."""
+	match request.param:
+		case 'file':
+			return FileBackend(str(tmp_path)), FileBackend(str(tmp_path))
+		case 'sqlite':
+			return SQLiteBackend(str(tmp_path / 'db')), SQLiteBackend(str(tmp_path / 'db'))
+		case 'mqtt':
+			broker = _Broker()
+			return MQTTBackend(broker.client(), 'test'), MQTTBackend(broker.client(), 'test')
+
+
+def test_claim_is_exclusive(backends):
+	a, b = backends
+	assert a.claim('alarm', 'a', 60)
+	assert not b.claim('alarm', 'b', 60)
+	assert b.claim('other', 'b', 60)
+
+
+def test_claim_can_be_repeated_by_its_owner(backends):
+	a, _ = backends
+	assert a.claim('mail', 'a', 60)
+	# e.g. retrying a mail whose handling failed
+	assert a.claim('mail', 'a', 60)
+
+
+def test_expired_claims_can_be_claimed_again(backends):
+	a, b = backends
+	assert a.claim('alarm', 'a', 0.05)
+	time.sleep(0.1)
+	a.heartbeat('a', 60)
+	assert b.claim('alarm', 'b', 60)
+
+
+@pytest.mark.parametrize('kind', ['file', 'sqlite'])
+def test_lease_is_lost_once_it_is_not_renewed(kind, tmp_path):
+	path = str(tmp_path) if kind == 'file' else str(tmp_path / 'db')
+	backend = FileBackend if kind == 'file' else SQLiteBackend
+	a, b = backend(path), backend(path)
+
+	assert a.acquire('ausbildungsdienst', 'a', 0.05)
+	assert a.acquire('ausbildungsdienst', 'a', 0.05)
+	assert not b.acquire('ausbildungsdienst', 'b', 0.05)
+
+	# a hangs and stops renewing
+	time.sleep(0.1)
+	assert b.acquire('ausbildungsdienst', 'b', 60)
+	assert not a.acquire('ausbildungsdienst', 'a', 60)
+
+	b.release('ausbildungsdienst', 'b')
+	assert a.acquire('ausbildungsdienst', 'a', 60)
+
+
+def _coordinator(backend, replica_id: str, members: list[str]) -> Coordinator:
+	coordinator = Coordinator()
+	coordinator.backend = backend
+	coordinator.replica_id = replica_id
+	coordinator._members = members
+	return coordinator
+
+
+def _key_preferring(replica_id: str, members: list[str]) -> str:
+	return next(key for key in (f'channel-{i}' for i in range(100)) if ranked(key, members)[0] == replica_id)
+
+
+def test_sharded_item_is_taken_over_if_the_preferred_replica_does_not_claim_it(tmp_path, monkeypatch):
+	monkeypatch.setattr(coordination, 'CLAIM_CONFIRM_TIME', 0.1)
+	members = ['a', 'b']
+	key = _key_preferring('a', members)
+	# a crashed, but is still a member until its heartbeat expires
+	b = _coordinator(FileBackend(str(tmp_path)), 'b', members)
+
+	wait = b.owns(key, f'{key}:1')
+	assert wait is not True and wait is not False and 0 < wait <= 0.1 + 1e-6
+
+	time.sleep(wait)
+	assert b.owns(key, f'{key}:1') is True
+
+
+def test_sharded_item_claimed_by_the_preferred_replica_is_skipped(tmp_path, monkeypatch):
+	monkeypatch.setattr(coordination, 'CLAIM_CONFIRM_TIME', 0.1)
+	members = ['a', 'b']
+	key = _key_preferring('a', members)
+	a = _coordinator(FileBackend(str(tmp_path)), 'a', members)
+	b = _coordinator(FileBackend(str(tmp_path)), 'b', members)
+
+	assert a.owns(key, f'{key}:1') is True
+	wait = b.owns(key, f'{key}:1')
+	time.sleep(wait)
+	assert b.owns(key, f'{key}:1') is False
+	# further items of the partition still go to a
+	assert a.owns(key, f'{key}:2') is True
+
+
+def test_mqtt_claims_are_ranked_between_replicas(monkeypatch):
+	monkeypatch.setattr(coordination, 'CLAIM_CONFIRM_TIME', 0.1)
+	broker = _Broker()
+	members = ['a', 'b']
+	key = _key_preferring('b', members)
+	a = _coordinator(MQTTBackend(broker.client(), 'test'), 'a', members)
+	b = _coordinator(MQTTBackend(broker.client(), 'test'), 'b', members)
+
+	# without atomic claims, a replica that is not preferred does not claim right away
+	wait = a.claim(key)
+	assert wait is not True and wait is not False
+	assert b.claim(key) is True
+	time.sleep(wait)
+	assert a.claim(key) is False
+
+
+def test_mail_is_undecided_while_the_preferred_replica_may_claim_it(monkeypatch):
+	monkeypatch.setattr(coordination, 'CLAIM_CONFIRM_TIME', 0.1)
+	broker = _Broker()
+	members = ['a', 'b']
+	key = next(key for key in (f'mail-{i}' for i in range(100)) if ranked(f'beflaggung:{key}', members)[0] == 'b')
+	a = ModuleCoordination(_coordinator(MQTTBackend(broker.client(), 'test'), 'a', members), 'beflaggung', Mode.ACTIVE)
+	b = ModuleCoordination(_coordinator(MQTTBackend(broker.client(), 'test'), 'b', members), 'beflaggung', Mode.ACTIVE)
+
+	assert a.should_handle(key) is None
+	assert b.should_handle(key) is True
+	time.sleep(0.1)
+	assert a.should_handle(key) is False
+
+
+def test_members_expire_after_missed_heartbeats(tmp_path):
+	a, b = FileBackend(str(tmp_path)), FileBackend(str(tmp_path))
+	a.heartbeat('a', 0.05)
+	assert b.heartbeat('b', 60) == ['a', 'b']
+	time.sleep(0.1)
+	assert b.heartbeat('b', 60) == ['b']
+
+
+def test_claim_survives_a_sweep_while_it_is_created(tmp_path, monkeypatch):
+	a, b = FileBackend(str(tmp_path)), FileBackend(str(tmp_path))
+	utime = os.utime
+
+	def sweep_then_utime(path, times):
+		# the new file has no expiry yet
+		monkeypatch.setattr(os, 'utime', utime)
+		b.heartbeat('b', 60)
+		utime(path, times)
+
+	monkeypatch.setattr(os, 'utime', sweep_then_utime)
+	assert a.claim('alarm', 'a', 60)
+	monkeypatch.setattr(os, 'utime', sweep_then_utime)
+	a.heartbeat('a', 60)
+	assert not b.claim('alarm', 'b', 60)
+	assert b.heartbeat('b', 60) == ['a', 'b']
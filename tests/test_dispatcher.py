@@ -0,0 +1,123 @@
+import socket
+from threading import Event, Thread
+
+import pytest
+import requests
+
+from modules.dispatcher import OutboundDispatcher, Priority
+
+
+class _Client:
+	"""Stands in for the Hermine client, sending blocks until `release` is set."""
+
+	def __init__(self):
+		self.release = Event()
+		self.sent = []
+
+	def send_msg(self, target, message, **kwargs):
+		self.release.wait(5)
+		self.sent.append((target, message))
+		return {'id': len(self.sent)}
+
+
+def _dispatcher(client: _Client) -> OutboundDispatcher:
+	return OutboundDispatcher(client, name='test', rate=1000.0, burst=1000, target_rate=1000.0, target_burst=1000, workers=1)
+
+
+def test_identical_notices_are_coalesced():
+	client = _Client()
+	dispatcher = _dispatcher(client)
+
+	blocker = dispatcher.send_msg(('channel', 1), 'first')
+	futures = [dispatcher.send_msg(('channel', 2), 'same') for _ in range(3)]
+	client.release.set()
+
+	assert futures[0] is futures[1] is futures[2]
+	for future in [blocker, *futures]:
+		future.result(5)
+	assert client.sent.count((('channel', 2), 'same')) == 1
+	dispatcher.close()
+
+
+def test_alarms_with_the_same_text_are_all_sent():
+	client = _Client()
+	dispatcher = _dispatcher(client)
+
+	blocker = dispatcher.send_msg(('channel', 1), 'first')
+	futures = [dispatcher.send_msg(('channel', 2), 'F1 Brand', priority=Priority.ALARM) for _ in range(2)]
+	futures += [dispatcher.send_msg(('channel', 2), 'F1 Brand', priority=Priority.ALARM, dedup_key=event_id) for event_id in (7, 8)]
+	client.release.set()
+
+	for future in [blocker, *futures]:
+		future.result(5)
+	assert client.sent.count((('channel', 2), 'F1 Brand')) == 4
+	dispatcher.close()
+
+
+def test_alarms_with_the_same_dedup_key_are_coalesced():
+	client = _Client()
+	dispatcher = _dispatcher(client)
+
+	blocker = dispatcher.send_msg(('channel', 1), 'first')
+	first = dispatcher.send_msg(('channel', 2), 'F1 Brand', priority=Priority.ALARM, dedup_key=7)
+	second = dispatcher.send_msg(('channel', 2), 'F1 Brand', priority=Priority.ALARM, dedup_key=7)
+	client.release.set()
+
+	assert first is second
+	blocker.result(5)
+	first.result(5)
+	assert client.sent.count((('channel', 2), 'F1 Brand')) == 1
+	dispatcher.close()
+
+
+class _Hangup:
+	"""Accepts connections and closes them once it read the request, like a server that crashed while handling it."""
+
+	def __init__(self):
+		self.socket = socket.create_server(('127.0.0.1', 0))
+		self.url = f'http://127.0.0.1:{self.socket.getsockname()[1]}/message/send'
+		self.received = 0
+		Thread(target=self._serve, daemon=True).start()
+
+	def _serve(self):
+		while True:
+			try:
+				connection, _ = self.socket.accept()
+			except OSError:
+				return
+			with connection:
+				connection.recv(65536)
+				self.received += 1
+
+
+def _post(url: str, calls: list[str]):
+	calls.append(url)
+	return requests.post(url, data={'text': 'Alarm'}, timeout=(5, 5))
+
+
+def test_requests_that_failed_to_connect_are_retried(monkeypatch):
+	dispatcher = OutboundDispatcher(_Client(), name='test', max_retries=2, workers=1)
+	monkeypatch.setattr(dispatcher, '_backoff', lambda request: 0.0)
+	# nothing listens on the port of a closed server
+	closed = socket.create_server(('127.0.0.1', 0))
+	url = f'http://127.0.0.1:{closed.getsockname()[1]}/message/send'
+	closed.close()
+
+	calls = []
+	with pytest.raises(requests.ConnectionError):
+		dispatcher.submit('message/send', _post, url, calls).result(5)
+	assert len(calls) == 3
+	dispatcher.close()
+
+
+def test_requests_the_server_may_have_received_are_not_retried(monkeypatch):
+	dispatcher = OutboundDispatcher(_Client(), name='test', max_retries=2, workers=1)
+	monkeypatch.setattr(dispatcher, '_backoff', lambda request: 0.0)
+	server = _Hangup()
+
+	calls = []
+	with pytest.raises(requests.ConnectionError):
+		dispatcher.submit('message/send', _post, server.url, calls).result(5)
+	assert len(calls) == 1 and server.received == 1
+	server.socket.close()
+	dispatcher.close()
@@ -0,0 +1,98 @@
+import json
+
+import Crypto.PublicKey.RSA
+import pytest
+import requests
+
+import modules.hermine  # noqa: F401, installs the crypto hook
+from lib.hermine import CONNECT_TIMEOUT, READ_TIMEOUT, AESBatchCodec, StashCatClient, _encrypt_aes
+from lib.tracing import TRACER, use_span
+from modules.hermine import CRYPTO_SECONDS
+
+
+class _Client(StashCatClient):
+	"""Answers the requests of sending a message without a server."""
+
+	def __init__(self):
+		super().__init__('device')
+		self.private_key = Crypto.PublicKey.RSA.generate(1024)
+		self.user_id = 1
+		self.sent = []
+
+	def _post(self, url, *, data, include_auth=True, **kwargs):
+		self.sent.append((url, data))
+		match url:
+			case 'channels/create':
+				return {'channel': {'id': 5, 'key': data['encryption_key']}}
+			case 'message/send':
+				return {'message': {'id': 1}}
+			case 'message/content':
+				key = self._get_conversation_key(('channel', 5))
+				iv = bytes(16)
+				return {'messages': [{'kind': 'message', 'encrypted': True, 'text': _encrypt_aes(b'hallo', key, iv).hex(), 'iv': iv.hex(), 'location': None}]}
+		raise AssertionError(url)
+
+
+def _count(operation: str) -> int:
+	samples = {suffix: value for suffix, _, value in CRYPTO_SECONDS.labels(operation)._samples()}
+	return int(samples['_count'])
+
+
+def test_crypto_operations_are_timed():
+	client = _Client()
+	before = {operation: _count(operation) for operation in ('rsa_wrap', 'rsa_decrypt', 'aes_encrypt', 'aes_decrypt')}
+
+	client.create_channel('Einsatz', 1)
+	client.send_msg(('channel', 5), 'hallo')
+	assert [message.get('text_decrypted') for message in client.get_messages(('channel', 5))] == ['hallo']
+
+	assert {operation: _count(operation) - count for operation, count in before.items()} == {
+		'rsa_wrap': 1,
+		# sending, reading and the fake server encrypting the answer
+		'rsa_decrypt': 3,
+		'aes_encrypt': 1,
+		'aes_decrypt': 1,
+	}
+
+
+def test_message_encryption_nests_under_the_sending_span(tmp_path):
+	client = _Client()
+	client.create_channel('Einsatz', 1)
+
+	TRACER.export_to(str(tmp_path / 'spans.json'))
+	try:
+		send = TRACER.start_trace('alarm.send')
+		with use_span(send):
+			client.send_msg(('channel', 5), 'hallo')
+		send.finish()
+	finally:
+		TRACER.stop()
+
+	lines = (tmp_path / 'spans.json').read_text().splitlines()
+	spans = [span for line in lines for span in json.loads(line)['resourceSpans'][0]['scopeSpans'][0]['spans']]
+	encrypt, = [span for span in spans if span['name'] == 'hermine.encrypt']
+	assert encrypt['parentSpanId'] == f'{send.span_id:016x}'
+
+
+def test_requests_have_a_timeout(monkeypatch):
+	calls = []
+
+	def post(url, **kwargs):
+		calls.append(kwargs)
+		raise requests.ConnectTimeout(url)
+
+	monkeypatch.setattr(requests, 'post', post)
+	with pytest.raises(requests.ConnectTimeout):
+		StashCatClient('device')._post('message/send', data={})
+	assert calls[0]['timeout'] == (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+
+def test_decrypting_with_an_iv_of_the_wrong_length_fails():
+	key = bytes(32)
+	ciphertext = _encrypt_aes(b'hallo', key, bytes(16)).hex()
+	codec = AESBatchCodec(key)
+	assert codec.decrypt_many([(ciphertext, bytes(16).hex())]) == [b'hallo']
+
+	for iv in (bytes(8), bytes(24)):
+		with pytest.raises(ValueError):
+			codec.decrypt_many([(ciphertext, iv.hex()), (ciphertext, bytes(16).hex())])
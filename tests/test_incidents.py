@@ -0,0 +1,71 @@
+from concurrent.futures import Future
+
+from modules.incidents import IncidentChannels
+from lib.tracing import NOOP_SPAN
+
+
+class _Builder:
+	def add(self, section, **values):
+		return self
+
+	def build(self):
+		return 'Einsatz'
+
+
+class _Templates:
+	def builder(self, name):
+		return _Builder()
+
+
+class _Outbox:
+	"""Runs every request right away."""
+
+	def __init__(self):
+		self.requests = []
+
+	def submit(self, endpoint, func, *args, **kwargs):
+		self.requests.append(endpoint)
+		future = Future()
+		future.set_result(func(*args))
+		return future
+
+	def send_msg(self, target, message, **kwargs):
+		return self.submit('message/send', lambda: {'id': 1})
+
+
+class _Hermine:
+	user_id = 1
+
+	def __init__(self):
+		self.invited = []
+
+	def create_channel(self, name, company_id):
+		return {'id': 5}
+
+	def invite(self, channel_id, users, text):
+		self.invited.extend(int(user['id']) for user in users)
+
+
+def _alarm(event_id: int, *units: int) -> dict:
+	return {
+		'event': {'id': event_id, 'name': 'Einsatz', 'startDate': '2026-10-19T12:00:00Z'},
+		'message': 'Alarm',
+		'alarmResources': {'units': [{'id': unit} for unit in units]},
+	}
+
+
+def test_updates_of_an_alarm_are_posted_to_its_channel():
+	hermine, outbox = _Hermine(), _Outbox()
+	incidents = IncidentChannels('test', hermine, outbox, None, None, _Templates(), company_id=1, labels=[], unit_channels={}, budget=60.0)
+	incidents._unit_users = {1: [{'id': 2, 'public_key': 'a'}], 2: [{'id': 2, 'public_key': 'a'}, {'id': 3, 'public_key': 'b'}]}
+
+	incidents.provision(_alarm(42, 1), ['Alarm'], None, received=0.0, trace=NOOP_SPAN).result(5)
+	incidents.provision(_alarm(42, 1, 2), ['Update'], None, received=0.0, trace=NOOP_SPAN).result(5)
+
+	assert outbox.requests.count('channels/create') == 1
+	assert outbox.requests.count('message/send') == 2
+	# only the responders added by the update are invited again
+	assert hermine.invited == [2, 3]
+
+	incidents.provision(_alarm(43, 1), ['Alarm'], None, received=0.0, trace=NOOP_SPAN).result(5)
+	assert outbox.requests.count('channels/create') == 2
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+from datetime import datetime
+
+from modules.mail import MailRule, MailWatcher
+
+
+class _Mailbox:
+	"""Holds unseen mails by their UID."""
+
+	def __init__(self, *uids: str):
+		self.unseen = {uid: SimpleNamespace(uid=uid, subject='Beflaggung', from_='bmi@example.org', date=datetime(1900, 1, 1)) for uid in uids}
+
+	def uids(self, criteria):
+		return list(self.unseen)
+
+	def fetch(self, criteria, **kwargs):
+		uids = str(criteria).removeprefix('(UID ').removesuffix(')').split(',')
+		return [self.unseen[uid] for uid in uids]
+
+	def flag(self, uid, flag, value):
+		del self.unseen[uid]
+
+
+def _watcher(*rules: MailRule) -> MailWatcher:
+	watcher = MailWatcher(SimpleNamespace(idle_timeout=60, username='user', host='localhost'), 'INBOX')
+	watcher.rules = {rule.name: rule for rule in rules}
+	return watcher
+
+
+def test_undecided_mail_is_offered_again():
+	decisions = [None, True]
+	offered = []
+
+	def handler(msg):
+		offered.append(msg.uid)
+		return decisions.pop(0)
+
+	watcher = _watcher(MailRule('beflaggung', handler))
+	mailbox = _Mailbox('1')
+
+	watcher._fetch(mailbox)
+	assert offered == ['1'] and '1' in mailbox.unseen
+
+	# after the next IDLE cycle
+	watcher._fetch(mailbox)
+	assert offered == ['1', '1'] and mailbox.unseen == {}
+
+
+def test_skipped_mail_is_not_offered_again():
+	offered = []
+
+	def handler(msg):
+		offered.append(msg.uid)
+		return False
+
+	watcher = _watcher(MailRule('beflaggung', handler))
+	mailbox = _Mailbox('1')
+
+	watcher._fetch(mailbox)
+	watcher._fetch(mailbox)
+	assert offered == ['1'] and '1' in mailbox.unseen
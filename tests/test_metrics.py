@@ -0,0 +1,33 @@
+import gc
+from threading import Thread
+
+from lib.metrics import Counter, Histogram, Registry
+
+
+def _in_threads(func, count: int = 8):
+	threads = [Thread(target=func) for _ in range(count)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	gc.collect()
+
+
+def test_shards_of_exited_threads_are_merged():
+	counter = Counter('test_requests', 'Requests', registry=Registry())
+	_in_threads(lambda: counter.inc(2))
+
+	assert len(counter._shards._shards) == 0
+	assert counter._shards.collect() == [16.0]
+
+	counter.inc()
+	assert counter._shards.collect() == [17.0]
+
+
+def test_histogram_keeps_observations_of_exited_threads():
+	histogram = Histogram('test_seconds', 'Durations', registry=Registry(), buckets=(1.0,))
+	_in_threads(lambda: histogram.observe(0.5), count=3)
+
+	assert len(histogram._shards._shards) == 0
+	samples = {(suffix, tuple(labels.items())): value for suffix, labels, value in histogram._samples()}
+	assert samples[('_count', ())] == 3
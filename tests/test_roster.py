@@ -0,0 +1,68 @@
+from modules.roster import Roster
+
+
+class _Client:
+	organization_id = 1
+
+	def __init__(self):
+		self.users: list[dict] = []
+		self.labels: dict[int, list[int]] = {}
+
+	def get_users(self) -> list[dict]:
+		return self.users
+
+	def get_label(self, label_id: int) -> dict:
+		return {'assignees': self.labels[label_id]}
+
+
+def _user(user_id: int, name: str, *, pending: bool = False) -> dict:
+	return {'id': user_id, 'name': name, 'surname': 'Muster', 'pending': pending}
+
+
+def test_bits_of_removed_persons_are_reused():
+	client = _Client()
+	client.users = [_user(1, 'Anna'), _user(2, 'Ben'), _user(3, 'Carla')]
+	client.labels = {10: [1, 2]}
+	roster = Roster(client)
+	roster.refresh([10])
+	ben = roster.get(2)
+	assert [person.name for person in roster.persons(roster.members([10]))] == ['Anna', 'Ben']
+
+	client.users = [_user(1, 'Anna'), _user(3, 'Carla'), _user(4, 'Dora')]
+	client.labels = {10: [1, 4]}
+	roster.refresh([10], force=True)
+
+	dora = roster.get(4)
+	assert roster.get(2) is None
+	assert dora.index == ben.index
+	assert len(roster) == 3
+	assert roster.members() == 0b111
+	assert [person.name for person in roster.persons(roster.members([10]))] == ['Anna', 'Dora']
+
+
+def test_reused_bit_is_not_a_label_member_of_the_removed_person():
+	client = _Client()
+	client.users = [_user(1, 'Anna'), _user(2, 'Ben')]
+	client.labels = {10: [2]}
+	roster = Roster(client, max_age=3600)
+	roster.refresh([10])
+
+	client.users = [_user(1, 'Anna'), _user(3, 'Carla')]
+	client.labels = {10: []}
+	roster.refresh(force=True)
+	# the label is fetched again on its next refresh, until then the removed member is dropped from it
+	assert roster.members([10]) == 0
+
+	roster.refresh([10])
+	assert roster.persons(roster.members([10])) == []
+	assert roster.mask([1, 2, 3]) == 0b11
+
+
+def test_pending_users_are_left_out():
+	client = _Client()
+	client.users = [_user(1, 'Anna'), _user(2, 'Ben', pending=True)]
+	roster = Roster(client)
+	roster.refresh()
+
+	assert roster.get(2) is None
+	assert roster.persons(roster.members()) == [roster.get(1)]
@@ -0,0 +1,84 @@
+import time
+from datetime import timedelta
+from threading import Event, Lock, Thread
+
+from modules.scheduler import Scheduler
+
+
+def _started(scheduler: Scheduler) -> Thread:
+	thread = Thread(target=scheduler.run, daemon=True)
+	thread.start()
+	return thread
+
+
+def test_jobs_of_the_same_owner_run_one_at_a_time():
+	scheduler = Scheduler(workers=4)
+	thread = _started(scheduler)
+
+	lock = Lock()
+	running = 0
+	overlapped = False
+	done = Event()
+	finished = []
+
+	def job(i: int):
+		nonlocal running, overlapped
+		with lock:
+			running += 1
+			overlapped |= running > 1
+		time.sleep(0.05)
+		with lock:
+			running -= 1
+			finished.append(i)
+			if len(finished) == 4:
+				done.set()
+
+	for i in range(4):
+		scheduler.once(timedelta(0), job, i, owner='module')
+
+	assert done.wait(5)
+	assert not overlapped
+	assert finished == [0, 1, 2, 3]
+
+	scheduler.stop()
+	thread.join(5)
+
+
+def test_jobs_of_different_owners_run_concurrently():
+	scheduler = Scheduler(workers=2)
+	thread = _started(scheduler)
+
+	started = [Event(), Event()]
+	met = []
+
+	def job(i: int):
+		started[i].set()
+		# only true if the job of the other owner runs at the same time
+		met.append(started[1 - i].wait(5))
+
+	scheduler.once(timedelta(0), job, 0, owner='a')
+	scheduler.once(timedelta(0), job, 1, owner='b')
+
+	deadline = time.monotonic() + 5
+	while len(met) < 2 and time.monotonic() < deadline:
+		time.sleep(0.01)
+	assert met == [True, True]
+
+	scheduler.stop()
+	thread.join(5)
+
+
+def test_configure_resizes_the_pool_of_a_running_scheduler():
+	scheduler = Scheduler(workers=1)
+	thread = _started(scheduler)
+	time.sleep(0.05)
+
+	scheduler.configure(workers=3)
+	assert scheduler._executor._max_workers == 3
+
+	ran = Event()
+	scheduler.once(timedelta(0), ran.set)
+	assert ran.wait(5)
+
+	scheduler.stop()
+	thread.join(5)
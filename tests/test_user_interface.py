@@ -0,0 +1,39 @@
+from config import Config
+from modules.push import PushConnection
+from modules.user_interface import _Config
+
+
+def _config(tmp_path, text: str) -> Config:
+	path = tmp_path / 'config.toml'
+	path.write_text(text)
+	return Config(str(path))
+
+
+def test_reloading_the_config_does_not_repeat_the_old_channel(tmp_path):
+	config = _config(tmp_path, '[modules.user_interface]\nhermine_channels = [1, 2]\nhermine_channel = 2\n')
+	cfg = _Config()
+	cfg.load(config.module_data('user_interface'), config)
+	assert cfg.hermine_channels == [1, 2]
+
+	cfg.load(config.module_data('user_interface'), config)
+	assert cfg.hermine_channels == [1, 2]
+
+	config = _config(tmp_path, '[modules.user_interface]\nhermine_channel = 3\n')
+	cfg.load(config.module_data('user_interface'), config)
+	assert cfg.hermine_channels == [3]
+
+
+def test_changed_sources_are_watched_right_away():
+	push = PushConnection(None, [('channel', 1), ('channel', 2)], name='test')
+	received = []
+	push.on_message(lambda source, data, message: received.append(data['id']))
+	push._on_event({'id': 10, 'channel_id': 1})
+
+	push.set_sources([('channel', 1), ('channel', 3)])
+	push._on_event({'id': 11, 'channel_id': 2})
+	push._on_event({'id': 12, 'channel_id': 3})
+	# the kept channel continues where it left off
+	push._on_event({'id': 10, 'channel_id': 1})
+	push._on_event({'id': 13, 'channel_id': 1})
+
+	assert received == [10, 12, 13]
@@ -0,0 +1,85 @@
+from modules.utils import cached, holding, parallel
+
+
+class _Client:
+	def __init__(self, name: str):
+		self.name = name
+		self.closed = False
+
+	def close(self) -> None:
+		self.closed = True
+
+
+def _factory():
+	@cached(maxsize=1, close=lambda client: client.close())
+	def get_client(name: str) -> _Client:
+		return _Client(name)
+	return get_client
+
+
+def test_least_recently_used_client_is_not_closed_while_held():
+	get_client = _factory()
+	module_a, module_b = object(), object()
+
+	with holding(module_a):
+		a = get_client('a')
+	with holding(module_b):
+		b = get_client('b')
+
+	# evicted from the cache, but module_a still uses it
+	assert len(get_client.cache) == 1
+	assert not a.closed
+
+	# reconfigured with another client
+	with holding(module_a):
+		assert get_client('b') is b
+	assert a.closed
+	assert not b.closed
+
+
+def test_client_is_closed_once_the_last_holder_releases_it():
+	get_client = _factory()
+	module_a, module_b = object(), object()
+
+	with holding(module_a):
+		shared = get_client('shared')
+	with holding(module_b):
+		assert get_client('shared') is shared
+
+	with holding(module_a):
+		get_client('a')
+	assert not shared.closed
+
+	with holding(module_b):
+		get_client('b')
+	assert shared.closed
+
+
+def test_failed_configuration_keeps_the_previous_clients():
+	get_client = _factory()
+	module = object()
+
+	with holding(module):
+		previous = get_client('a')
+	try:
+		with holding(module):
+			get_client('b')
+			raise ValueError()
+	except ValueError:
+		pass
+
+	assert not previous.closed
+
+
+def test_clients_requested_in_parallel_are_held_by_the_caller():
+	get_client = _factory()
+	module = object()
+
+	with holding(module):
+		a, b = parallel(lambda: get_client('a'), lambda: get_client('b'))
+
+	assert not a.closed and not b.closed
+	with holding(module):
+		pass
+	# only the one that was evicted from the cache
+	assert sorted([a.closed, b.closed]) == [False, True]
@@ -0,0 +1,54 @@
+import http.client
+
+import pytest
+
+from modules.webhooks import WebhookServer, is_loopback
+
+
+@pytest.fixture
+def server():
+	server = WebhookServer('127.0.0.1', 0)
+	yield server
+	server.close()
+
+
+def _post(server: WebhookServer, path: str, body: bytes, headers: dict[str, str]) -> int:
+	connection = http.client.HTTPConnection('127.0.0.1', server._server.server_port, timeout=5)
+	try:
+		connection.putrequest('POST', path)
+		for name, value in headers.items():
+			connection.putheader(name, value)
+		connection.endheaders(body)
+		return connection.getresponse().status
+	finally:
+		connection.close()
+
+
+def test_webhook_is_handled(server):
+	received = []
+	server.route('/hook', received.append, secret='s3cret')
+
+	assert _post(server, '/hook', b'{"id": 1}', {'Content-Length': '9', 'X-Webhook-Secret': 's3cret'}) == 202
+	assert _post(server, '/hook', b'{"id": 2}', {'Content-Length': '9', 'X-Webhook-Secret': 'wrong'}) == 401
+	assert received == [{'id': 1}]
+
+
+@pytest.mark.parametrize('length', ['abc', '-5'])
+def test_malformed_content_length_is_rejected(server, length):
+	received = []
+	server.route('/hook', received.append)
+
+	assert _post(server, '/hook', b'{}', {'Content-Length': length}) == 400
+	assert received == []
+
+
+@pytest.mark.parametrize('host, expected', [
+	('127.0.0.1', True),
+	('::1', True),
+	('localhost', True),
+	('0.0.0.0', False),
+	('192.168.1.10', False),
+	('example.org', False),
+])
+def test_is_loopback(host, expected):
+	assert is_loopback(host) is expected